@@ -5,9 +5,12 @@ import django
 from django import forms
 from django.contrib import messages
 from django.contrib.admin.actions import delete_selected
-from django.contrib.admin.views.main import ChangeList
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR, PAGE_VAR
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext_lazy as _
 from django.urls import reverse
 from object_tool import CustomObjectToolModelAdmin
@@ -86,6 +89,90 @@ class WeChatChangeList(ChangeList):
             view, kwargs=kwargs, current_app=self.model_admin.admin_site.name)
 
 
+CURSOR_VAR = "cursor"
+
+
+class KeysetChangeList(WeChatChangeList):
+    """不执行COUNT(*)的ChangeList
+
+    默认排序时按(keyset_field, pk)倒序以游标翻页,点击列排序时退化为
+    OFFSET翻页,两种方式均多取一行判断是否有下一页
+    """
+    nocount = True
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = request.GET.get(CURSOR_VAR)
+        super(KeysetChangeList, self).__init__(request, *args, **kwargs)
+        # 同PAGE_VAR 游标不应保留在筛选链接及搜索表单中
+        self.params.pop(CURSOR_VAR, None)
+
+    def get_filters_params(self, params=None):
+        rv = super(KeysetChangeList, self).get_filters_params(params)
+        rv.pop(CURSOR_VAR, None)
+        return rv
+
+    @property
+    def keyset(self):
+        return ORDER_VAR not in self.params
+
+    def get_results(self, request):
+        field = self.model_admin.keyset_field
+        per_page = self.list_per_page
+        queryset = self.queryset
+        if self.keyset:
+            queryset = queryset.order_by("-" + field, "-pk")
+            if self.cursor:
+                value, pk = self.parse_cursor(self.cursor)
+                queryset = queryset.filter(
+                    Q(**{field + "__lt": value})
+                    | Q(**{field: value, "pk__lt": pk}))
+        else:
+            offset = self.page_num * per_page
+            queryset = queryset[offset:]
+        result_list = list(queryset[:per_page + 1])
+        has_next = len(result_list) > per_page
+        result_list = result_list[:per_page]
+
+        self.next_url = self.prev_url = self.first_url = None
+        if has_next:
+            if self.keyset:
+                self.next_url = self.get_query_string(
+                    {CURSOR_VAR: self.make_cursor(result_list[-1])})
+            else:
+                self.next_url = self.get_query_string(
+                    {PAGE_VAR: self.page_num + 1})
+        if self.keyset and self.cursor:
+            self.first_url = self.get_query_string(remove=[CURSOR_VAR])
+        elif not self.keyset and self.page_num:
+            self.prev_url = self.get_query_string(
+                {PAGE_VAR: self.page_num - 1})
+
+        self.result_count = len(result_list)
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = False
+        self.paginator = self.model_admin.get_paginator(
+            request, result_list, per_page)
+
+    def make_cursor(self, obj):
+        value = getattr(obj, self.model_admin.keyset_field)
+        return "{0},{1}".format(value.isoformat(), obj.pk)
+
+    def parse_cursor(self, cursor):
+        try:
+            value, pk = cursor.rsplit(",", 1)
+            value = parse_datetime(value)
+            pk = int(pk)
+        except ValueError:
+            raise IncorrectLookupParameters
+        if not value:
+            raise IncorrectLookupParameters
+        return value, pk
+
+
 class WeChatModelAdminMetaClass(forms.MediaDefiningClass):
     def __new__(cls, name, bases, attrs):
         model = attrs.pop("__model__", None)
@@ -106,8 +193,13 @@ class WeChatModelAdmin(six.with_metaclass(WeChatModelAdminMetaClass,
     change_list_template = "admin/wechat_django/change_list.html"
     objecttool_form_template = "admin/wechat_django/objecttool_form.html"
 
+    keyset_field = None
+    """设置后列表页不再COUNT(*),按该字段与主键游标翻页"""
+
     #region view
     def get_changelist(self, request):
+        if self.keyset_field:
+            return KeysetChangeList
         return WeChatChangeList
 
     def get_urls(self):
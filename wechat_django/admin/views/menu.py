@@ -84,7 +84,8 @@ class MenuAdmin(WeChatModelAdmin):
         self.check_wechat_permission(request, "publish")
 
         def action():
-            request.app.publish_menus()
+            if request.app.publish_menus() is None:
+                return _("Menus unchanged since last publish")
             return _("Menus successful published")
 
         return self._clientaction(
@@ -110,7 +111,8 @@ class MenuAdmin(WeChatModelAdmin):
         return rv
 
     def get_queryset(self, request):
-        rv = super(MenuAdmin, self).get_queryset(request)
+        rv = super(MenuAdmin, self).get_queryset(request).filter(
+            conditional__isnull=True)
         if not get_request_params(request, "menuid"):
             rv = rv.filter(menuid__isnull=True)
         if request.GET.get("parent_id"):
@@ -2,9 +2,12 @@
 from __future__ import unicode_literals
 
 from django.contrib import admin
+from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 
-from ...models import MessageLog
+from ...models import MessageLog, WeChatUser
+from ...search import get_search_backend
+from ...utils.model import bucket_range
 from ..utils import foreignkey
 from ..base import WeChatModelAdmin
 
@@ -13,17 +16,52 @@ class MessageLogAdmin(WeChatModelAdmin):
     __category__ = "messagelog"
     __model__ = MessageLog
 
+    class BucketFilter(admin.SimpleListFilter):
+        """按月分区筛选 仅查询所选分区"""
+        title = _("month")
+        parameter_name = "bucket"
+
+        def lookups(self, request, model_admin):
+            buckets = MessageLog.objects.filter(
+                app_id=request.app_id).calendar_buckets()
+            return [(str(b), "%d-%02d" % divmod(b, 100)) for b in buckets]
+
+        def queryset(self, request, queryset):
+            if self.value():
+                bucket = int(self.value())
+                start, end = bucket_range(bucket)
+                queryset = queryset.filter(
+                    bucket=bucket, created_at__gte=start, created_at__lt=end)
+            return queryset
+
     list_display = (
         "msg_id", foreignkey("user"), "type", "content", "created_at")
-    list_filter = ("type", )
+    list_filter = (BucketFilter, "type")
     search_fields = (
         "=user__openid", "=user__unionid", "user__nickname", "user__comment",
-        "content")
+        "text")
+    keyset_field = "created_at"
 
     fields = (
         "msg_id", foreignkey("user"), "type", "content", "created_at")
     readonly_fields = fields
 
+    def get_search_results(self, request, queryset, search_term):
+        """按openid或unionid精确匹配用户,或按昵称,备注包含匹配用户,
+        或经搜索后端检索消息文本,避免在日志表上做LIKE查询
+        """
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        # 用户表远小于日志表 在用户子查询中做包含查询
+        users = WeChatUser.objects.filter(app_id=request.app_id).filter(
+            Q(openid=search_term) | Q(unionid=search_term)
+            | Q(nickname__icontains=search_term)
+            | Q(comment__icontains=search_term)).values("id")
+        rv = queryset.filter(
+            Q(user_id__in=users) | get_search_backend().q(search_term))
+        return rv, False
+
     def has_add_permission(self, request):
         return False
 
@@ -42,6 +42,7 @@ class WeChatUserAdmin(WeChatModelAdmin):
         "openid", "nickname", "avatar", "alias", "subscribe", "remark",
         "created_at")
     search_fields = ("=openid", "=unionid", "alias", "nickname", "remark")
+    keyset_field = "created_at"
 
     fields = (
         "avatar", "nickname", "openid", "unionid", "alias", "sex", "city",
@@ -22,6 +22,7 @@ class WeChatConfig(AppConfig):
 
         # 注册注册关注,取关事件
         from . import signals
-        from .handler import handle_subscribe_events
+        from .handler import handle_subscribe_events, handle_template_events
 
         signals.message_received.connect(handle_subscribe_events)
+        signals.message_received.connect(handle_template_events)
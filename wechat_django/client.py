@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 import logging
+import threading
 
 from django.utils.module_loading import import_string
 from wechatpy import exceptions as excs, WeChatClient as _Client
@@ -20,6 +21,39 @@ class WeChatMaterial(api.WeChatMaterial):
             }
         )
 
+    def get_stream(self, media_id):
+        """流式下载永久素材 图文及视频素材仍返回解析后的json,
+        其他素材调用方读取完毕后需关闭返回的response
+
+        :rtype: requests.Response or dict
+        """
+        self._client._stream_local.stream = True
+        try:
+            return self._post(
+                'material/get_material',
+                data={'media_id': media_id},
+                stream=True
+            )
+        finally:
+            self._client._stream_local.stream = False
+
+
+class WeChatMedia(api.WeChatMedia):
+    def download_stream(self, media_id):
+        """流式下载临时素材 调用方读取完毕后需关闭返回的response
+
+        :rtype: requests.Response
+        """
+        self._client._stream_local.stream = True
+        try:
+            return self._get(
+                'media/get',
+                params={'media_id': media_id},
+                stream=True
+            )
+        finally:
+            self._client._stream_local.stream = False
+
 
 class WeChatMessage(api.WeChatMessage):
     def send_articles(self, user_id, articles, account=None):
@@ -39,6 +73,7 @@ class WeChatClient(_Client):
     """继承原有WeChatClient添加日志功能 追加accesstoken url获取"""
     # 增加raw_get方法
     material = WeChatMaterial()
+    media = WeChatMedia()
     message = WeChatMessage()
 
     ACCESSTOKEN_URL = None
@@ -49,6 +84,8 @@ class WeChatClient(_Client):
         if callable(session):
             session = session(app)
         self.app = app
+        self._log_local = threading.local()
+        self._stream_local = threading.local()
         if app.configurations.get("ACCESSTOKEN_URL"):
             self.ACCESSTOKEN_URL = app.configurations["ACCESSTOKEN_URL"]
         super(WeChatClient, self).__init__(
@@ -74,14 +111,30 @@ class WeChatClient(_Client):
             raise
 
     def _handle_result(self, res, method=None, url=None, *args, **kwargs):
+        if getattr(self._stream_local, "stream", False)\
+            and not self._is_json(res):
+            # 流式下载时不读取响应体
+            self._update_log(resp="<stream>")
+            return res
         resp = res.content if hasattr(res, "content") else res
         self._update_log(resp=resp)
         return super(WeChatClient, self)._handle_result(
             res, method, url, *args, **kwargs)
 
+    @staticmethod
+    def _is_json(res):
+        content_type = getattr(res, "headers", {}).get("Content-Type", "")
+        return not content_type\
+            or content_type.startswith(("application/json", "text/"))
+
+    @property
+    def _log_kwargs(self):
+        # 日志参数线程隔离 允许多线程共用一个client并发请求
+        if not hasattr(self._log_local, "kwargs"):
+            self._log_local.kwargs = dict()
+        return self._log_local.kwargs
+
     def _update_log(self, **kwargs):
-        if not hasattr(self, "_log_kwargs"):
-            self._log_kwargs = dict()
         self._log_kwargs.update(kwargs)
 
     def _log(self, level):
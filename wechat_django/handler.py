@@ -23,8 +23,8 @@ from . import settings, signals
 from .exceptions import BadMessageRequest, MessageHandleError
 from .sites.wechat import default_site, WeChatInfo, WeChatView
 
-__all__ = ("handle_subscribe_events", "Handler", "message_handler",
-           "message_rule", "WeChatMessageInfo")
+__all__ = ("handle_subscribe_events", "handle_template_events", "Handler",
+           "message_handler", "message_rule", "WeChatMessageInfo")
 
 
 class WeChatMessageInfo(WeChatInfo):
@@ -270,3 +270,15 @@ def handle_subscribe_events(sender, message_info, **kwargs):
         if message.event == "unsubscribe":
             message_info.local_user.subscribe = False
             message_info.local_user.save()
+
+
+def handle_template_events(sender, message_info, **kwargs):
+    """处理模板消息送达事件(TEMPLATESENDJOBFINISH),更新发送记录的送达状态"""
+    from .models import TemplateMessageLog
+
+    message = message_info.message
+    if isinstance(message, BaseEvent)\
+        and message.event == "templatesendjobfinish":
+        (TemplateMessageLog.objects
+            .filter(app=message_info.app)
+            .update_status([(message.id, message.status)]))
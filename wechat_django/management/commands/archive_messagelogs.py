@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from wechat_django.models import WeChatApp
+from wechat_django.utils.model import bucket_range, month_bucket
+
+
+class Command(BaseCommand):
+    help = "将过期的消息日志按月归档为压缩文件并从数据库删除"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "output", help="归档目录")
+        parser.add_argument(
+            "--app", dest="appnames", action="append",
+            help="公众号名,可指定多个,默认全部")
+        parser.add_argument(
+            "--months", type=int, default=6, help="保留最近几个月的日志")
+        parser.add_argument(
+            "--chunk-size", dest="chunk_size", type=int, default=1000)
+
+    def handle(self, output, appnames=None, months=6, chunk_size=1000,
+               **options):
+        if months < 1:
+            raise CommandError("months must be positive")
+        if not os.path.isdir(output):
+            os.makedirs(output)
+
+        # 保留含本月在内的months个月
+        bucket = month_bucket(timezone.now())
+        for i in range(months - 1):
+            year, month = divmod(bucket, 100)
+            bucket = (year - 1) * 100 + 12 if month == 1 else bucket - 1
+        before = bucket_range(bucket)[0]
+
+        apps = WeChatApp.objects.all()
+        if appnames:
+            apps = apps.filter(name__in=appnames)
+        for app in apps:
+            for bucket, count in sorted(app.archive_messagelogs(
+                before, output, chunk_size).items()):
+                self.stdout.write("{0} {1}: {2} archived".format(
+                    app.name, bucket, count))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from wechat_django.models import MessageLog
+
+
+class Command(BaseCommand):
+    help = "为已有消息日志提取文本并建立搜索索引"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--app", dest="appnames", action="append",
+            help="公众号名,可指定多个,默认全部")
+        parser.add_argument(
+            "--chunk-size", dest="chunk_size", type=int, default=1000)
+
+    def handle(self, appnames=None, chunk_size=1000, **options):
+        logs = MessageLog.objects.all()
+        if appnames:
+            logs = logs.filter(app__name__in=appnames)
+        count = MessageLog.reindex(logs, chunk_size)
+        self.stdout.write("{0} message logs indexed".format(count))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from wechat_django.models import WeChatApp
+from wechat_django.models.permission import sync_perms
+
+
+class Command(BaseCommand):
+    help = "补全各公众号缺失的权限并修正权限名称"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--app", dest="appnames", action="append",
+            help="公众号名,可指定多个,默认全部")
+
+    def handle(self, appnames=None, **options):
+        apps = WeChatApp.objects.all()
+        if appnames:
+            apps = apps.filter(name__in=appnames)
+        created, renamed = sync_perms(apps)
+        self.stdout.write(
+            "{0} permissions created, {1} renamed".format(created, renamed))
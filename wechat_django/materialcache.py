@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""素材Storage
+
+素材代理下载的内容按sha1寻址存放在WECHAT_MATERIALSTORAGE配置的
+django Storage中,media_id到内容的索引及写入量存放于django cache,
+总大小超过WECHAT_MATERIALCACHESIZE时按最近访问时间淘汰,
+多进程部署时请使用共享的cache
+"""
+
+from __future__ import unicode_literals
+
+from hashlib import sha1
+import os
+import tempfile
+import time
+
+from django.core.cache import cache
+from django.core.files.base import File
+from django.utils.module_loading import import_string
+import six
+
+from . import settings
+
+
+INDEX_CACHE_KEY = "wechat_django:material:{app_id}:{media_id}"
+WRITTEN_CACHE_KEY = "wechat_django:material:written"
+EVICT_LOCK_KEY = "wechat_django:material:evicting"
+
+
+class MaterialCache(object):
+    """按内容寻址的素材缓存
+
+    :type storage: django.core.files.storage.Storage
+    :param max_size: 缓存的最大字节数,超出时淘汰最久未访问的文件
+    """
+    directory = "materials"
+    touch_interval = 60
+    evict_timeout = 600
+    spool_size = 1024*1024
+
+    def __init__(self, storage, max_size=None):
+        self.storage = storage
+        self.max_size = max_size
+
+    def get(self, app, media_id):
+        """取出缓存的素材
+
+        :returns: (索引信息, 文件) 未缓存时返回(None, None)
+        """
+        key = INDEX_CACHE_KEY.format(app_id=app.id, media_id=media_id)
+        info = cache.get(key)
+        if not info:
+            return None, None
+        file = self.open(info)
+        if not file:
+            # 文件已被淘汰
+            cache.delete(key)
+            return None, None
+        return info, file
+
+    def open(self, info):
+        """打开缓存的文件 文件已被淘汰时返回None"""
+        try:
+            file = self.storage.open(info["name"], "rb")
+        except (IOError, OSError):
+            return None
+        self._touch(info["name"])
+        return file
+
+    def set(self, app, media_id, chunks, headers=None):
+        """缓存素材内容 内容经临时文件流式写入storage
+
+        :param chunks: 素材内容,bytes或可迭代的bytes片段
+        :param headers: 需要随响应返回的content-*头
+        :returns: 索引信息
+        """
+        if isinstance(chunks, bytes):
+            chunks = [chunks]
+        with tempfile.SpooledTemporaryFile(self.spool_size) as file:
+            digest = sha1()
+            size = 0
+            for chunk in chunks:
+                digest.update(chunk)
+                file.write(chunk)
+                size += len(chunk)
+            digest = digest.hexdigest()
+            name = "{0}/{1}/{2}".format(self.directory, digest[:2], digest)
+            written = None
+            if not self.storage.exists(name):
+                file.seek(0)
+                name = self.storage.save(name, File(file, name=name))
+                written = self._add_written(size)
+        info = dict(
+            name=name,
+            etag=digest,
+            size=size,
+            modified=time.time(),
+            headers=dict(headers or {}),
+        )
+        cache.set(INDEX_CACHE_KEY.format(app_id=app.id, media_id=media_id),
+                  info, None)
+        if self.max_size and written and written * 10 >= self.max_size:
+            self.evict()
+        return info
+
+    def evict(self):
+        """淘汰最久未访问的文件直至总大小不超过max_size的九成"""
+        # 以cache为锁 同一时间只有一个进程执行淘汰
+        if not self.max_size\
+            or not cache.add(EVICT_LOCK_KEY, True, self.evict_timeout):
+            return
+        try:
+            cache.set(WRITTEN_CACHE_KEY, 0, None)
+            files = list(self._iter_files())
+            total = sum(size for _, size, _ in files)
+            if total <= self.max_size:
+                return
+            target = self.max_size * 0.9
+            for name, size, _ in sorted(files, key=lambda o: o[2]):
+                if total <= target:
+                    break
+                self.storage.delete(name)
+                total -= size
+        finally:
+            cache.delete(EVICT_LOCK_KEY)
+
+    def _add_written(self, size):
+        """累计各进程自上次淘汰后写入的字节数"""
+        cache.add(WRITTEN_CACHE_KEY, 0, None)
+        try:
+            return cache.incr(WRITTEN_CACHE_KEY, size)
+        except ValueError:
+            # 计数被cache淘汰
+            cache.set(WRITTEN_CACHE_KEY, size, None)
+            return size
+
+    def _iter_files(self):
+        try:
+            prefixes = self.storage.listdir(self.directory)[0]
+        except (IOError, OSError):
+            return
+        for prefix in prefixes:
+            path = "{0}/{1}".format(self.directory, prefix)
+            for filename in self.storage.listdir(path)[1]:
+                name = "{0}/{1}".format(path, filename)
+                yield name, self.storage.size(name), self._accessed_time(name)
+
+    def _accessed_time(self, name):
+        try:
+            return self.storage.get_modified_time(name)
+        except NotImplementedError:
+            return self.storage.get_created_time(name)
+
+    def _touch(self, name):
+        """访问时更新本地文件的修改时间 作为淘汰依据"""
+        try:
+            path = self.storage.path(name)
+        except NotImplementedError:
+            return
+        try:
+            if os.path.getmtime(path) + self.touch_interval < time.time():
+                os.utime(path, None)
+        except (IOError, OSError):
+            pass
+
+
+_material_cache = None
+
+
+def get_material_cache():
+    """未配置WECHAT_MATERIALSTORAGE时返回None
+
+    :rtype: MaterialCache
+    """
+    global _material_cache
+    if not _material_cache and settings.MATERIALSTORAGE:
+        storage = settings.MATERIALSTORAGE
+        if isinstance(storage, six.string_types):
+            storage = import_string(storage)
+        _material_cache = MaterialCache(storage(), settings.MATERIALCACHESIZE)
+    return _material_cache
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 05:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0005_alias'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateMessageLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('campaign', models.CharField(blank=True, help_text='批量发送的批次标识', max_length=64, null=True, verbose_name='campaign')),
+                ('openid', models.CharField(max_length=36, verbose_name='openid')),
+                ('msgid', models.BigIntegerField(null=True, verbose_name='msgid')),
+                ('errcode', models.IntegerField(default=0, verbose_name='errcode')),
+                ('errmsg', models.CharField(blank=True, max_length=256, null=True, verbose_name='errmsg')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='template_logs', to='wechat_django.WeChatApp')),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='logs', to='wechat_django.Template')),
+            ],
+            options={
+                'verbose_name': 'template message log',
+                'verbose_name_plural': 'template message logs',
+                'ordering': ('app', '-created_at'),
+                'index_together': {('template', 'campaign', 'openid')},
+            },
+        ),
+    ]
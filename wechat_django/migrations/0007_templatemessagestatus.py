@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 05:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0006_templatemessagelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='templatemessagelog',
+            name='status',
+            field=models.CharField(blank=True, choices=[('success', 'SUCCESS'), ('failed: system failed', 'SYSTEMFAILED'), ('failed:user block', 'USERBLOCK')], max_length=32, null=True, verbose_name='status'),
+        ),
+        migrations.AlterIndexTogether(
+            name='templatemessagelog',
+            index_together={('app', 'msgid'), ('template', 'campaign', 'openid')},
+        ),
+    ]
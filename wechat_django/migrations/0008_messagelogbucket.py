@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import wechat_django.models.messagelog
+
+from wechat_django.utils.model import bucket_range, month_bucket
+
+
+def fill_buckets(apps, schema_editor):
+    """按月批量填充已有消息日志的分区号"""
+    MessageLog = apps.get_model("wechat_django", "MessageLog")
+    dates = MessageLog.objects.aggregate(
+        first=models.Min("created_at"), last=models.Max("created_at"))
+    if not dates["first"]:
+        return
+    bucket, last = month_bucket(dates["first"]), month_bucket(dates["last"])
+    while bucket <= last:
+        start, end = bucket_range(bucket)
+        MessageLog.objects.filter(
+            created_at__gte=start, created_at__lt=end).update(bucket=bucket)
+        bucket = month_bucket(end)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0007_templatemessagestatus'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='bucket',
+            field=wechat_django.models.messagelog.MonthBucketField(date_field='created_at', default=0, editable=False, verbose_name='bucket'),
+        ),
+        migrations.RunPython(fill_buckets, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='messagelog',
+            index_together={('app', 'created_at'), ('app', 'bucket')},
+        ),
+    ]
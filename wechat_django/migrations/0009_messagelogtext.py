@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 06:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0008_messagelogbucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='text',
+            field=models.TextField(blank=True, null=True, verbose_name='text'),
+        ),
+    ]
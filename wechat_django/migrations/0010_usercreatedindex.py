@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 06:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0009_messagelogtext'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='wechatuser',
+            index_together={('app', 'created_at')},
+        ),
+    ]
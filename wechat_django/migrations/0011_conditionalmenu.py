@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 06:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0010_usercreatedindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConditionalMenu',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=32, verbose_name='title')),
+                ('matchrule', jsonfield.fields.JSONField(default=dict, help_text='tag_id,sex,country,province,city,client_platform_type及language的组合', verbose_name='matchrule')),
+                ('menuid', models.CharField(editable=False, max_length=32, null=True, verbose_name='menuid')),
+                ('published', jsonfield.fields.JSONField(editable=False, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conditional_menus', to='wechat_django.WeChatApp')),
+            ],
+            options={
+                'verbose_name': 'conditional menu',
+                'verbose_name_plural': 'conditional menus',
+            },
+        ),
+        migrations.AddField(
+            model_name='menu',
+            name='conditional',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='menus', to='wechat_django.ConditionalMenu'),
+        ),
+    ]
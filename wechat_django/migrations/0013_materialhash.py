@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 06:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0012_articlehash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='material',
+            name='content_hash',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='material',
+            index_together={('app', 'content_hash')},
+        ),
+    ]
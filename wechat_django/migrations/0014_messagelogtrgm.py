@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import DatabaseError, migrations, transaction
+
+
+INDEX_NAME = "wechat_django_messagelog_text_trgm"
+
+
+def create_trgm_index(apps, schema_editor):
+    """PostgreSQL下为消息文本建立pg_trgm的gin索引,供包含查询使用
+
+    索引建立在UPPER(text)上,与icontains生成的查询一致
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            schema_editor.execute(
+                "CREATE INDEX IF NOT EXISTS {0} ON wechat_django_messagelog "
+                "USING gin (UPPER(text) gin_trgm_ops)".format(INDEX_NAME))
+    except DatabaseError:
+        # 无权限安装扩展时跳过,可由DBA手动执行上述语句
+        logging.getLogger("wechat.migrations").warning(
+            "unable to create pg_trgm index on messagelog text",
+            exc_info=True)
+
+
+def drop_trgm_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS {0}".format(INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0013_materialhash'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trgm_index, drop_trgm_index),
+    ]
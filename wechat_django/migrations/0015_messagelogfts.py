@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import DatabaseError, migrations, transaction
+
+
+TABLE_NAME = "wechat_django_messagelog_fts"
+
+
+def create_fts_table(apps, schema_editor):
+    """SQLite下为消息文本建立FTS5 trigram全文索引,供SQLiteFTSSearchBackend使用
+
+    索引表以消息日志表为外部内容,由触发器随日志的写入,修改及删除
+    (包括级联删除及批量删除)同步更新,删除后重用的rowid不会残留旧索引
+    """
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    statements = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5("
+        "text, content='wechat_django_messagelog', content_rowid='id', "
+        "tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS {0}_ai AFTER INSERT ON "
+        "wechat_django_messagelog BEGIN "
+        "INSERT INTO {0} (rowid, text) VALUES (new.id, new.text); END",
+        "CREATE TRIGGER IF NOT EXISTS {0}_ad AFTER DELETE ON "
+        "wechat_django_messagelog BEGIN "
+        "INSERT INTO {0} ({0}, rowid, text) "
+        "VALUES ('delete', old.id, old.text); END",
+        "CREATE TRIGGER IF NOT EXISTS {0}_au AFTER UPDATE OF text ON "
+        "wechat_django_messagelog BEGIN "
+        "INSERT INTO {0} ({0}, rowid, text) "
+        "VALUES ('delete', old.id, old.text); "
+        "INSERT INTO {0} (rowid, text) VALUES (new.id, new.text); END",
+        # 为已有日志建立索引
+        "INSERT INTO {0} ({0}) VALUES ('rebuild')"
+    )
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            for statement in statements:
+                schema_editor.execute(statement.format(TABLE_NAME))
+    except DatabaseError:
+        # 未编译FTS5或SQLite低于3.34(不支持trigram分词)时跳过,
+        # SQLiteFTSSearchBackend将退化为包含查询
+        logging.getLogger("wechat.migrations").warning(
+            "unable to create fts5 table for messagelog text",
+            exc_info=True)
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for suffix in ("_ai", "_ad", "_au"):
+        schema_editor.execute(
+            "DROP TRIGGER IF EXISTS {0}{1}".format(TABLE_NAME, suffix))
+    schema_editor.execute("DROP TABLE IF EXISTS {0}".format(TABLE_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0014_messagelogtrgm'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
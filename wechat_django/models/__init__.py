@@ -8,6 +8,7 @@ from .app import WeChatApp
 from .permission import permissions
 from .base import WeChatModel, appmethod
 from .template import Template
+from .templatemessagelog import TemplateMessageLog
 from .user import WeChatUser
 from .usertag import UserTag
 from .material import Material
@@ -16,5 +17,5 @@ from .messagehandler import MessageHandler
 from .reply import Reply
 from .rule import Rule
 from .messagelog import MessageLog
-from .menu import Menu
+from .menu import ConditionalMenu, Menu
 from .session import Session
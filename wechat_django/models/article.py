@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from hashlib import md5
+import json
+
 from django.db import models as m, transaction
 from django.utils.translation import ugettext_lazy as _
 
+from ..utils.model import model_fields
 from . import appmethod, Material, WeChatModel
 
 
@@ -31,6 +35,7 @@ class Article(WeChatModel):
     index = m.PositiveSmallIntegerField(_("index"))
     _thumb_url = m.CharField(
         db_column="thumb_url", max_length=256, null=True, default=None)
+    content_hash = m.CharField(max_length=32, null=True, editable=False)
 
     synced_at = m.DateTimeField(_("synchronized at"), auto_now_add=True)
 
@@ -65,12 +70,88 @@ class Article(WeChatModel):
 
     @classmethod
     @appmethod("sync_articles")
-    def sync(cls, app, id=None):
+    def sync(cls, app, id=None, incremental=False):
         if id:
             return Material.sync(app, id, Material.Type.NEWS)
         else:
             with transaction.atomic():
-                return Material.sync_type(app, Material.Type.NEWS)
+                return Material.sync_type(
+                    app, Material.Type.NEWS, incremental)
+
+    @classmethod
+    def fill_thumb_urls(cls, articles):
+        """批量补全缺失的封面url 一次查询素材,一次写入
+
+        :type articles: list of Article
+        """
+        missing = [
+            o for o in articles if o._thumb_url is None and o.thumb_media_id]
+        if not missing:
+            return
+        conditions = m.Q()
+        for article in missing:
+            conditions |= m.Q(
+                app_id=article.material.app_id,
+                media_id=article.thumb_media_id)
+        urls = {
+            (app_id, media_id): url
+            for app_id, media_id, url in Material.objects.filter(conditions)
+                .values_list("app_id", "media_id", "url")
+        }
+        updates = dict()
+        for article in missing:
+            url = urls.get((article.material.app_id, article.thumb_media_id))
+            if url is not None:
+                article._thumb_url = url
+                updates[article.id] = url
+        updates and cls.objects.filter(id__in=updates.keys()).update(
+            _thumb_url=m.Case(*[
+                m.When(id=id, then=m.Value(url))
+                for id, url in updates.items()
+            ]))
+
+    @classmethod
+    def from_json(cls, data, material, index):
+        """由素材接口返回的图文生成Article"""
+        fields = model_fields(cls)
+        return cls(
+            index=index,
+            material=material,
+            _thumb_url=data.get("thumb_url"),
+            content_hash=cls.hash(data),
+            **{k: v for k, v in data.items() if k in fields}
+        )
+
+    @staticmethod
+    def hash(data):
+        return md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def upsert(cls, news):
+        """批量写入图文 仅替换内容有变化的图文
+
+        :param news: (Material, news_item)的迭代器
+        """
+        news = list(news)
+        existed = dict()
+        for id, material_id, index, content_hash in (cls.objects
+            .filter(material__in=[material for material, _ in news])
+            .values_list("id", "material_id", "index", "content_hash")):
+            existed[(material_id, index)] = (id, content_hash)
+
+        stale = []
+        created = []
+        for material, articles in news:
+            for index, article in enumerate(articles):
+                old = existed.pop((material.id, index), None)
+                if old and old[1] == cls.hash(article):
+                    continue
+                old and stale.append(old[0])
+                created.append(cls.from_json(article, material, index))
+        # 图文数减少
+        stale.extend(id for id, _ in existed.values())
+        stale and cls.objects.filter(id__in=stale).delete()
+        created and cls.objects.bulk_create(created)
 
     def to_json(self):
         return dict(
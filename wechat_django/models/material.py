@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from hashlib import sha1
 import mimetypes
 import re
+import tempfile
 
 from django.db import models as m, transaction
 from django.utils.translation import ugettext_lazy as _
 from wechatpy.constants import WeChatErrorCode
 from wechatpy.exceptions import WeChatClientException
 
+from ..utils.func import concurrent_map, next_chunk
 from ..utils.model import enum2choices, model_fields
 from . import appmethod, WeChatApp, WeChatModel
 
@@ -57,20 +60,17 @@ class MaterialManager(m.Manager):
             news.articles.all().delete()
 
         articles = (kwargs.get("content") or kwargs)["news_item"]
-        fields = model_fields(Article)
         news.articles.bulk_create([
-            Article(
-                index=idx,
-                material=news,
-                _thumb_url=article.get("thumb_url"),
-                **{k: v for k, v in article.items() if k in fields}
-            )
+            Article.from_json(article, news, idx)
             for idx, article in enumerate(articles)
         ])
         return news
 
 
 class Material(WeChatModel):
+    CHUNK_SIZE = 64*1024
+    SPOOL_SIZE = 1024*1024
+
     class Type(object):
         IMAGE = "image"
         VIDEO = "video"
@@ -91,6 +91,7 @@ class Material(WeChatModel):
     url = m.CharField(_("url"), max_length=512, editable=False, null=True)
     update_time = m.IntegerField(
         _("update time"), editable=False, null=True)
+    content_hash = m.CharField(max_length=40, null=True, editable=False)
 
     comment = m.TextField(_("comment"), blank=True)
 
@@ -104,12 +105,16 @@ class Material(WeChatModel):
         verbose_name_plural = _("materials")
 
         unique_together = (("app", "media_id"), ("app", "alias"))
+        index_together = (("app", "content_hash"),)
         ordering = ("app", "-update_time")
 
     @classmethod
     @appmethod("sync_materials")
-    def sync(cls, app, id=None, type=None):
-        """同步所有永久素材"""
+    def sync(cls, app, id=None, type=None, incremental=False, workers=8):
+        """同步所有永久素材
+
+        :param incremental: 增量同步,参见sync_type
+        """
         if id:
             if type not in (cls.Type.NEWS, cls.Type.VIDEO):
                 raise NotImplementedError()
@@ -120,22 +125,96 @@ class Material(WeChatModel):
             updated = []
             for type, _ in enum2choices(cls.Type):
                 with transaction.atomic():
-                    updates = cls.sync_type(app, type)
+                    updates = cls.sync_type(
+                        app, type, incremental, workers)
                     updated.extend(updates)
             return updated
 
     @classmethod
     @appmethod("sync_type_materials")
-    def sync_type(cls, app, type):
-        """同步某种类型的永久素材"""
-        updates = cls.get_all_materials(app, type)
-        # 删除被删除的 更新或新增获取的
-        (app.materials.filter(type=type)
-            .exclude(media_id__in=map(lambda o: o["media_id"], updates))
-            .delete())
-        return [
-            app.materials.create_material(type=type, **item)
-            for item in updates]
+    def sync_type(cls, app, type, incremental=False, workers=8):
+        """同步某种类型的永久素材 逐页写入数据库
+
+        :param incremental: 增量同步,仅拉取update_time不早于本地最新素材的
+                            素材,翻页至更早的素材即停止.增量同步不会删除
+                            微信上已删除的素材,需定期全量同步
+        :param workers: 全量同步时并发拉取的最大并发数
+        """
+        since = None
+        if incremental:
+            since = (app.materials.filter(type=type)
+                .aggregate(m.Max("update_time"))["update_time__max"])
+        rv = []
+        media_ids = set()
+        # 更新或新增获取的
+        for items in cls.iter_materials(app, type, since, workers):
+            media_ids.update(item["media_id"] for item in items)
+            rv.extend(cls.upsert(app, type, items))
+        if since is None:
+            # 删除被删除的
+            (app.materials.filter(type=type)
+                .exclude(media_id__in=media_ids)
+                .delete())
+        return rv
+
+    @classmethod
+    def upsert(cls, app, type, items, chunk_size=100):
+        """批量新增或更新素材 未变化的素材及图文不写入
+
+        :param items: batchget返回的素材
+        :returns: 对应的Material
+        """
+        rv = []
+        for chunk in next_chunk(iter(items), chunk_size):
+            rv.extend(cls._upsert_chunk(app, type, chunk))
+        return rv
+
+    @classmethod
+    def _upsert_chunk(cls, app, type, items):
+        from . import Article
+
+        existed = {
+            o.media_id: o for o in app.materials.filter(
+                type=type, media_id__in=[item["media_id"] for item in items])
+        }
+        fields = ("name", "url", "update_time")
+        created = []
+        news = []
+        for item in items:
+            material = existed.get(item["media_id"])
+            if type == cls.Type.VIDEO and "url" not in item:
+                if material and\
+                    material.update_time == item.get("update_time"):
+                    # 视频未更新时不再查询下载地址
+                    item["url"] = material.url
+                else:
+                    data = app.client.material.get(item["media_id"])
+                    item["url"] = data.get("down_url")
+            if not material:
+                material = cls(app=app, type=type, media_id=item["media_id"])
+                created.append(material)
+            changed = [
+                field for field in fields
+                if field in item and getattr(material, field) != item[field]]
+            for field in changed:
+                setattr(material, field, item[field])
+            if material.pk and changed:
+                material.save(update_fields=changed + ["updated_at"])
+            if type == cls.Type.NEWS:
+                news.append((material, item))
+        if created:
+            cls.objects.bulk_create(created)
+            # 部分数据库bulk_create后拿不到主键
+            existed.update({
+                o.media_id: o for o in app.materials.filter(
+                    type=type,
+                    media_id__in=[o.media_id for o in created])
+            })
+        if news:
+            Article.upsert(
+                (existed[material.media_id], item["content"]["news_item"])
+                for material, item in news)
+        return [existed[item["media_id"]] for item in items]
 
     @classmethod
     @appmethod("migrate_type_materials")
@@ -144,61 +223,115 @@ class Material(WeChatModel):
         raise NotImplementedError()
 
     @classmethod
-    def get_all_materials(cls, app, type):
+    def get_all_materials(cls, app, type, since=None, workers=8):
+        """拉取某种类型的全部永久素材 参见iter_materials"""
+        return [
+            item
+            for items in cls.iter_materials(app, type, since, workers)
+            for item in items]
+
+    @classmethod
+    def iter_materials(cls, app, type, since=None, workers=8):
+        """按页产出某种类型的永久素材
+
+        首页返回total_count后,其余页以有限线程池并发拉取,按顺序产出
+
+        :param since: 仅拉取update_time不早于该值的素材,微信按更新时间
+                      倒序返回素材,遇到更早的素材即停止翻页,此时顺序翻页
+        :param workers: 最大并发数
+        """
         count = 20
-        offset = 0
-        rv = []
-        while True:
-            data = app.client.material.batchget(
+
+        def fetch(offset):
+            return app.client.material.batchget(
                 media_type=type,
                 offset=offset,
                 count=count
             )
-            rv.extend(data["item"])
+
+        data = fetch(0)
+        if since is None:
+            yield data["item"]
+            offsets = range(count, data["total_count"], count)
+            for data in concurrent_map(fetch, offsets, workers):
+                yield data["item"]
+            return
+
+        offset = 0
+        while True:
+            items = data["item"]
+            yield [
+                item for item in items
+                if (item.get("update_time") or 0) >= since]
+            if any((item.get("update_time") or 0) < since
+                   for item in items):
+                break
             if data["total_count"] <= offset + count:
                 break
             offset += count
-        return rv
+            data = fetch(offset)
 
     @classmethod
     def as_permenant(cls, media_id, app, save=True):
-        """将临时素材转换为永久素材"""
-        # 下载临时素材
-        resp = app.client.media.download(media_id)
+        """将临时素材转换为永久素材
 
-        try:
-            content_type = resp.headers["Content-Type"]
-        except:
-            raise ValueError("missing Content-Type")
-        if content_type.startswith("image"):
-            type = cls.Type.IMAGE
-        elif content_type.startswith("video"):
-            type = cls.Type.VIDEO
-        elif content_type.startswith("audio"):
-            type = cls.Type.VOICE
-        else:
-            raise ValueError("unknown Content-Type")
+        临时素材流式下载至临时文件后上传,按内容sha1去重,
+        内容相同的素材只上传一次,转换后的永久素材总会记录在数据库中
 
-        # 找文件名
+        :param save: 为True时返回Material,否则返回永久素材的media_id
+        """
+        # 下载临时素材
+        resp = app.client.media.download_stream(media_id)
         try:
-            disposition = resp.headers["Content-Disposition"]
-            filename = re.findall(r'filename="(.+?)"', disposition)[0]
-        except:
-            # 默认文件名
-            ext = mimetypes.guess_extension(content_type)
-            filename = (media_id + ext) if ext else media_id
-
-        # 上载素材
-        return cls.upload_permenant(app, (filename, resp.content), type, save)
+            try:
+                content_type = resp.headers["Content-Type"]
+            except:
+                raise ValueError("missing Content-Type")
+            if content_type.startswith("image"):
+                type = cls.Type.IMAGE
+            elif content_type.startswith("video"):
+                type = cls.Type.VIDEO
+            elif content_type.startswith("audio"):
+                type = cls.Type.VOICE
+            else:
+                raise ValueError("unknown Content-Type")
+
+            # 找文件名
+            try:
+                disposition = resp.headers["Content-Disposition"]
+                filename = re.findall(r'filename="(.+?)"', disposition)[0]
+            except:
+                # 默认文件名
+                ext = mimetypes.guess_extension(content_type)
+                filename = (media_id + ext) if ext else media_id
+
+            with tempfile.SpooledTemporaryFile(cls.SPOOL_SIZE) as file:
+                digest = sha1()
+                for chunk in resp.iter_content(cls.CHUNK_SIZE):
+                    digest.update(chunk)
+                    file.write(chunk)
+                content_hash = digest.hexdigest()
+
+                material = app.materials.filter(
+                    type=type, content_hash=content_hash).first()
+                if not material:
+                    # 上载素材
+                    file.seek(0)
+                    material = cls.upload_permenant(
+                        app, (filename, file), type,
+                        content_hash=content_hash)
+        finally:
+            resp.close()
+        return material if save else material.media_id
 
     @classmethod
-    def upload_permenant(cls, app, file, type, save=True):
+    def upload_permenant(cls, app, file, type, save=True, **kwargs):
         """上传永久素材"""
         data = app.client.material.add(type, file)
         media_id = data["media_id"]
         if save:
             return app.materials.create_material(
-                type=type, media_id=media_id, url=data.get("url"))
+                type=type, media_id=media_id, url=data.get("url"), **kwargs)
         else:
             return media_id
 
@@ -211,12 +344,18 @@ class Material(WeChatModel):
 
     @property
     def articles_json(self):
+        from . import Article
+
+        articles = list(self.articles.all())
+        for article in articles:
+            article.material = self
+        Article.fill_thumb_urls(articles)
         return list(map(lambda o: dict(
             title=o.title,
             description=o.digest,
-            image=o.thumb_url,
+            image=o._thumb_url,
             url=o.url
-        ), self.articles.all()))
+        ), articles))
 
     def save(self, *args, **kwargs):
         self.alias = self.alias or None
@@ -5,9 +5,12 @@ from hashlib import md5
 import json
 
 from django.db import models as m, transaction
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from jsonfield import JSONField
+from wechatpy.exceptions import WeChatClientException
 
+from ..utils.func import concurrent_map
 from ..utils.model import enum2choices
 from . import appmethod, MessageHandler, WeChatApp, WeChatModel
 
@@ -40,6 +43,9 @@ class Menu(WeChatModel):
     parent = m.ForeignKey(
         "Menu", related_name="sub_button", null=True, blank=True,
         on_delete=m.CASCADE)
+    conditional = m.ForeignKey(
+        "ConditionalMenu", related_name="menus", null=True, blank=True,
+        on_delete=m.CASCADE, editable=False)
     type = m.CharField(
         _("type"), max_length=20, choices=enum2choices(Event),
         null=True, blank=True)
@@ -72,7 +78,7 @@ class Menu(WeChatModel):
 
         with transaction.atomic():
             # 旧menu
-            app.menus.all().delete()
+            app.menus.filter(conditional__isnull=True).delete()
             # 移除同步菜单产生的message handler
             app.message_handlers.filter(
                 src=MessageHandler.Source.MENU).delete()
@@ -83,12 +89,15 @@ class Menu(WeChatModel):
 
     @classmethod
     @appmethod("publish_menus")
-    def publish(cls, app, menuid=None):
+    def publish(cls, app, menuid=None, force=False):
         """
-        发布菜单
+        发布菜单 由数据库生成的菜单与上次发布时一致且未指定force时不调用接口
         :type app: wechat_django.models.WeChatApp
+        :returns: 接口返回,未发布时返回None
         """
         data = cls.menus2json(app, menuid)
+        if not force and app.ext_info.get("current_menus") == data:
+            return None
         rv = app.client.menu.create(data)
         app.ext_info["current_menus"] = data
         app.save()
@@ -97,12 +106,13 @@ class Menu(WeChatModel):
     @classmethod
     def get_menus(cls, app, menuid=None):
         """获取数据库中公众号菜单配置"""
-        q = app.menus.filter(parent_id__isnull=True)
+        q = app.menus.filter(parent_id__isnull=True, conditional__isnull=True)
         q = q.filter(menuid=menuid) if menuid else q.filter(menuid__isnull=True)
         return list(q.all())
 
     @classmethod
     def menus2json(cls, app, menuid=None):
+        """菜单配置的json"""
         menus = cls.get_menus(app, menuid)
         return dict(button=[menu.to_json() for menu in menus])
 
@@ -147,3 +157,122 @@ class Menu(WeChatModel):
 
     def __str__(self):
         return "{0}".format(self.name)
+
+
+class ConditionalMenu(WeChatModel):
+    """个性化菜单 根菜单为conditional指向本对象的Menu"""
+    ERRCODE_MENU_NOT_EXISTS = 65301
+
+    app = m.ForeignKey(
+        WeChatApp, related_name="conditional_menus", on_delete=m.CASCADE)
+    title = m.CharField(_("title"), max_length=32)
+    matchrule = JSONField(
+        _("matchrule"), default=dict,
+        help_text=_("tag_id,sex,country,province,city,client_platform_type"
+                    "及language的组合"))
+    menuid = m.CharField(
+        _("menuid"), max_length=32, null=True, editable=False)
+    published = JSONField(null=True, editable=False)
+
+    created_at = m.DateTimeField(_("created at"), auto_now_add=True)
+    updated_at = m.DateTimeField(_("updated at"), auto_now=True)
+
+    class Meta(object):
+        verbose_name = _("conditional menu")
+        verbose_name_plural = _("conditional menus")
+
+    @classmethod
+    @appmethod("publish_conditional_menus")
+    def publish_many(cls, app, menus=None, force=False, workers=8):
+        """并发发布个性化菜单 与上次发布内容一致的菜单不调用接口
+
+        个性化菜单无法修改,已发布过的菜单会先创建新菜单再删除旧菜单,
+        微信按创建时间倒序匹配个性化菜单,发布期间用户不会退回默认菜单;
+        并发发布时不保证创建顺序,
+        若各菜单匹配规则存在重叠,请以workers=1按需要的顺序传入menus
+
+        :type app: wechat_django.models.WeChatApp
+        :param menus: 待发布的个性化菜单,默认该公众号全部个性化菜单
+        :returns: dict(published=发布数, skipped=未变化数, failed=失败数)
+        """
+        if menus is None:
+            menus = app.conditional_menus.order_by("id")
+        rv = dict(published=0, skipped=0, failed=0)
+
+        def prepare(menus):
+            # 在调用方线程生成菜单json 工作线程仅发起请求
+            for menu in menus:
+                menu.app = app
+                data = menu.menus2json()
+                if not force and menu.menuid and menu.published == data:
+                    rv["skipped"] += 1
+                    continue
+                yield menu, data
+
+        def publish(item):
+            menu, data = item
+            try:
+                result = app.client.menu.add_conditional(data)
+            except Exception as e:
+                # 单个菜单发布异常不中断整批发布
+                return menu, data, None, e
+            # 新菜单创建成功后再删除旧菜单 创建失败时旧菜单仍然有效
+            try:
+                menu.unpublish()
+            except Exception as e:
+                app.logger("menu").warning(
+                    "delete conditional menu %s failed: %s", menu.menuid, e)
+            return menu, data, result, None
+
+        for menu, data, result, exc in concurrent_map(
+            publish, prepare(menus), workers):
+            if exc:
+                app.logger("menu").warning(
+                    "publish conditional menu %s failed: %s", menu.pk, exc)
+                rv["failed"] += 1
+                continue
+            menu.menuid = str(result["menuid"])
+            menu.published = data
+            cls.objects.filter(pk=menu.pk).update(
+                menuid=menu.menuid, published=data)
+            rv["published"] += 1
+        return rv
+
+    def menus2json(self):
+        """个性化菜单的json"""
+        menus = (Menu.objects.filter(conditional=self)
+                 .filter(parent_id__isnull=True))
+        return dict(
+            button=[menu.to_json() for menu in menus],
+            matchrule=self.matchrule)
+
+    def publish(self, force=False):
+        """发布本个性化菜单"""
+        return self.publish_many(self.app, [self], force, workers=1)
+
+    def unpublish(self):
+        """删除微信上的本个性化菜单"""
+        if not self.menuid:
+            return
+        try:
+            self.app.client.menu.del_conditional(self.menuid)
+        except WeChatClientException as e:
+            if e.errcode != self.ERRCODE_MENU_NOT_EXISTS:
+                raise
+
+    def __str__(self):
+        return "{0}".format(self.title)
+
+
+@receiver(m.signals.pre_delete, sender=ConditionalMenu)
+def on_conditional_menu_delete(sender, instance, *args, **kwargs):
+    """删除个性化菜单(含批量删除及随公众号级联删除)前尝试删除微信上的菜单
+
+    远程删除失败时仅记录日志,不阻止本地删除
+    """
+    try:
+        instance.unpublish()
+    except Exception as e:
+        instance.app.logger("menu").warning(
+            "delete conditional menu %s failed: %s", instance.menuid, e,
+            exc_info=True)
@@ -1,14 +1,88 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import gzip
+import json
+import os
+
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models as m
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from jsonfield import JSONField
+import six
 from wechatpy.events import BaseEvent
 
-from ..utils.model import enum2choices
-from . import Rule, WeChatApp, WeChatModel, WeChatUser
+from ..utils.model import enum2choices, month_bucket
+from . import appmethod, Rule, WeChatApp, WeChatModel, WeChatUser
+
+
+class MonthBucketField(m.PositiveIntegerField):
+    """保存时由date_field所在月份生成的分区号,如201906
+    date_field须先于本字段声明
+    """
+    def __init__(self, *args, **kwargs):
+        self.date_field = kwargs.pop("date_field", "created_at")
+        kwargs.setdefault("default", 0)
+        kwargs.setdefault("editable", False)
+        super(MonthBucketField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(
+            MonthBucketField, self).deconstruct()
+        kwargs["date_field"] = self.date_field
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.date_field)
+        value = month_bucket(value) if value else 0
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+class MessageLogQuerySet(m.QuerySet):
+    def between(self, start=None, end=None):
+        """限定时间范围[start, end),同时限定按月分区,仅查询相关分区"""
+        qs = self
+        if start:
+            qs = qs.filter(
+                created_at__gte=start, bucket__gte=month_bucket(start))
+        if end:
+            qs = qs.filter(created_at__lt=end, bucket__lte=month_bucket(end))
+        return qs
+
+    def search(self, keyword):
+        """经配置的搜索后端检索消息文本"""
+        from ..search import get_search_backend
+        return self.filter(get_search_backend().q(keyword))
+
+    def buckets(self):
+        """存在日志的分区号,由新到旧"""
+        return self.order_by("-bucket").values_list(
+            "bucket", flat=True).distinct()
+
+    def calendar_buckets(self):
+        """最早日志所在月至当前月的分区号,由新到旧
+
+        仅需一次可走索引的MIN聚合,避免DISTINCT扫描全部日志,
+        结果可能包含没有日志的月份
+        """
+        earliest = self.aggregate(
+            earliest=m.Min("created_at"))["earliest"]
+        if not earliest:
+            return []
+        rv = []
+        bucket = month_bucket(timezone.now())
+        first = month_bucket(earliest)
+        while bucket >= first:
+            rv.append(bucket)
+            # 一月的上一个月为上一年十二月
+            bucket -= 89 if bucket % 100 == 1 else 1
+        return rv
+
+
+class MessageLogManager(m.Manager.from_queryset(MessageLogQuerySet)):
+    pass
 
 
 class MessageLog(WeChatModel):
@@ -24,19 +98,126 @@ class MessageLog(WeChatModel):
         _("message type"), max_length=24,
         choices=enum2choices(Rule.ReceiveMsgType))
     content = JSONField(_("content"))
+    # 由content提取的消息文本 供搜索使用
+    text = m.TextField(_("text"), null=True, blank=True)
     direct = m.BooleanField(_("direct"), default=Direct.USER2APP)
 
     raw = m.TextField(null=True, blank=True, default=None)
 
     created_at = m.DateTimeField(_("created at"), auto_now_add=True)
+    bucket = MonthBucketField(_("bucket"), date_field="created_at")
+
+    objects = MessageLogManager()
 
     class Meta(object):
         verbose_name = _("message log")
         verbose_name_plural = _("message logs")
 
-        index_together = (("app", "created_at"),)
+        index_together = (("app", "created_at"), ("app", "bucket"))
         ordering = ("app", "-created_at")
 
+
+    @classmethod
+    @appmethod("active_users")
+    def active_users(cls, app, hours=48):
+        """
+        最近hours小时内向公众号发送过消息的用户,即可接收客服消息的用户
+        依据消息日志查询,请确保已开启消息日志
+        :type app: wechat_django.models.WeChatApp
+        :rtype: django.db.models.QuerySet
+        """
+        since = timezone.now() - timezone.timedelta(hours=hours)
+        # 限定分区 由数据库完成子查询
+        user_ids = cls.objects.filter(
+            app=app, direct=cls.Direct.USER2APP
+        ).between(since).values("user_id")
+        return app.users.filter(id__in=user_ids)
+
+    @classmethod
+    @appmethod("archive_messagelogs")
+    def archive(cls, app, before, path, chunk_size=1000):
+        """将before所在月份之前的消息日志按月归档为gzip压缩的json lines
+        文件并从数据库删除
+
+        每次归档写入单独的文件,文件名包含该次归档的主键范围,如
+        messagelog-<appname>-201906-<首条id>-<末条id>.jsonl.gz,
+        写入后中断的归档再次执行时不会重复写入
+
+        :type app: wechat_django.models.WeChatApp
+        :param before: 保留该时间所在月份及之后的日志
+        :param path: 归档目录
+        :returns: {分区号: 本次归档条数}
+        """
+        buckets = cls.objects.filter(
+            app=app, bucket__lt=month_bucket(before)).buckets()
+        return {
+            bucket: cls._archive_bucket(app, bucket, path, chunk_size)
+            for bucket in list(buckets)
+        }
+
+    @classmethod
+    def _archived_pk(cls, app, bucket, path):
+        """分区已归档的最大主键 由归档文件名得出"""
+        prefix = "messagelog-{0}-{1}-".format(app.name, bucket)
+        suffix = ".jsonl.gz"
+        rv = 0
+        for name in os.listdir(path):
+            if name.startswith(prefix) and name.endswith(suffix):
+                pk_range = name[len(prefix):-len(suffix)].split("-")
+                if len(pk_range) == 2 and pk_range[1].isdigit():
+                    rv = max(rv, int(pk_range[1]))
+        return rv
+
+    @classmethod
+    def _archive_bucket(cls, app, bucket, path, chunk_size):
+        from ..search import get_search_backend
+
+        logs = cls.objects.filter(app=app, bucket=bucket).order_by("pk")
+        fields = ("id", "user_id", "user__openid", "msg_id", "type",
+                  "content", "direct", "raw", "created_at")
+
+        def delete(last):
+            # 归档写入完成后再分批删除
+            while True:
+                pks = list(logs.filter(pk__lte=last).values_list(
+                    "pk", flat=True)[:chunk_size])
+                if not pks:
+                    break
+                cls.objects.filter(pk__in=pks).delete()
+                get_search_backend().remove(pks)
+
+        # 先删除上次已写入归档但未删除的日志
+        archived = cls._archived_pk(app, bucket, path)
+        archived and delete(archived)
+
+        tmp = os.path.join(path, "messagelog-{0}-{1}.jsonl.gz.tmp".format(
+            app.name, bucket))
+        count = first = 0
+        last = archived
+        with gzip.open(tmp, "wb") as f:
+            while True:
+                rows = list(logs.filter(pk__gt=last).values(
+                    *fields)[:chunk_size])
+                if not rows:
+                    break
+                for row in rows:
+                    line = json.dumps(
+                        row, cls=DjangoJSONEncoder, ensure_ascii=False)
+                    f.write((line + "\n").encode("utf-8"))
+                count += len(rows)
+                first = first or rows[0]["id"]
+                last = rows[-1]["id"]
+        if not count:
+            os.remove(tmp)
+            return 0
+
+        # 写入完成后再以主键范围命名 文件名即为归档进度
+        os.rename(tmp, os.path.join(
+            path, "messagelog-{0}-{1}-{2}-{3}.jsonl.gz".format(
+                app.name, bucket, first, last)))
+        delete(last)
+        return count
+
     @classmethod
     def from_message_info(cls, message_info):
         """
@@ -72,7 +253,7 @@ class MessageLog(WeChatModel):
         if message.time:
             kwargs["created_at"] = timezone.datetime.fromtimestamp(
                 message.time)
-        return cls.objects.create(**kwargs)
+        return cls._create(**kwargs)
 
     @classmethod
     def from_reply(cls, reply, app, user):
@@ -94,7 +275,54 @@ class MessageLog(WeChatModel):
         if reply.time:
             kwargs["created_at"] = timezone.datetime.fromtimestamp(
                 reply.time)
-        return cls.objects.create(**kwargs)
+        return cls._create(**kwargs)
+
+    TEXT_FIELDS = ("content", "recognition", "title", "description", "label")
+
+    @classmethod
+    def extract_text(cls, content):
+        """提取消息内容中可供搜索的文本"""
+        texts = [
+            content[key] for key in cls.TEXT_FIELDS
+            if isinstance(content.get(key), six.string_types)
+            and content[key]
+        ]
+        return "\n".join(texts) or None
+
+    @classmethod
+    def _create(cls, **kwargs):
+        from ..search import get_search_backend
+
+        kwargs["text"] = cls.extract_text(kwargs["content"])
+        rv = cls.objects.create(**kwargs)
+        get_search_backend().index([rv])
+        return rv
+
+    @classmethod
+    def reindex(cls, queryset=None, chunk_size=1000):
+        """为已有日志提取文本并建立索引
+
+        :returns: 处理的日志数
+        """
+        from ..search import get_search_backend
+
+        backend = get_search_backend()
+        queryset = (cls.objects.all() if queryset is None else queryset)\
+            .order_by("pk")
+        count = last = 0
+        while True:
+            logs = list(queryset.filter(pk__gt=last)[:chunk_size])
+            if not logs:
+                break
+            for log in logs:
+                text = cls.extract_text(log.content or {})
+                if text != log.text:
+                    log.text = text
+                    cls.objects.filter(pk=log.pk).update(text=text)
+            backend.index(logs)
+            count += len(logs)
+            last = logs[-1].pk
+        return count
 
     def __str__(self):
         return _("%(type)s消息: %(msg_id)s") % dict(
@@ -12,17 +12,31 @@ from __future__ import unicode_literals
 
 from collections import defaultdict
 import re
+import uuid
 
 from django.contrib.auth.models import Group, Permission, User
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.db import models as m, transaction
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
+import six
 
+from .. import settings
+from ..utils.func import next_chunk
 from . import WeChatApp
 
 WECHATPERM_PREFIX = "app|"
 
+PERM_PATTERN = re.compile(
+    r"(?:{label}[.])?{prefix}(?P<appname>.+?)(?:[|](?P<permission>.+))?$"
+    .format(label="wechat_django", prefix=re.escape(WECHATPERM_PREFIX)))
+
+PERMS_CACHE_KEY = "wechat_django:perms:{0}"
+PERMS_VERSION_KEY = "wechat_django:perms:version"
+
 permissions = {
     "manage": _("Can manage %(appname)s"),
     "article": _("Can edit %(appname)s articles"),
@@ -138,15 +152,7 @@ def get_perms_by_codenames(codenames):
 def create_app_perms(sender, instance, created, *args, **kwargs):
     if created:
         # 添加
-        content_type = ContentType.objects.get_for_model(WeChatApp)
-        Permission.objects.bulk_create(
-            Permission(
-                codename=perm_name,
-                name=get_perm_desc(perm_name, instance),
-                content_type=content_type
-            )
-            for perm_name in list_perm_names(instance)
-        )
+        sync_perms([instance])
 
 
 @receiver(m.signals.post_delete, sender=WeChatApp)
@@ -156,6 +162,7 @@ def delete_app_perms(sender, instance, *args, **kwargs):
         content_type=content_type,
         codename__in=list_perm_names(instance)
     ).delete()
+    expire_permissions()
 
 
 @receiver(m.signals.m2m_changed, sender=Group.permissions.through)
@@ -193,7 +200,53 @@ def get_user_permissions(user, app=None, exclude_sub=False, exclude_manage=False
             if permission.find("_") != -1
         )
 
-    perm_names = user.get_all_permissions()
+    perms_map = get_permissions_map(user)
+    if app:
+        return perms_map.get(app.name, set()).difference(excludes)
+    return {
+        appname: app_permissions.difference(excludes)
+        for appname, app_permissions in perms_map.items()
+    }
+
+
+def get_permissions_map(user):
+    """用户的{appname: set(permission)}映射
+
+    结果缓存在user对象上(即单次请求内),配置共享cache时另在django缓存中
+    保存WECHAT_PERMISSIONCACHETIMEOUT秒,用户,组或权限变动时失效
+    """
+    rv = getattr(user, "_wechat_perms_cache", None)
+    if rv is not None:
+        return rv
+
+    key = user.pk and use_shared_cache() and PERMS_CACHE_KEY.format(user.pk)
+    if key:
+        cached = cache.get_many([key, PERMS_VERSION_KEY])
+        version = cached.get(PERMS_VERSION_KEY)
+        if cached.get(key) and version and cached[key][0] == version:
+            rv = cached[key][1]
+    if rv is None:
+        rv = build_permissions_map(user.get_all_permissions())
+        if key:
+            if not version:
+                version = expire_permissions()
+            cache.set(key, (version, rv), settings.PERMISSIONCACHETIMEOUT)
+
+    user._wechat_perms_cache = rv
+    return rv
+
+
+def use_shared_cache():
+    """是否跨请求缓存用户权限
+
+    本地内存缓存无法在其他进程中失效,会使已撤销的权限在其他worker中
+    继续生效,故仅在默认cache为共享缓存时启用
+    """
+    return bool(settings.PERMISSIONCACHETIMEOUT) and not isinstance(
+        caches["default"], (DummyCache, LocMemCache))
+
+
+def build_permissions_map(perm_names):
     rv = defaultdict(set)
     for perm_name in perm_names:
         appname, permission = match_permission(perm_name)
@@ -203,51 +256,127 @@ def get_user_permissions(user, app=None, exclude_sub=False, exclude_manage=False
             else:
                 # 所有权限
                 rv[appname] = set(permissions.keys())
+    return dict(rv)
+
+
+def expire_permissions(user=None):
+    """使缓存的用户权限失效 不传入user时使所有用户的缓存失效"""
+    if user is not None:
+        cache.delete(PERMS_CACHE_KEY.format(user.pk))
+        user.__dict__.pop("_wechat_perms_cache", None)
+        return
+    version = uuid.uuid4().hex
+    cache.set(PERMS_VERSION_KEY, version, None)
+    return version
+
+
+@receiver(m.signals.m2m_changed, sender=User.user_permissions.through)
+@receiver(m.signals.m2m_changed, sender=User.groups.through)
+def on_user_perms_changed(sender, instance, action, reverse, pk_set,
+                          *args, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        expire_permissions(instance)
+    elif pk_set:
+        for pk in pk_set:
+            cache.delete(PERMS_CACHE_KEY.format(pk))
+    else:
+        expire_permissions()
 
-    for appname in rv:
-        rv[appname].difference_update(excludes)
 
-    return rv[app.name] if app else dict(rv.items())
+@receiver(m.signals.m2m_changed, sender=Group.permissions.through)
+def on_group_perms_changed(sender, action, *args, **kwargs):
+    if action.startswith("post_"):
+        expire_permissions()
+
+
+@receiver(m.signals.post_save, sender=User)
+@receiver(m.signals.post_delete, sender=User)
+def on_user_changed(sender, instance, *args, **kwargs):
+    # is_superuser及is_active会影响用户权限
+    expire_permissions(instance)
+
+
+@receiver(m.signals.post_delete, sender=Group)
+@receiver(m.signals.post_save, sender=Permission)
+@receiver(m.signals.post_delete, sender=Permission)
+def on_perms_changed(sender, *args, **kwargs):
+    expire_permissions()
 
 
 def match_permission(perm_name):
     """从permission的codename中拿到appname与权限名"""
-    str4format = r"(?:{label}[.])?{prefix}(?P<appname>.+?)(?:|(?P<permission>.+))?$"
-    pattern = str4format.format(
-        label="wechat_django",
-        prefix=WECHATPERM_PREFIX
-    ).replace("|", "[|]")
-    match = re.match(pattern, perm_name)
+    match = PERM_PATTERN.match(perm_name)
     if match:
         return match.group("appname"), match.group("permission")
     else:
         return None, None
 
 
+def sync_perms(apps=None, permissions=None):
+    """批量补全公众号权限 缺失的权限一次写入,名称有变化的一次更新
+
+    :param apps: 公众号,默认所有公众号
+    :param permissions: 权限名,默认全部权限(包括公众号的完全控制权限)
+    :returns: (新增数, 更新数)
+    """
+    if apps is None:
+        apps = WeChatApp.objects.all()
+    expected = dict()
+    for app in apps:
+        perm_names = (get_perm_names(app, permissions) if permissions
+            else list_perm_names(app))
+        for perm_name in perm_names:
+            expected[perm_name] = six.text_type(get_perm_desc(perm_name, app))
+    if not expected:
+        return 0, 0
+
+    content_type = ContentType.objects.get_for_model(WeChatApp)
+    existed = dict()
+    renamed = dict()
+    # 仅查询所需的权限 避免随公众号数量增长 分批以免超出参数上限
+    for codenames in next_chunk(iter(expected), 500):
+        for id, codename, name in (Permission.objects
+                .filter(content_type=content_type, codename__in=codenames)
+                .order_by()
+                .values_list("id", "codename", "name")):
+            existed[codename] = id
+            if expected[codename] != name:
+                renamed[id] = expected[codename]
+
+    creates = [
+        Permission(codename=codename, name=name, content_type=content_type)
+        for codename, name in expected.items()
+        if codename not in existed
+    ]
+    if not creates and not renamed:
+        return 0, 0
+
+    with transaction.atomic():
+        Permission.objects.bulk_create(creates)
+        if renamed:
+            Permission.objects.filter(id__in=renamed.keys()).update(
+                name=m.Case(*[
+                    m.When(id=id, then=m.Value(name))
+                    for id, name in renamed.items()
+                ]))
+    expire_permissions()
+    return len(creates), len(renamed)
+
+
 def upgrade_perms(permissions):
     """迁移时新增权限"""
-    with transaction.atomic():
-        content_type = ContentType.objects.get_for_model(WeChatApp)
-        apps = WeChatApp.objects.all()
-        for app in apps:
-            for perm_name in get_perm_names(app, permissions):
-                query = dict(
-                    codename=perm_name,
-                    content_type=content_type
-                )
-                defaults = query.copy()
-                defaults.update(dict(name=get_perm_desc(perm_name, app)))
-                Permission.objects.update_or_create(
-                    defaults=defaults, **query)
+    sync_perms(permissions=permissions)
 
 
 def downgrade_perms(permissions):
     """降级时移除新增的权限"""
-    with transaction.atomic():
-        content_type = ContentType.objects.get_for_model(WeChatApp)
-        apps = WeChatApp.objects.all()
-        for app in apps:
-            Permission.objects.filter(
-                content_type=content_type,
-                codename__in=get_perm_names(app, permissions)
-            ).delete()
+    content_type = ContentType.objects.get_for_model(WeChatApp)
+    codenames = [
+        perm_name
+        for app in WeChatApp.objects.all()
+        for perm_name in get_perm_names(app, permissions)
+    ]
+    Permission.objects.filter(
+        content_type=content_type, codename__in=codenames).delete()
@@ -10,11 +10,14 @@ from jsonfield import JSONField
 import requests
 from six import text_type
 from wechatpy import replies
+from wechatpy.exceptions import WeChatClientException
 
 from ..exceptions import MessageHandleError
+from ..utils.func import concurrent_map, RateLimiter
 from ..utils.model import enum2choices, model_fields
 from . import (
-    Article, Material, MessageHandler, MsgType as BaseMsgType, WeChatModel)
+    Article, Material, MessageHandler, MsgType as BaseMsgType, WeChatModel,
+    WeChatUser)
 
 
 class Reply(WeChatModel):
@@ -69,6 +72,43 @@ class Reply(WeChatModel):
         func = funcname and getattr(self.app.client.message, funcname)
         return func and func(**kwargs)
 
+    def broadcast(self, users, workers=8, rate=None, chunk_size=100):
+        """
+        以客服消息向多个用户主动发送本回复,回复内容只生成一次
+        :param users: 用户queryset,或用户对象/openid的可迭代对象,
+                      可使用MessageLog.active_users筛选可接收客服消息的用户
+        :param workers: 最大并发数
+        :param rate: 每秒最多发送条数,不填不限制
+        :returns: dict(sent=成功数, failed=失败数, errors={openid: errcode})
+        """
+        if self.type in (self.MsgType.FORWARD, self.MsgType.CUSTOM):
+            raise MessageHandleError(
+                "cannot broadcast a {0} reply".format(self.type))
+        funcname, kwargs = self.reply2send(self.normal_reply(None))
+        func = getattr(self.app.client.message, funcname)
+        limiter = RateLimiter(rate)
+        if isinstance(users, m.QuerySet):
+            users = users.iterator()
+
+        def send(user):
+            openid = user.openid if isinstance(user, WeChatUser) else user
+            limiter.acquire()
+            try:
+                func(**dict(kwargs, user_id=openid))
+            except WeChatClientException as e:
+                return openid, e.errcode or -1
+            return openid, 0
+
+        rv = dict(sent=0, failed=0, errors=dict())
+        for openid, errcode in concurrent_map(
+            send, users, workers, chunk_size):
+            if errcode:
+                rv["failed"] += 1
+                rv["errors"][openid] = errcode
+            else:
+                rv["sent"] += 1
+        return rv
+
     def reply(self, message_info):
         """被动回复
         :type message_info: wechat_django.models.WeChatMessageInfo
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
+from uuid import uuid4
+
 from django.db import models as m, transaction
 from django.utils.translation import ugettext_lazy as _
+import six
+from wechatpy.exceptions import WeChatClientException
 
 from ..exceptions import WeChatAbilityError
+from ..utils.func import concurrent_map, next_chunk, RateLimiter
 from ..utils.model import model_fields
 from . import appmethod, WeChatApp, WeChatModel
 
@@ -83,9 +89,7 @@ class Template(WeChatModel):
         :param emphasis_keyword: 模板需要放大的关键词，不填则默认无放大
         :param kwargs: 接口的data字段 可直接传字符串 当data未填写时 使用该字段
         """
-        from . import WeChatUser
-
-        openid = user.openid if isinstance(user, WeChatUser) else user
+        openid = self._get_openid(user)
         pagepath = pagepath or page
         if not data:
             data = {
@@ -101,6 +105,118 @@ class Template(WeChatModel):
         else:
             raise WeChatAbilityError(WeChatAbilityError.TEMPLATE)
 
+    def send_many(
+        self, users, data_fn=None, campaign=None, resume=True, workers=8,
+        rate=None, chunk_size=100, **kwargs):
+        """
+        批量发送模板消息,每个用户的发送结果记录于TemplateMessageLog
+        :param users: 用户queryset,或用户对象/openid的可迭代对象
+        :param data_fn: 接收用户(或openid),返回该用户data字段的dict,
+                        小程序可返回form_id
+        :param campaign: 批次标识,不填自动生成;中断后以相同批次标识重新调用
+                         即可续发
+        :param resume: 跳过本批次已成功发送的用户,并重发失败的用户
+        :param workers: 最大并发数
+        :param rate: 每秒最多发送条数,不填不限制
+        :param kwargs: 所有用户共用的参数,同compile
+        :returns: dict(campaign=批次标识, sent=成功数, failed=失败数,
+                       skipped=跳过数)
+        """
+        from . import TemplateMessageLog
+
+        campaign = campaign or uuid4().hex
+        rv = dict(campaign=campaign, sent=0, failed=0, skipped=0)
+        if isinstance(users, m.QuerySet):
+            users = users.iterator()
+        limiter = RateLimiter(rate)
+        # 静态字段只序列化一次 在调用线程初始化client 各发送线程共用
+        compiled = self.compile(**kwargs)
+        self.app.client
+
+        def pending_users():
+            for chunk in next_chunk(users, chunk_size):
+                if resume:
+                    openids = [self._get_openid(user) for user in chunk]
+                    logs = self.logs.filter(
+                        campaign=campaign, openid__in=openids)
+                    sent = set(logs.filter(errcode=0)
+                        .values_list("openid", flat=True))
+                    logs.exclude(errcode=0).delete()
+                    rv["skipped"] += len(sent)
+                    chunk = [o for o in chunk
+                             if self._get_openid(o) not in sent]
+                for user in chunk:
+                    yield user
+
+        def send(user):
+            params = data_fn(user) if data_fn else dict()
+            limiter.acquire()
+            return self._send_log(user, campaign, compiled.send, params)[0]
+
+        logs = []
+        try:
+            for log in concurrent_map(send, pending_users(), workers,
+                                      chunk_size):
+                logs.append(log)
+                rv["sent" if log.success else "failed"] += 1
+                if len(logs) >= chunk_size:
+                    TemplateMessageLog.objects.bulk_create(logs)
+                    logs = []
+        finally:
+            # 即便发送中断,也记录已发送的结果以便续发
+            logs and TemplateMessageLog.objects.bulk_create(logs)
+        return rv
+
+    def compile(
+        self, data=None, url=None, appid=None, pagepath=None, page=None,
+        emphasis_keyword=None, **kwargs):
+        """
+        预编译模板消息,静态字段仅序列化一次,此后每次发送只需序列化
+        用户相关的字段.适用于大量发送仅少数字段不同的模板消息,参数同send
+
+            compiled = template.compile(url="url", remark="remark")
+            for user in users:
+                compiled.send(user, keyword1=user.nickname)
+
+        :rtype: wechat_django.models.template.CompiledTemplate
+        """
+        return CompiledTemplate(
+            self, data or kwargs, url=url, appid=appid,
+            pagepath=pagepath or page, emphasis_keyword=emphasis_keyword)
+
+    def send_with_log(self, user, campaign=None, **kwargs):
+        """
+        发送模板消息并将结果(msgid,errcode)记录于TemplateMessageLog,
+        以便接收TEMPLATESENDJOBFINISH事件后更新送达状态.参数同send
+        :rtype: wechat_django.models.TemplateMessageLog
+        """
+        log, exc = self._send_log(user, campaign, self.send, kwargs)
+        log.save()
+        if exc:
+            raise exc
+        return log
+
+    def _send_log(self, user, campaign, send, params):
+        """调用send发送并生成未保存的发送记录,微信接口异常时记录errcode"""
+        from . import TemplateMessageLog
+
+        log = TemplateMessageLog(
+            app_id=self.app_id, template=self, campaign=campaign,
+            openid=self._get_openid(user))
+        try:
+            resp = send(user, **params)
+        except WeChatClientException as e:
+            log.errcode = e.errcode or -1
+            log.errmsg = e.errmsg and e.errmsg[:256]
+            return log, e
+        log.msgid = (resp or {}).get("msgid")
+        return log, None
+
+    @staticmethod
+    def _get_openid(user):
+        from . import WeChatUser
+        return user.openid if isinstance(user, WeChatUser) else user
+
     def _send_service(
         self, openid, data, url=None, appid=None, pagepath=None):
         """发送服务号模板消息"""
@@ -140,3 +256,72 @@ class Template(WeChatModel):
     def __str__(self):
         return "{title} ({template_id})".format(
             title=self.title, template_id=self.template_id)
+
+
+class CompiledTemplate(object):
+    """预编译的模板消息,由Template.compile生成
+
+    请求体中除touser,form_id及用户相关的data字段外,其余部分均预先序列化
+    """
+
+    def __init__(
+        self, template, data=None, url=None, appid=None, pagepath=None,
+        emphasis_keyword=None):
+        """:type template: wechat_django.models.Template"""
+        app = template.app
+        payload = dict(template_id=template.template_id)
+        if app.type == WeChatApp.Type.SERVICEAPP:
+            self._endpoint = "message/template/send"
+            payload.update(url=url, miniprogram=dict(
+                appid=appid,
+                pagepath=pagepath
+            ) if appid else None)
+        elif app.type == WeChatApp.Type.MINIPROGRAM:
+            self._endpoint = "cgi-bin/message/wxopen/template/send"
+            payload.update(page=pagepath, emphasis_keyword=emphasis_keyword)
+        else:
+            raise WeChatAbilityError(WeChatAbilityError.TEMPLATE)
+
+        self.template = template
+        # 形如'{"template_id": "id", "url": "url"'
+        self._prefix = self._dumps(
+            {k: v for k, v in payload.items() if v is not None})[:-1]
+        self._fields = {
+            k: self._dump_field(k, v) for k, v in (data or {}).items()}
+
+    def send(self, user, data=None, form_id=None, **kwargs):
+        """
+        发送预编译的模板消息
+        :param user: 用户openid或用户对象
+        :type user: wechat_django.models.WeChatUser or str
+        :param data: 该用户的data字段,覆盖预编译的同名字段
+        :param form_id: 发送模板消息需要的form_id 仅小程序有效
+        :param kwargs: 该用户的data字段 可直接传字符串 当data未填写时 使用该字段
+        """
+        fields = self._fields
+        data = data or kwargs
+        if data:
+            fields = fields.copy()
+            fields.update((k, self._dump_field(k, v)) for k, v in data.items())
+
+        parts = [self._prefix, ', "touser": ',
+                 self._dumps(self.template._get_openid(user))]
+        if form_id:
+            parts.extend((', "form_id": ', self._dumps(form_id)))
+        parts.extend((', "data": {', ", ".join(fields.values()), "}}"))
+        body = "".join(parts).encode("utf-8")
+
+        client = self.template.app.client
+        if self.template.app.type == WeChatApp.Type.SERVICEAPP:
+            client = client.message
+        return client._post(self._endpoint, data=body)
+
+    @classmethod
+    def _dump_field(cls, key, value):
+        if not isinstance(value, dict):
+            value = dict(value=value)
+        return "{0}: {1}".format(cls._dumps(key), cls._dumps(value))
+
+    @staticmethod
+    def _dumps(obj):
+        return six.text_type(json.dumps(obj, ensure_ascii=False))
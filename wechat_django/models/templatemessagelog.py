@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import models as m
+from django.utils.translation import ugettext_lazy as _
+
+from ..utils.model import enum2choices
+from . import Template, WeChatApp, WeChatModel
+
+
+class TemplateMessageLogQuerySet(m.QuerySet):
+    def update_status(self, receipts):
+        """根据微信推送的模板消息送达结果批量更新状态
+        同一状态的消息只需一次按(app, msgid)索引的update
+
+        :param receipts: (msgid, status)的可迭代对象
+        :returns: 更新的记录数
+        """
+        groups = defaultdict(set)
+        for msgid, status in receipts:
+            groups[status].add(msgid)
+        return sum(
+            self.filter(msgid__in=msgids).update(status=status)
+            for status, msgids in groups.items())
+
+    def stats(self):
+        """统计发送及送达情况,仅执行一次聚合查询"""
+        def count(**kwargs):
+            return m.Sum(m.Case(
+                m.When(then=1, **kwargs), default=0,
+                output_field=m.IntegerField()))
+
+        Status = TemplateMessageLog.Status
+        rv = self.aggregate(
+            total=m.Count("id"),
+            sent=count(errcode=0),
+            delivered=count(status=Status.SUCCESS),
+            user_block=count(status=Status.USERBLOCK),
+            system_failed=count(status=Status.SYSTEMFAILED),
+            pending=count(errcode=0, status__isnull=True)
+        )
+        rv = {k: v or 0 for k, v in rv.items()}
+        rv["failed"] = rv["total"] - rv["sent"]
+        return rv
+
+
+class TemplateMessageLogManager(
+    m.Manager.from_queryset(TemplateMessageLogQuerySet)):
+    pass
+
+
+class TemplateMessageLog(WeChatModel):
+    """模板消息发送记录"""
+
+    class Status(object):
+        """TEMPLATESENDJOBFINISH事件推送的送达状态"""
+        SUCCESS = "success"
+        USERBLOCK = "failed:user block"
+        SYSTEMFAILED = "failed: system failed"
+
+    app = m.ForeignKey(
+        WeChatApp, related_name="template_logs", on_delete=m.CASCADE)
+    template = m.ForeignKey(
+        Template, related_name="logs", on_delete=m.CASCADE)
+    campaign = m.CharField(
+        _("campaign"), max_length=64, blank=True, null=True,
+        help_text=_("批量发送的批次标识"))
+
+    openid = m.CharField(_("openid"), max_length=36)
+    msgid = m.BigIntegerField(_("msgid"), null=True)
+    errcode = m.IntegerField(_("errcode"), default=0)
+    errmsg = m.CharField(_("errmsg"), max_length=256, blank=True, null=True)
+    status = m.CharField(
+        _("status"), max_length=32, blank=True, null=True,
+        choices=enum2choices(Status))
+
+    created_at = m.DateTimeField(_("created at"), auto_now_add=True)
+
+    objects = TemplateMessageLogManager()
+
+    class Meta(object):
+        verbose_name = _("template message log")
+        verbose_name_plural = _("template message logs")
+
+        index_together = (
+            ("template", "campaign", "openid"), ("app", "msgid"))
+        ordering = ("app", "-created_at")
+
+    @property
+    def success(self):
+        return self.errcode == 0
+
+    def __str__(self):
+        return "{openid} ({msgid})".format(
+            openid=self.openid, msgid=self.msgid)
@@ -93,6 +93,7 @@ class WeChatUser(WeChatModel):
         verbose_name_plural = _("users")
 
         ordering = ("app", "-created_at")
+        index_together = (("app", "created_at"),)
         unique_together = (
             ("app", "openid"), ("unionid", "app"), ("app", "alias"))
 
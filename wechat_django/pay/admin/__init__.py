@@ -1,4 +1,4 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from . import payapp, order # noqa
+from . import payapp, order, summary # noqa
@@ -5,7 +5,7 @@ from django.contrib import admin
 from django.utils.translation import ugettext_lazy as _
 import object_tool
 
-from ..models import UnifiedOrder, UnifiedOrderResult
+from ..models import Refund, UnifiedOrder, UnifiedOrderResult
 from .base import WeChatPayModelAdmin
 
 
@@ -34,13 +34,33 @@ class OrderResultAdmin(admin.StackedInline):
         return False
 
 
+class RefundAdmin(admin.TabularInline):
+    model = Refund
+
+    fields = (
+        "out_refund_no", "refund_id", "refund_fee", "settlement_refund_fee",
+        "status", "refund_desc", "success_time", "created_at", "updated_at")
+    extra = 0
+
+    def get_readonly_fields(self, request, obj=None):
+        return self.fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 class OrderAdmin(WeChatPayModelAdmin):
     __category__ = "pay_order"
     __model__ = UnifiedOrder
 
-    inlines = (OrderResultAdmin,)
+    inlines = (OrderResultAdmin, RefundAdmin)
 
     actions = ("sync",)
+    # trade_state及transaction_id读取订单结果 随订单一并查询
+    list_select_related = ("result",)
     list_display = (
         "out_trade_no", "body", "total_fee", "trade_state", "transaction_id",
         "openid", "sub_openid", "time_start", "time_expire", "created_at",
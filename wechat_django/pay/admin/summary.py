@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from ..models import OrderSummary
+from .base import WeChatPayModelAdmin
+
+
+class OrderSummaryAdmin(WeChatPayModelAdmin):
+    __category__ = "pay_order"
+    __model__ = OrderSummary
+
+    date_hierarchy = "date"
+    list_display = (
+        "date", "pay", "trade_state", "count", "total_fee", "cash_fee")
+    list_display_links = None
+    list_filter = ("pay", "trade_state")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
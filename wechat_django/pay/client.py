@@ -1,41 +1,95 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from contextlib import contextmanager
+import atexit
+import datetime
+import hashlib
 import os
-from tempfile import NamedTemporaryFile
+import shutil
+from tempfile import mkdtemp
+import threading
 
 from wechatpy import WeChatPay as _Pay
 from wechatpy.exceptions import WeChatPayException
+import xmltodict
 
+from . import settings
 
-@contextmanager
-def load_cert(self):
-    if self.pay.mch_cert and self.pay.mch_key:
-        # 证书文件要在硬盘上读取
-        # 自动delete在windows下读取时报PermissionDenied
-        # TODO: 可以考虑第一次使用时写入证书 析构时移除证书 减少IO
-        with NamedTemporaryFile("wb", delete=False) as mch_cert,\
-             NamedTemporaryFile("wb", delete=False) as mch_key:
-            mch_cert.write(self.pay.mch_cert)
-            mch_cert.flush()
-            mch_cert.close()
-            mch_key.write(self.pay.mch_key)
-            mch_key.flush()
-            mch_key.close()
-            self.mch_cert = mch_cert.name
-            self.mch_key = mch_key.name
-            try:
-                yield
-            finally:
-                self.mch_key and os.path.exists(self.mch_key)\
-                    and os.remove(self.mch_key)
-                self.mch_key = None
-                self.mch_cert and os.path.exists(self.mch_cert)\
-                    and os.remove(self.mch_cert)
-                self.mch_cert = None
-    else:
-        yield
+
+_certs = dict()
+_certs_dir = None
+_certs_lock = threading.Lock()
+
+
+def load_cert(pay):
+    """将商户证书及私钥写入仅当前用户可读写的文件,返回(证书路径, 私钥路径)
+
+    文件以商户号id及证书内容摘要命名,每个进程内同一证书只写入一次,
+    供所有请求及线程复用;证书变更后写入新文件并移除旧文件
+    :type pay: wechat_django.pay.models.WeChatPay
+    """
+    if not (pay.mch_cert and pay.mch_key):
+        return None, None
+
+    mch_cert = bytes(pay.mch_cert)
+    mch_key = bytes(pay.mch_key)
+    digest = hashlib.sha1(mch_cert + b"\n" + mch_key).hexdigest()
+    name = "{0}_{1}".format(pay.pk, digest)
+    with _certs_lock:
+        paths = _certs.get(pay.pk)
+        if paths and os.path.basename(paths[0]).startswith(name)\
+            and all(map(os.path.exists, paths)):
+            return paths
+
+        certs_dir = _get_certs_dir()
+        rv = (os.path.join(certs_dir, name + ".cert.pem"),
+              os.path.join(certs_dir, name + ".key.pem"))
+        _write_private_file(rv[0], mch_cert)
+        _write_private_file(rv[1], mch_key)
+        _certs[pay.pk] = rv
+        if paths and paths != rv:
+            _remove_files(paths)
+        return rv
+
+
+def release_cert(pay):
+    """移除已写入的商户证书文件"""
+    with _certs_lock:
+        paths = _certs.pop(pay.pk, None)
+        paths and _remove_files(paths)
+
+
+def _get_certs_dir():
+    global _certs_dir
+    if not _certs_dir:
+        if settings.CERTDIR:
+            if not os.path.exists(settings.CERTDIR):
+                os.makedirs(settings.CERTDIR, 0o700)
+            _certs_dir = settings.CERTDIR
+        else:
+            # mkdtemp创建的目录仅当前用户可访问 进程退出时移除
+            _certs_dir = mkdtemp(prefix="wechat_django_pay_")
+            atexit.register(shutil.rmtree, _certs_dir, True)
+    return _certs_dir
+
+
+def _write_private_file(path, content):
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(fd, content)
+    finally:
+        os.close(fd)
+    # 以rename保证其他进程不会读到写了一半的文件
+    os.rename(tmp, path)
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 
 class WeChatPayClient(_Pay):
@@ -52,30 +106,85 @@ class WeChatPayClient(_Pay):
             kwargs["sub_appid"] = pay.sub_appid
 
         super(WeChatPayClient, self).__init__(**kwargs)
+        self._stream_local = threading.local()
+
+    def iter_bill(self, bill_date, bill_type="ALL", device_info=None):
+        """流式下载对账单,逐条返回以表头为键的交易记录字典,
+        不含末尾的汇总数据
+
+        :param bill_date: 对账单日期
+        :param bill_type: 账单类型 ALL,SUCCESS,REFUND或RECHARGE_REFUND
+        """
+        if isinstance(bill_date, (datetime.datetime, datetime.date)):
+            bill_date = bill_date.strftime("%Y%m%d")
+        data = dict(
+            appid=self.appid,
+            bill_date=bill_date,
+            bill_type=bill_type,
+            device_info=device_info
+        )
+        self._stream_local.stream = True
+        try:
+            res = self._request(
+                "post", "pay/downloadbill", data=data, stream=True)
+        finally:
+            self._stream_local.stream = False
+
+        res.encoding = "utf-8"
+        lines = res.iter_lines(decode_unicode=True)
+        try:
+            headers = next(lines).lstrip("\ufeff")
+        except StopIteration:
+            return
+        if headers.startswith("<xml>"):
+            # 下载失败时返回xml
+            data = xmltodict.parse(
+                "".join([headers] + list(lines)))["xml"]
+            raise WeChatPayException(
+                data.get("return_code"), data.get("result_code"),
+                data.get("return_msg"), data.get("error_code"),
+                client=self, request=res.request, response=res)
+
+        headers = headers.split(",")
+        for line in lines:
+            if not line:
+                continue
+            if not line.startswith("`"):
+                # 交易记录之后为汇总数据
+                break
+            # 每个字段以`开头 商品名称等字段中可能包含逗号
+            values = line[1:].split(",`")
+            yield dict(zip(headers, values))
+
+    def _handle_result(self, res):
+        # 流式请求的响应由调用方读取
+        if getattr(self._stream_local, "stream", False):
+            return res
+        return super(WeChatPayClient, self)._handle_result(res)
 
     def _request(self, method, url_or_endpoint, **kwargs):
         logger = self.pay.app.logger("client")
         log_args = dict(data=kwargs.get("data", ""))
-        with load_cert(self):
-            try:
-                rv = super(WeChatPayClient, self)._request(
-                    method, url_or_endpoint, **kwargs)
-            except WeChatPayException as e:
-                log_args["err"] = e
-                logger.warning(
-                    "An error occurred when send wechat pay"
-                    "request: %s" % log_args, exc_info=True)
-                raise
-            except Exception as e:
-                log_args["err"] = e
-                logger.error(
-                    "An unexcept error occurred when send wechat pay"
-                    "request: %s" % log_args, exc_info=True)
-                raise
-            else:
-                log_args["result"] = rv
-                logger.debug("A WeChat pay request sent: %s" % log_args)
-            return rv
+        self.mch_cert, self.mch_key = load_cert(self.pay)
+        try:
+            rv = super(WeChatPayClient, self)._request(
+                method, url_or_endpoint, **kwargs)
+        except WeChatPayException as e:
+            log_args["err"] = e
+            logger.warning(
+                "An error occurred when send wechat pay"
+                "request: %s" % log_args, exc_info=True)
+            raise
+        except Exception as e:
+            log_args["err"] = e
+            logger.error(
+                "An unexcept error occurred when send wechat pay"
+                "request: %s" % log_args, exc_info=True)
+            raise
+        else:
+            log_args["result"] = rv
+            logger.debug("A WeChat pay request sent: %s" % log_args)
+        return rv
 
 
 class WeChatPaySandboxClient(WeChatPayClient):
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wechat_django.models import WeChatApp
+from ...poller import OrderPoller
+
+
+class Command(BaseCommand):
+    help = "轮询待支付订单状态,并关闭已过期的订单"
+
+    def add_arguments(self, parser):
+        parser.add_argument("appname", help="公众号名")
+        parser.add_argument("--pay", dest="payname", help="商户号名,默认全部")
+        parser.add_argument(
+            "--workers", type=int, default=8, help="最大并发查询数")
+        parser.add_argument(
+            "--interval", type=int, default=5, help="两轮轮询间隔(秒)")
+        parser.add_argument(
+            "--once", action="store_true", help="仅轮询一次")
+
+    def handle(self, appname, payname=None, workers=8, interval=5,
+               once=False, **options):
+        try:
+            app = WeChatApp.objects.get(name=appname)
+        except WeChatApp.DoesNotExist:
+            raise CommandError("app %s not found" % appname)
+
+        pays = app.pays.all()
+        if payname:
+            pays = pays.filter(name=payname)
+        poller = OrderPoller(pays, workers=workers)
+        if once:
+            rv = poller.poll()
+            self.stdout.write(
+                "polled {polled}, updated {updated}, closed {closed}, "
+                "failed {failed}".format(**rv))
+        else:
+            poller.run(interval)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone as tz
+
+from wechat_django.models import WeChatApp
+
+
+class Command(BaseCommand):
+    help = "以微信支付对账单核对并更新订单结果"
+
+    def add_arguments(self, parser):
+        parser.add_argument("appname", help="公众号名")
+        parser.add_argument("--pay", dest="payname", help="商户号名,默认全部")
+        parser.add_argument(
+            "--date", dest="bill_date",
+            help="对账单日期,格式为YYYYMMDD,默认昨日")
+
+    def handle(self, appname, payname=None, bill_date=None, **options):
+        try:
+            app = WeChatApp.objects.get(name=appname)
+        except WeChatApp.DoesNotExist:
+            raise CommandError("app %s not found" % appname)
+
+        if not bill_date:
+            yesterday = tz.localtime() - datetime.timedelta(days=1)
+            bill_date = yesterday.strftime("%Y%m%d")
+
+        pays = app.pays.all()
+        if payname:
+            pays = pays.filter(name=payname)
+        for pay in pays:
+            report = pay.reconcile(bill_date)
+            self.stdout.write(
+                "{pay}: total {total}, updated {updated}, "
+                "missing {missing}, mismatched {mismatched}".format(
+                    pay=pay.name, total=report["total"],
+                    updated=report["updated"],
+                    missing=len(report["missing"]),
+                    mismatched=len(report["mismatched"])))
+            for out_trade_no in report["missing"]:
+                self.stderr.write("missing: " + out_trade_no)
+            for out_trade_no in report["mismatched"]:
+                self.stderr.write("mismatched: " + out_trade_no)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 05:52
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django_pay', '0001_pay'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='unifiedorderresult',
+            index_together={('trade_state', 'order')},
+        ),
+    ]
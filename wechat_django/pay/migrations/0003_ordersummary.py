@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 05:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django_pay', '0002_pendingorderindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='date')),
+                ('trade_state', models.CharField(choices=[('CLOSED', 'CLOSED'), ('FAIL', 'FAIL'), ('NOTPAY', 'NOTPAY'), ('PAYERROR', 'PAYERROR'), ('REFUND', 'REFUND'), ('REVOKED', 'REVOKED'), ('SUCCESS', 'SUCCESS'), ('USERPAYING', 'USERPAYING')], max_length=32, verbose_name='trade_state')),
+                ('count', models.IntegerField(default=0, verbose_name='count')),
+                ('total_fee', models.BigIntegerField(default=0, verbose_name='total_fee')),
+                ('cash_fee', models.BigIntegerField(default=0, verbose_name='cash_fee')),
+                ('pay', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='order_summaries', to='wechat_django_pay.WeChatPay')),
+            ],
+            options={
+                'verbose_name': 'Order summary',
+                'verbose_name_plural': 'Order summaries',
+                'ordering': ('-date', 'trade_state'),
+                'unique_together': {('pay', 'date', 'trade_state')},
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 05:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+import wechat_django.pay.models.refund
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django_pay', '0003_ordersummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Refund',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('out_refund_no', models.CharField(db_index=True, default=wechat_django.pay.models.refund.generate_out_refund_no, max_length=64, verbose_name='out_refund_no')),
+                ('refund_id', models.CharField(max_length=32, null=True, verbose_name='refund_id')),
+                ('refund_fee', models.PositiveIntegerField(verbose_name='refund_fee')),
+                ('settlement_refund_fee', models.PositiveIntegerField(null=True, verbose_name='settlement_refund_fee')),
+                ('refund_desc', models.CharField(max_length=80, null=True, verbose_name='refund_desc')),
+                ('status', models.CharField(choices=[('CHANGE', 'CHANGE'), ('FAIL', 'FAIL'), ('PENDING', 'PENDING'), ('PROCESSING', 'PROCESSING'), ('REFUNDCLOSE', 'REFUNDCLOSE'), ('SUCCESS', 'SUCCESS')], default='PENDING', max_length=16, verbose_name='refund_status')),
+                ('success_time', models.CharField(max_length=20, null=True, verbose_name='success_time')),
+                ('refund_recv_accout', models.CharField(max_length=64, null=True, verbose_name='refund_recv_accout')),
+                ('ext_info', jsonfield.fields.JSONField(default=dict, editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='refunds', to='wechat_django_pay.UnifiedOrder')),
+            ],
+            options={
+                'verbose_name': 'Refund',
+                'verbose_name_plural': 'Refunds',
+                'unique_together': {('order', 'out_refund_no')},
+                'index_together': {('status', 'created_at')},
+            },
+        ),
+    ]
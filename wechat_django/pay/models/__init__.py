@@ -5,3 +5,5 @@ from __future__ import unicode_literals
 from .app import WeChatPay
 from .order import UnifiedOrder
 from .orderresult import UnifiedOrderResult
+from .ordersummary import OrderSummary
+from .refund import Refund
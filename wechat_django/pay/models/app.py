@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 from django.db import models as m
+from django.dispatch import receiver
 from django.utils.functional import cached_property
 from django.utils.module_loading import import_string
 from django.utils.translation import ugettext_lazy as _
@@ -60,6 +61,23 @@ class WeChatPay(m.Model):
         unique_together = (("app", "name"),)
         ordering = ("app", "-weight", "pk")
 
+    _notify_urls = dict()
+
+    def notify_url(self, request=None, urlname="order_notify"):
+        """支付结果通知地址 按商户号及请求域名缓存,避免每次下单反解url
+
+        :param urlname: 通知地址的url名,退款通知为refund_notify
+        """
+        app = self.app
+        host = request.get_host() if request and not app.site_host else None
+        key = (urlname, app.name, self.name, app.site_host, app.site_https,
+               host, host and request.scheme)
+        if key not in self._notify_urls:
+            self._notify_urls[key] = app.build_url(
+                urlname, request=request,
+                kwargs=dict(payname=self.name), absolute=True)
+        return self._notify_urls[key]
+
     @property
     def client(self):
         """:rtype: wechat_django.client.WeChatPayClient"""
@@ -74,3 +92,10 @@ class WeChatPay(m.Model):
 
     def __str__(self):
         return "{0} ({1})".format(self.title, self.name)
+
+
+@receiver(m.signals.post_delete, sender=WeChatPay)
+def on_pay_deleted(sender, instance, *args, **kwargs):
+    """移除已删除商户号落地的证书文件"""
+    from ..client import release_cert
+    release_cert(instance)
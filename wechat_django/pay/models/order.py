@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 import datetime
 
-from django.db import models as m
+from django.db import models as m, transaction
 from django.dispatch import receiver
 from django.utils import timezone as tz
 from django.utils.translation import ugettext_lazy as _
@@ -17,6 +17,17 @@ from . import WeChatPay
 from .base import PayDateTimeField, paymethod
 
 
+_external_ip = None
+
+
+def _get_external_ip():
+    """本机外网ip 仅在首次使用时查询"""
+    global _external_ip
+    if not _external_ip:
+        _external_ip = get_external_ip()
+    return _external_ip
+
+
 class UnifiedOrder(WeChatModel):
     ALLOW_UPDATES = (
         "device_info", "openid", "sub_openid", "trade_type", "total_fee",
@@ -132,12 +143,18 @@ class UnifiedOrder(WeChatModel):
         :param kwargs: 覆盖默认生成的数据
         :param dt2py: 将请求微信的datetime格式转换为python的datetime格式
         """
+        update_fields = []
         # 更新ip
-        self.spbill_create_ip = kwargs.pop(
+        client_ip = kwargs.pop(
             "client_ip",
-            get_ip(request) or self.spbill_create_ip or get_external_ip())
+            get_ip(request) or self.spbill_create_ip or _get_external_ip())
+        if client_ip != self.spbill_create_ip:
+            self.spbill_create_ip = client_ip
+            update_fields.append("spbill_create_ip")
         if self._call_args:
-            self._call_args["client_ip"] = self.spbill_create_ip
+            if self._call_args.get("client_ip") != self.spbill_create_ip:
+                self._call_args["client_ip"] = self.spbill_create_ip
+                update_fields.append("_call_args")
         else:
             self.time_start = kwargs.pop("time_start", self.time_start)
             self.time_expire = kwargs.pop("time_expire", self.time_expire)
@@ -147,14 +164,11 @@ class UnifiedOrder(WeChatModel):
             if not self.time_expire:
                 self.time_expire = self.created_at + datetime.timedelta(hours=2)
             # 构建call_args并缓存
-            notify_url = self.pay.app.build_url(
-                "order_notify", request=request,
-                kwargs=dict(payname=self.pay.name), absolute=True)
             self._call_args = dict(
                 trade_type=self.trade_type,
                 body=self.body,
                 total_fee=self.total_fee,
-                notify_url=notify_url,
+                notify_url=self.pay.notify_url(request),
                 client_ip=self.spbill_create_ip,
                 user_id=self.openid,
                 out_trade_no=self.out_trade_no,
@@ -171,7 +185,12 @@ class UnifiedOrder(WeChatModel):
                 receipt=self.receipt
             )
             self._call_args.update(kwargs)
-        self.save()
+            update_fields.extend(("time_start", "time_expire", "_call_args"))
+        # 仅写入有变化的字段
+        if not self.pk:
+            self.save()
+        elif update_fields:
+            self.save(update_fields=update_fields + ["updated_at"])
 
         rv = self._call_args.copy()
         if dt2py:
@@ -185,6 +204,19 @@ class UnifiedOrder(WeChatModel):
         call_args = self.call_args(request, dt2py=True, **kwargs)
         return self.pay.client.order.create(**call_args)
 
+    def refund(self, refund_fee=None, refund_desc=None, request=None,
+               **kwargs):
+        """申请退款
+
+        :param refund_fee: 退款金额 默认全额退款
+        :rtype: wechat_django.pay.models.Refund
+        """
+        refund = self.refunds.create(
+            refund_fee=refund_fee or self.total_fee, refund_desc=refund_desc,
+            **kwargs)
+        refund.apply(request)
+        return refund
+
     def jsapi_params(self, prepay_id, *args, **kwargs):
         return self.pay.client.jsapi.get_jsapi_params(
             prepay_id, *args, **kwargs)
@@ -209,24 +241,50 @@ class UnifiedOrder(WeChatModel):
         return self.result, result
 
     def update(self, result, signal=True, verify=True):
-        """由字典更新数据"""
-        verify and self.verify(result)
-        updated = False
-        for field in self.ALLOW_UPDATES:
-            data = result.get(field)
-            if not getattr(self, field) and data:
-                setattr(self, field, data)
-                updated = True
-        updated and self.save()
+        """由字典更新数据 订单状态未变化时不写入数据也不发送信号
+
+        :returns: 订单状态是否有更新
+        """
+        from . import UnifiedOrderResult
 
+        verify and self.verify(result)
         try:
-            self.result.update(result, signal=signal, verify=False)
+            current = self.result
         except AttributeError:
-            from . import UnifiedOrderResult
-            transaction_id = result.get("transaction_id") or None
-            obj = UnifiedOrderResult(
-                order=self, transaction_id=transaction_id)
-            obj.update(result, signal=signal, verify=False)
+            current = None
+        if current and (current.same_state(result)
+                        or not current.can_transit(result["trade_state"])):
+            return False
+
+        with transaction.atomic():
+            # 锁定订单行,避免回调通知与主动查询并发更新同一订单
+            list(UnifiedOrder.objects.select_for_update()
+                 .filter(pk=self.pk).values_list("pk", flat=True))
+            current = UnifiedOrderResult.objects.filter(order=self).first()
+            if current:
+                self.result = current
+                # 迟到的通知或查询不回退已退款,关闭等状态
+                if current.same_state(result)\
+                    or not current.can_transit(result["trade_state"]):
+                    return False
+
+            updated = False
+            for field in self.ALLOW_UPDATES:
+                data = result.get(field)
+                if not getattr(self, field) and data:
+                    setattr(self, field, data)
+                    updated = True
+            updated and self.save()
+
+            if not current:
+                transaction_id = result.get("transaction_id") or None
+                current = UnifiedOrderResult(
+                    order=self, transaction_id=transaction_id)
+            current.update(result, signal=False, verify=False)
+        # 信号接收方多为发货等耗时逻辑 在释放行锁后发送,
+        # 接收方异常也不会回滚已写入的订单结果
+        signal and current.send_signal(result.get("attach"))
+        return True
 
     def verify(self, result):
         """检查订单结果参数"""
@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.db import models as m
+from decimal import Decimal
+
+from django.db import models as m, transaction
 from django.utils.translation import ugettext_lazy as _
 from jsonfield import JSONField
 
 from wechat_django.models import WeChatModel
+from wechat_django.utils.func import next_chunk
 from wechat_django.utils.model import enum2choices, model_fields
 from ..signals import order_updated
 from . import UnifiedOrder
-from .base import PayBooleanField, PayDateTimeField
+from .base import PayBooleanField, PayDateTimeField, paymethod
 
 
 class UnifiedOrderResult(WeChatModel):
@@ -23,6 +26,15 @@ class UnifiedOrderResult(WeChatModel):
         PAYERROR = "PAYERROR"  # 支付失败(其他原因，如银行返回失败)
         FAIL = "FAIL"  # 回调拿到失败
 
+    # 订单状态只能向优先级更高的状态流转 退款,关闭及撤销为终态
+    TERMINAL_STATES = (State.REFUND, State.CLOSED, State.REVOKED)
+    STATE_PRECEDENCE = {
+        State.SUCCESS: 1,
+        State.REFUND: 2,
+        State.CLOSED: 2,
+        State.REVOKED: 2
+    }
+
     order = m.OneToOneField(
         UnifiedOrder, on_delete=m.CASCADE, related_name="result")
 
@@ -53,10 +65,145 @@ class UnifiedOrderResult(WeChatModel):
         verbose_name = _("Unified order result")
         verbose_name_plural = _("Unified order results")
 
+        # 供轮询待支付订单使用
+        index_together = (("trade_state", "order"), )
+
+    @classmethod
+    @paymethod("reconcile")
+    def reconcile(cls, pay, bill_date, signal=True, chunk_size=1000):
+        """以对账单核对并更新订单结果 仅写入状态有变化的订单
+
+        :type pay: wechat_django.pay.models.WeChatPay
+        :param bill_date: 对账单日期
+        :param signal: 是否对更新的订单发送order_updated信号
+        :returns: 对账报告 missing为对账单中有而本地不存在的商户订单号,
+                  mismatched为金额不一致未予更新的商户订单号
+        """
+        report = dict(total=0, updated=0, missing=[], mismatched=[])
+        rows = pay.client.iter_bill(bill_date)
+        for chunk in next_chunk(rows, chunk_size):
+            report["total"] += len(chunk)
+            # 同一订单当日既支付又退款时 以优先级较高的记录为准
+            bill = dict()
+            for row in chunk:
+                out_trade_no = row["商户订单号"]
+                existed = bill.get(out_trade_no)
+                if not existed or cls.precedence(row["交易状态"])\
+                    >= cls.precedence(existed["交易状态"]):
+                    bill[out_trade_no] = row
+            with transaction.atomic():
+                updates = cls._reconcile_chunk(pay, bill, report)
+            report["updated"] += len(updates)
+
+            if signal:
+                for obj in updates:
+                    order_updated.send(
+                        sender=pay.staticname, result=obj, order=obj.order,
+                        state=obj.trade_state, attach=None)
+        return report
+
+    @classmethod
+    def _reconcile_chunk(cls, pay, bill, report):
+        """在锁定订单行后核对一批账单 避免与回调通知及主动查询交错写入
+
+        :returns: 有更新的订单结果
+        """
+        from . import OrderSummary
+
+        # 按主键顺序锁定 与UnifiedOrder.update使用同一把锁
+        orders = UnifiedOrder.objects.select_for_update().filter(
+            pay=pay, out_trade_no__in=bill.keys()).order_by("pk")
+        orders = {order.out_trade_no: order for order in orders}
+        results = cls.objects.filter(
+            order_id__in=[order.pk for order in orders.values()])
+        results = {result.order_id: result for result in results}
+
+        updates = []
+        transitions = []
+        for out_trade_no, row in bill.items():
+            order = orders.get(out_trade_no)
+            if not order:
+                report["missing"].append(out_trade_no)
+                continue
+            order.pay = pay
+            result = cls._bill2result(row)
+            total_fee = result.pop("total_fee")
+            if result["trade_state"] == cls.State.SUCCESS\
+                and total_fee != order.total_fee:
+                report["mismatched"].append(out_trade_no)
+                continue
+            obj = results.get(order.pk) or cls()
+            obj.order = order
+            if obj.pk and (obj.same_state(result)
+                           or not obj.can_transit(result["trade_state"])):
+                # 对账单晚于本地状态时(如已退款的订单) 不回退状态
+                continue
+            if obj.cash_fee is not None:
+                # 保留通知或查询得到的实付金额
+                result.pop("cash_fee", None)
+            previous = (obj.trade_state, obj.cash_fee) if obj.pk else None
+            for k, v in result.items():
+                setattr(obj, k, v)
+            updates.append(obj)
+            transitions.append(
+                (order, previous, (obj.trade_state, obj.cash_fee)))
+
+        cls.objects.bulk_create([obj for obj in updates if not obj.pk])
+        for obj in updates:
+            if obj.pk:
+                obj.save(update_fields=(
+                    "transaction_id", "trade_state", "time_end",
+                    "bank_type", "settlement_total_fee", "cash_fee",
+                    "updated_at"))
+        OrderSummary.record(transitions)
+        return updates
+
+    @classmethod
+    def _bill2result(cls, row):
+        def fen(yuan):
+            return int(Decimal(yuan or "0") * 100)
+
+        trade_state = row["交易状态"]
+        rv = dict(
+            transaction_id=row["微信订单号"] or None,
+            trade_state=trade_state,
+            bank_type=row.get("付款银行") or None,
+            # 旧版对账单无订单金额一列
+            total_fee=fen(row.get("订单金额") or row.get("应结订单金额"))
+        )
+        if row.get("应结订单金额"):
+            # 对账单无现金支付金额 以应结订单金额计入统计
+            rv["cash_fee"] = fen(row["应结订单金额"])
+        if trade_state == cls.State.SUCCESS:
+            rv["settlement_total_fee"] = fen(row.get("应结订单金额"))
+            rv["time_end"] = PayDateTimeField.str2dt(
+                "".join(c for c in row["交易时间"] if c.isdigit()))
+        return rv
+
+    @classmethod
+    def precedence(cls, trade_state):
+        return cls.STATE_PRECEDENCE.get(trade_state, 0)
+
+    def can_transit(self, trade_state):
+        """订单结果能否由当前状态变更为trade_state 终态不再变更"""
+        if self.trade_state in self.TERMINAL_STATES:
+            return False
+        return self.precedence(trade_state) >= self.precedence(
+            self.trade_state)
+
+    def same_state(self, result):
+        """订单结果与查询或通知结果的状态是否一致"""
+        return self.trade_state == result.get("trade_state")\
+            and (self.transaction_id or None)\
+            == (result.get("transaction_id") or None)
+
     def update(self, result, signal=True, verify=True):
         """根据参数更新订单状态"""
+        from . import OrderSummary
+
         verify and self.order.verify(result)
         # TODO: 支付成功后写入用户
+        previous = (self.trade_state, self.cash_fee) if self.pk else None
         excludes = ("transaction_id",) if self.transaction_id else tuple()
         all_fields = model_fields(UnifiedOrderResult, excludes=excludes)
         ignore_fields = (
@@ -69,11 +216,17 @@ class UnifiedOrderResult(WeChatModel):
                     setattr(self, k, v)
                 else:
                     self.ext_info[k] = v
-        self.save()
-        if signal:
-            order_updated.send(sender=self.order.pay.staticname, result=self,
-                               order=self.order, state=self.trade_state,
-                               attach=result.get("attach"))
+        with transaction.atomic():
+            self.save()
+            OrderSummary.record(
+                [(self.order, previous, (self.trade_state, self.cash_fee))])
+        signal and self.send_signal(result.get("attach"))
+
+    def send_signal(self, attach=None):
+        """发送order_updated信号 应在写入事务及行锁之外调用"""
+        order_updated.send(sender=self.order.pay.staticname, result=self,
+                           order=self.order, state=self.trade_state,
+                           attach=attach)
 
     def __str__(self):
         return _("%(order)s reuslt") % dict(order=self.order)
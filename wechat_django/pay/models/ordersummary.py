@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import IntegrityError, models as m, transaction
+from django.utils import timezone as tz
+from django.utils.translation import ugettext_lazy as _
+
+from wechat_django.models import WeChatModel
+from wechat_django.utils.model import enum2choices
+from . import UnifiedOrderResult, WeChatPay
+
+
+class OrderSummary(WeChatModel):
+    """按商户号,订单创建日期及订单状态汇总的订单统计,随订单状态变化增量维护"""
+    pay = m.ForeignKey(
+        WeChatPay, on_delete=m.CASCADE, related_name="order_summaries")
+    date = m.DateField(_("date"))
+    trade_state = m.CharField(
+        _("trade_state"), max_length=32,
+        choices=enum2choices(UnifiedOrderResult.State))
+
+    count = m.IntegerField(_("count"), default=0)
+    total_fee = m.BigIntegerField(_("total_fee"), default=0)
+    cash_fee = m.BigIntegerField(_("cash_fee"), default=0)
+
+    class Meta(object):
+        verbose_name = _("Order summary")
+        verbose_name_plural = _("Order summaries")
+
+        unique_together = (("pay", "date", "trade_state"),)
+        ordering = ("-date", "trade_state")
+
+    @classmethod
+    def record(cls, transitions):
+        """记录订单状态变化
+
+        :param transitions: (订单, 原(状态, cash_fee), 现(状态, cash_fee))
+                            的列表,订单首次产生结果时原状态为None
+        """
+        deltas = defaultdict(lambda: [0, 0, 0])
+        for order, previous, current in transitions:
+            date = tz.localtime(order.created_at).date()
+            for state, sign in ((previous, -1), (current, 1)):
+                if not state:
+                    continue
+                trade_state, cash_fee = state
+                delta = deltas[(order.pay_id, date, trade_state)]
+                delta[0] += sign
+                delta[1] += sign * order.total_fee
+                delta[2] += sign * int(cash_fee or 0)
+
+        for (pay_id, date, trade_state), delta in deltas.items():
+            if any(delta):
+                cls._add(pay_id, date, trade_state, *delta)
+
+    @classmethod
+    def rebuild(cls, pay):
+        """由订单结果重新生成商户号的全部统计,用于初始化或修正统计数据"""
+        from django.db.models.functions import TruncDate
+
+        rows = UnifiedOrderResult.objects.filter(order__pay=pay).annotate(
+            date=TruncDate("order__created_at")
+        ).values("date", "trade_state").annotate(
+            count=m.Count("pk"),
+            total_fee=m.Sum("order__total_fee"),
+            cash_fee=m.Sum("cash_fee")
+        ).order_by()
+        with transaction.atomic():
+            cls.objects.filter(pay=pay).delete()
+            cls.objects.bulk_create([
+                cls(pay=pay, date=row["date"], trade_state=row["trade_state"],
+                    count=row["count"], total_fee=row["total_fee"] or 0,
+                    cash_fee=row["cash_fee"] or 0)
+                for row in rows
+            ])
+
+    @classmethod
+    def _add(cls, pay_id, date, trade_state, count, total_fee, cash_fee):
+        def update():
+            return cls.objects.filter(
+                pay_id=pay_id, date=date, trade_state=trade_state
+            ).update(
+                count=m.F("count") + count,
+                total_fee=m.F("total_fee") + total_fee,
+                cash_fee=m.F("cash_fee") + cash_fee)
+
+        if update():
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    pay_id=pay_id, date=date, trade_state=trade_state,
+                    count=count, total_fee=total_fee, cash_fee=cash_fee)
+        except IntegrityError:
+            # 并发创建
+            update()
+
+    def __str__(self):
+        return "{0} {1}".format(self.date, self.trade_state)
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from uuid import uuid4
+
+from django.db import models as m, transaction
+from django.utils.translation import ugettext_lazy as _
+from jsonfield import JSONField
+import six
+from wechatpy.exceptions import WeChatPayException
+
+from wechat_django.models import WeChatModel
+from wechat_django.utils.func import concurrent_map
+from wechat_django.utils.model import enum2choices
+from ..signals import refund_updated
+from . import UnifiedOrder
+from .base import paymethod
+
+
+def generate_out_refund_no():
+    return uuid4().hex
+
+
+class Refund(WeChatModel):
+    class Status(object):
+        PENDING = "PENDING"  # 未申请
+        FAIL = "FAIL"  # 申请失败
+        PROCESSING = "PROCESSING"  # 退款处理中
+        SUCCESS = "SUCCESS"  # 退款成功
+        CHANGE = "CHANGE"  # 退款异常
+        REFUNDCLOSE = "REFUNDCLOSE"  # 退款关闭
+
+    # 退款状态只能向优先级更高的状态流转 成功,关闭及异常为终态
+    TERMINAL_STATUSES = (Status.SUCCESS, Status.REFUNDCLOSE, Status.CHANGE)
+    STATUS_PRECEDENCE = {
+        Status.PROCESSING: 1,
+        Status.SUCCESS: 2,
+        Status.REFUNDCLOSE: 2,
+        Status.CHANGE: 2
+    }
+
+    # 明确拒绝退款申请的错误码 SYSTEMERROR,BIZERR_NEED_RETRY等错误时
+    # 退款可能已受理,需以相同退款单号查询或重新申请
+    FAIL_ERRCODES = (
+        "TRADE_OVERDUE", "ERROR", "USER_ACCOUNT_ABNORMAL", "NOTENOUGH",
+        "INVALID_TRANSACTIONID", "PARAM_ERROR", "APPID_NOT_EXIST",
+        "MCHID_NOT_EXIST", "APPID_MCHID_NOT_MATCH", "ORDERNOTEXIST",
+        "REQUIRE_POST_METHOD", "SIGNERROR", "XML_FORMAT_ERROR")
+
+    order = m.ForeignKey(
+        UnifiedOrder, on_delete=m.CASCADE, related_name="refunds")
+
+    out_refund_no = m.CharField(
+        _("out_refund_no"), max_length=64, db_index=True,
+        default=generate_out_refund_no)
+    refund_id = m.CharField(_("refund_id"), max_length=32, null=True)
+    refund_fee = m.PositiveIntegerField(_("refund_fee"))
+    settlement_refund_fee = m.PositiveIntegerField(
+        _("settlement_refund_fee"), null=True)
+    refund_desc = m.CharField(_("refund_desc"), max_length=80, null=True)
+    status = m.CharField(
+        _("refund_status"), max_length=16, choices=enum2choices(Status),
+        default=Status.PENDING)
+    success_time = m.CharField(_("success_time"), max_length=20, null=True)
+    refund_recv_accout = m.CharField(
+        _("refund_recv_accout"), max_length=64, null=True)
+
+    ext_info = JSONField(default=dict, editable=False)
+
+    created_at = m.DateTimeField(_("created at"), auto_now_add=True)
+    updated_at = m.DateTimeField(_("updated at"), auto_now=True)
+
+    class Meta(object):
+        verbose_name = _("Refund")
+        verbose_name_plural = _("Refunds")
+
+        unique_together = (("order", "out_refund_no"),)
+        index_together = (("status", "created_at"),)
+
+    @classmethod
+    @paymethod("apply_refunds")
+    def apply_many(cls, pay, refunds, request=None, workers=8,
+                   signal=True):
+        """并发申请退款 各请求共用商户号的证书文件与连接
+
+        :type pay: wechat_django.pay.models.WeChatPay
+        :param refunds: 待申请的Refund
+        :returns: dict(applied=申请成功数, failed=申请失败数)
+        """
+        notify_url = pay.notify_url(request, "refund_notify")
+
+        def prepare(refunds):
+            # 在调用方线程读取订单 工作线程仅发起请求
+            for refund in refunds:
+                refund.order.pay = pay
+                yield refund, refund.call_args(notify_url)
+
+        def apply(item):
+            refund, call_args = item
+            try:
+                return refund, pay.client.refund.apply(**call_args), None
+            except Exception as e:
+                # 单笔请求异常不中断整批申请
+                return refund, None, e
+
+        rv = dict(applied=0, failed=0)
+        for refund, result, exc in concurrent_map(
+            apply, prepare(refunds), workers):
+            try:
+                if exc:
+                    refund.fail(exc, signal=signal)
+                else:
+                    result.setdefault("refund_status", cls.Status.PROCESSING)
+                    refund.update(result, signal=signal)
+            except Exception as e:
+                exc = exc or e
+            if exc:
+                cls._log_error(
+                    pay, "apply refund %s failed: %s", refund, exc)
+                rv["failed"] += 1
+            else:
+                rv["applied"] += 1
+        return rv
+
+    @classmethod
+    @paymethod("sync_refunds")
+    def sync_many(cls, pay, refunds=None, workers=8, signal=True):
+        """并发查询退款状态
+
+        :param refunds: 需查询的Refund,默认为该商户号下处理中的全部退款
+                        (包括申请结果未知的退款)
+        :returns: dict(synced=查询数, updated=状态变化数, failed=失败数)
+        """
+        if refunds is None:
+            refunds = cls.objects.select_related("order").filter(
+                order__pay=pay, status=cls.Status.PROCESSING
+            ).order_by("created_at").iterator()
+
+        def query(refund):
+            try:
+                return refund, pay.client.refund.query(
+                    out_refund_no=refund.out_refund_no), None
+            except Exception as e:
+                return refund, None, e
+
+        rv = dict(synced=0, updated=0, failed=0)
+        for refund, result, exc in concurrent_map(query, refunds, workers):
+            rv["synced"] += 1
+            refund.order.pay = pay
+            updated = False
+            if not exc:
+                try:
+                    updated = refund.update(result, signal=signal)
+                except Exception as e:
+                    exc = e
+            if exc:
+                cls._log_error(
+                    pay, "query refund %s failed: %s", refund, exc)
+                rv["failed"] += 1
+            elif updated:
+                rv["updated"] += 1
+        return rv
+
+    @staticmethod
+    def _log_error(pay, msg, refund, exc):
+        """微信返回的错误记为warning 其他异常连同堆栈记为error"""
+        logger = pay.app.logger("pay")
+        if isinstance(exc, WeChatPayException):
+            logger.warning(msg, refund.out_refund_no, exc)
+        else:
+            exc_info = (type(exc), exc, getattr(exc, "__traceback__", None))
+            logger.error(msg, refund.out_refund_no, exc, exc_info=exc_info)
+
+    def call_args(self, notify_url=None):
+        """申请退款接口的参数"""
+        return dict(
+            total_fee=self.order.total_fee,
+            refund_fee=self.refund_fee,
+            out_refund_no=self.out_refund_no,
+            out_trade_no=self.order.out_trade_no,
+            fee_type=self.order.fee_type or UnifiedOrder.FeeType.CNY,
+            refund_desc=self.refund_desc,
+            notify_url=notify_url
+        )
+
+    def apply(self, request=None):
+        """申请退款"""
+        pay = self.order.pay
+        try:
+            rv = pay.client.refund.apply(
+                **self.call_args(pay.notify_url(request, "refund_notify")))
+        except Exception as e:
+            self.fail(e)
+            raise
+        rv.setdefault("refund_status", self.Status.PROCESSING)
+        self.update(rv)
+        return rv
+
+    def fail(self, exc, signal=True):
+        """记录退款申请失败 仅明确拒绝的业务错误记为失败,
+        系统错误,网络异常等结果未知时记为处理中,由sync_many查询确认
+        """
+        errcode = getattr(exc, "errcode", None)
+        if errcode in self.FAIL_ERRCODES:
+            status = self.Status.FAIL
+        else:
+            status = self.Status.PROCESSING
+        return self.update(dict(
+            refund_status=status, err_code=errcode or type(exc).__name__,
+            err_code_des=getattr(exc, "errmsg", None) or six.text_type(exc)),
+            signal=signal)
+
+    def sync(self):
+        """查询退款状态"""
+        rv = self.order.pay.client.refund.query(
+            out_refund_no=self.out_refund_no)
+        self.update(rv)
+        return rv
+
+    def update(self, result, signal=True):
+        """由申请,查询或通知结果更新退款 状态未变化时不写入
+
+        :returns: 状态是否有更新
+        """
+        result = self._normalize(result)
+        with transaction.atomic():
+            if self.pk:
+                # 锁定退款行,避免回调通知与主动查询并发更新同一退款
+                current = Refund.objects.select_for_update().filter(
+                    pk=self.pk).values_list("status", "refund_id").first()
+                if current:
+                    self.status, self.refund_id = current
+            status = result.get("refund_status") or self.status
+            refund_id = result.get("refund_id") or self.refund_id
+            if self.pk and (status == self.status
+                            and refund_id == self.refund_id
+                            or not self.can_transit(status)):
+                # 迟到的通知或查询不回退已成功,关闭等状态
+                return False
+
+            self.status = status
+            self.refund_id = refund_id
+            for field in ("settlement_refund_fee", "success_time",
+                          "refund_recv_accout"):
+                if result.get(field) is not None:
+                    setattr(self, field, result[field])
+            for k in ("err_code", "err_code_des", "refund_account",
+                      "refund_request_source"):
+                if result.get(k) is not None:
+                    self.ext_info[k] = result[k]
+            self.save()
+        # 在释放行锁后发送信号
+        if signal:
+            refund_updated.send(
+                sender=self.order.pay.staticname, refund=self,
+                order=self.order, status=self.status)
+        return True
+
+    @classmethod
+    def precedence(cls, status):
+        return cls.STATUS_PRECEDENCE.get(status, 0)
+
+    def can_transit(self, status):
+        """退款能否由当前状态变更为status 终态不再变更"""
+        if self.status in self.TERMINAL_STATUSES:
+            return False
+        return self.precedence(status) >= self.precedence(self.status)
+
+    def _normalize(self, result):
+        """查询结果中字段以序号为后缀 取出本退款单对应的字段"""
+        if "refund_count" not in result:
+            return result
+        for i in range(int(result["refund_count"])):
+            if result.get("out_refund_no_%d" % i) == self.out_refund_no:
+                suffix = "_%d" % i
+                rv = {k[:-len(suffix)]: v for k, v in result.items()
+                      if k.endswith(suffix)}
+                rv["success_time"] = rv.pop("refund_success_time", None)
+                return rv
+        return dict()
+
+    def __str__(self):
+        return "{0} ({1})".format(self.out_refund_no, self.refund_fee)
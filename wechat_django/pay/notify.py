@@ -7,7 +7,9 @@ from __future__ import unicode_literals
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import response
 from django.utils.translation import ugettext_lazy as _
-from wechatpy.exceptions import InvalidSignatureException
+from wechatpy.exceptions import (
+    InvalidAppIdException, InvalidMchIdException, InvalidSignatureException)
+import xmltodict
 
 from wechat_django.sites.wechat import default_site, WeChatView
 from .exceptions import WeChatPayNotifyError
@@ -32,25 +34,74 @@ class NotifyView(WeChatView):
         return _("Internal server error")
 
     def post(self, request, appname, payname):
-        pay, data = self._prepare(request, payname)
-        out_trade_no = data["out_trade_no"]
-        try:
-            order = pay.orders.get(out_trade_no=out_trade_no)
-        except ObjectDoesNotExist:
+        order = self._get_order(request, payname)
+        pay, data = self._prepare(request, payname, order and order.pay)
+        if not order:
             return _("Order not found")
         data["trade_state"] = data["result_code"]
+        # 重复通知已处理的订单时不做任何写入
         order.update(data)
 
-    def _prepare(self, request, payname):
+    def _get_order(self, request, payname):
+        """以一次查询取出通知对应的订单及其商户号与订单结果,
+        签名在取得商户号后校验
+        """
+        from .models import UnifiedOrder
+
+        try:
+            out_trade_no = xmltodict.parse(request.body)["xml"]["out_trade_no"]
+        except Exception:
+            return None
+        app = request.wechat.app
+        order = UnifiedOrder.objects.select_related("pay", "result").filter(
+            pay__app=app, pay__name=payname, out_trade_no=out_trade_no
+        ).first()
+        if order:
+            order.pay.app = app
+        return order
+
+    def _prepare(self, request, payname, pay=None):
         xml = request.body
         if not xml:
             raise WeChatPayNotifyError(_("Empty body"))
 
+        if not pay:
+            try:
+                pay = request.wechat.app.pays.get(name=payname)
+            except ObjectDoesNotExist as e:
+                raise WeChatPayNotifyError(_("WeChat Pay not found"), e)
+        return pay, self._parse(pay, xml)
+
+    def _parse(self, pay, xml):
         try:
-            pay = request.wechat.app.pays.get(name=payname)
-        except ObjectDoesNotExist as e:
-            raise WeChatPayNotifyError(_("WeChat Pay not found"), e)
-        try:
-            return pay, pay.client.parse_payment_result(xml)
+            return pay.client.parse_payment_result(xml)
         except InvalidSignatureException as e:
             raise WeChatPayNotifyError(_("Invalid signature"), e)
+
+
+@default_site.register
+class RefundNotifyView(NotifyView):
+    url_pattern = r"^pay/(?P<payname>[-_a-zA-Z\d]+)/refund/notify/"
+    url_name = "refund_notify"
+
+    def post(self, request, appname, payname):
+        from .models import Refund
+
+        pay, data = self._prepare(request, payname)
+        try:
+            refund = Refund.objects.select_related("order").get(
+                order__pay=pay, out_refund_no=data["out_refund_no"])
+        except ObjectDoesNotExist:
+            return _("Refund not found")
+        refund.order.pay = pay
+        # 重复通知已处理的退款时不做任何写入
+        refund.update(data)
+
+    def _parse(self, pay, xml):
+        """解密退款通知中的req_info"""
+        try:
+            return pay.client.parse_refund_notify_result(xml)
+        except (InvalidAppIdException, InvalidMchIdException) as e:
+            raise WeChatPayNotifyError(_("Invalid signature"), e)
+        except Exception as e:
+            raise WeChatPayNotifyError(_("Invalid request"), e)
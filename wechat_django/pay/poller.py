@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""待支付订单状态轮询"""
+
+from __future__ import unicode_literals
+
+import datetime
+import time
+
+from django.db.models import Q
+from django.utils import timezone as tz
+from wechatpy.exceptions import WeChatPayException
+
+from wechat_django.utils.func import concurrent_map
+from .models import UnifiedOrder, UnifiedOrderResult
+
+
+class OrderPoller(object):
+    """并发查询待支付订单状态,每笔订单按指数退避间隔查询,
+    超过time_expire仍未支付的订单将被关闭
+
+    退避状态保存在poller实例中,长期运行时请复用同一实例
+    """
+    PENDING_STATES = (
+        UnifiedOrderResult.State.NOTPAY, UnifiedOrderResult.State.USERPAYING)
+
+    def __init__(self, pays, workers=8, base_interval=5, max_interval=600,
+                 max_age=datetime.timedelta(days=1)):
+        """
+        :param pays: 需轮询的商户号
+        :param workers: 最大并发查询数
+        :param base_interval: 首次退避间隔(秒)
+        :param max_interval: 最大退避间隔(秒)
+        :param max_age: 仅轮询该时间内创建的订单
+        """
+        self.pays = list(pays)
+        self.workers = workers
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.max_age = max_age
+        self._schedule = dict()
+
+    def pending_orders(self, pay):
+        """待支付的订单"""
+        return UnifiedOrder.objects.select_related("result").filter(
+            pay=pay, created_at__gte=tz.now() - self.max_age
+        ).filter(
+            Q(result__isnull=True)
+            | Q(result__trade_state__in=self.PENDING_STATES)
+        ).order_by("created_at")
+
+    def poll(self):
+        """轮询一次所有到期的待支付订单
+
+        :returns: dict(polled=查询数, updated=状态变化数, closed=关闭数,
+                       failed=失败数)
+        """
+        now = time.time()
+        orders = []
+        pending = set()
+        for pay in self.pays:
+            for order in self.pending_orders(pay).iterator():
+                order.pay = pay
+                pending.add(order.pk)
+                attempts, next_at = self._schedule.get(order.pk, (0, 0))
+                if next_at <= now:
+                    orders.append(order)
+        # 已离开待支付状态的订单不再记录退避状态
+        self._schedule = {
+            k: v for k, v in self._schedule.items() if k in pending}
+
+        def query(order):
+            # 单笔订单的网络错误等异常不应中断整轮轮询
+            try:
+                return order, order.pay.client.order.query(
+                    out_trade_no=order.out_trade_no), None
+            except Exception as e:
+                return order, None, e
+
+        rv = dict(polled=0, updated=0, closed=0, failed=0)
+        for order, result, exc in concurrent_map(query, orders, self.workers):
+            rv["polled"] += 1
+            logger = order.pay.app.logger("pay")
+            if not exc:
+                try:
+                    if order.update(result):
+                        rv["updated"] += 1
+                except Exception as e:
+                    # 如verify发现商户号或金额不一致
+                    exc = e
+            if exc:
+                self._log_error(
+                    logger, "poll order %s failed: %s", order, exc)
+                rv["failed"] += 1
+            elif result["trade_state"] not in self.PENDING_STATES:
+                continue
+
+            if order.time_expire and order.time_expire <= tz.now():
+                try:
+                    order.close()
+                except Exception as e:
+                    self._log_error(
+                        logger, "close order %s failed: %s", order, e)
+                    rv["failed"] += 1
+                else:
+                    rv["closed"] += 1
+                    continue
+            self._backoff(order.pk, now)
+        return rv
+
+    def run(self, interval=5, rounds=None):
+        """持续轮询
+
+        :param interval: 两轮轮询间的间隔(秒)
+        :param rounds: 轮询次数,为空时持续运行
+        """
+        while rounds is None or rounds > 0:
+            self.poll()
+            rounds = rounds and rounds - 1
+            if rounds != 0:
+                time.sleep(interval)
+
+    @staticmethod
+    def _log_error(logger, msg, order, exc):
+        """微信返回的错误记为warning 其他异常连同堆栈记为error"""
+        if isinstance(exc, WeChatPayException):
+            logger.warning(msg, order.out_trade_no, exc)
+        else:
+            exc_info = (type(exc), exc, getattr(exc, "__traceback__", None))
+            logger.error(msg, order.out_trade_no, exc, exc_info=exc_info)
+
+    def _backoff(self, pk, now):
+        attempts = self._schedule.get(pk, (0, 0))[0]
+        delay = min(self.base_interval * 2 ** attempts, self.max_interval)
+        self._schedule[pk] = (attempts + 1, now + delay)
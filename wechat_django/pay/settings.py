@@ -2,3 +2,5 @@
 from __future__ import unicode_literals
 
 from django.conf import settings
+
+CERTDIR = getattr(settings, "WECHAT_PAYCERTDIR", None)
@@ -5,3 +5,4 @@ from django.dispatch import Signal
 
 
 order_updated = Signal(["result", "order", "state", "attach"])
+refund_updated = Signal(["refund", "order", "status"])
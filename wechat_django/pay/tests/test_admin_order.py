@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from uuid import uuid4
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from ..models import UnifiedOrderResult
+from .base import WeChatPayTestCase
+
+
+class OrderAdminTestCase(WeChatPayTestCase):
+    def setUp(self):
+        super(OrderAdminTestCase, self).setUp()
+        user = User.objects.create(
+            username="admin", is_superuser=True, is_staff=True)
+        user.set_password("123456")
+        user.save()
+        self.client.login(username="admin", password="123456")
+
+    def test_changelist_queries(self):
+        """测试订单列表查询数不随订单数增长"""
+        url = reverse("admin:wechat_django_pay_unifiedorder_changelist",
+                      kwargs=dict(wechat_app_id=self.app.id))
+
+        def create_orders(count):
+            for i in range(count):
+                order = self.app.pay.create_order(
+                    body="body", out_trade_no=str(uuid4()), total_fee=101)
+                if i % 2:
+                    UnifiedOrderResult.objects.create(
+                        order=order, transaction_id=order.out_trade_no,
+                        trade_state=UnifiedOrderResult.State.SUCCESS)
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as context:
+                resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            return len(context.captured_queries)
+
+        create_orders(10)
+        # 首次请求会建立权限缓存
+        count_queries()
+        queries = count_queries()
+        create_orders(90)
+        self.assertEqual(count_queries(), queries)
@@ -4,11 +4,14 @@ from __future__ import unicode_literals
 from uuid import uuid4
 
 from django.utils import timezone as tz
+from httmock import HTTMock, response, urlmatch
 from wechatpy import WeChatPay as WeChatPayBaseClient
+from wechatpy.exceptions import WeChatPayException
 
 from wechat_django.models import WeChatUser
 from wechat_django.utils.web import get_ip
-from ..models import UnifiedOrder, UnifiedOrderResult, WeChatPay
+from ..models import (
+    OrderSummary, UnifiedOrder, UnifiedOrderResult, WeChatPay)
 from ..models.base import PayDateTimeField
 from ..signals import order_updated
 from .base import mock, WeChatPayTestCase
@@ -72,7 +75,9 @@ class OrderTestCase(WeChatPayTestCase):
         order = self.app.pay.create_order(request=request, **full)
         call_args = order.call_args(request, dt2py=True)
         self.assertEqual(call_args, order.call_args(dt2py=True))
-        _call_args = order.call_args(request)
+        # 参数未变化时不写入数据库
+        with self.assertNumQueries(0):
+            _call_args = order.call_args(request)
         self.assertEqual(_call_args, order._call_args)
         self.assertEqual(
             call_args["notify_url"],
@@ -188,18 +193,23 @@ class OrderTestCase(WeChatPayTestCase):
                     self.assertEqual(v, value)
             self.assertEqual(UnifiedOrder.verify.call_count, 1)
 
-        # 测试回调更新
+        # 测试状态未变化的回调不再写入
+        bank_type = order.result.bank_type
         result = self.notify(self.app.pay, order)
-        order.update(result)
-        for key, value in result.items():
-            if key in UnifiedOrder.ALLOW_UPDATES:
-                v = getattr(order, key)
-                v = v if v is None else str(v)
-                self.assertEqual(v, value)
-            if key in self.list_fields(UnifiedOrderResult):
-                v = getattr(order.result, key)
-                v = v if v is None else str(v)
-                self.assertEqual(v, value)
+        self.assertFalse(order.update(result))
+        self.assertEqual(
+            UnifiedOrderResult.objects.get(order=order).bank_type, bank_type)
+
+        # 测试迟到的支付成功不回退已退款订单
+        self.assertTrue(order.update(dict(
+            self.success(self.app.pay, order),
+            trade_state=UnifiedOrderResult.State.REFUND)))
+        with mock.patch.object(order_updated, "send"):
+            self.assertFalse(order.update(self.notify(self.app.pay, order)))
+            self.assertFalse(order_updated.send.called)
+        self.assertEqual(
+            UnifiedOrderResult.objects.get(order=order).trade_state,
+            UnifiedOrderResult.State.REFUND)
 
         # 测试回调更新
         order = self.app.pay.create_order(**self.minimal_example)
@@ -254,6 +264,137 @@ class OrderTestCase(WeChatPayTestCase):
             order.update(result, signal=False)
             self.assertEqual(order_updated.send.call_count, 0)
 
+        # 信号在事务外发送 接收方异常不回滚订单结果
+        def receiver(*args, **kwargs):
+            raise RuntimeError
+
+        order_updated.connect(receiver)
+        try:
+            order = self.app.pay.create_order(**self.minimal_example)
+            result = self.success(self.app.pay, order)
+            self.assertRaises(RuntimeError, order.update, result)
+            self.assertEqual(
+                UnifiedOrderResult.objects.get(order=order).trade_state,
+                UnifiedOrderResult.State.SUCCESS)
+        finally:
+            order_updated.disconnect(receiver)
+
+    def test_reconcile(self):
+        """测试以对账单核对订单"""
+        pay = self.app.pay
+        created = pay.create_order(**self.minimal_example)
+        notpay = pay.create_order(**self.minimal_example)
+        notpay.update(self.notpay(pay, notpay))
+        success = pay.create_order(**self.minimal_example)
+        success.update(self.success(pay, success))
+        mismatched = pay.create_order(**self.minimal_example)
+        refunded = pay.create_order(**self.minimal_example)
+        refunded.update(self.success(pay, refunded))
+        refunded.update(dict(
+            self.success(pay, refunded),
+            trade_state=UnifiedOrderResult.State.REFUND))
+        summaries = list(pay.order_summaries.values_list(
+            "trade_state", "count", "cash_fee"))
+
+        def row(out_trade_no, total_fee="1.01"):
+            values = (
+                "2019-06-13 19:08:54", pay.appid, pay.mch_id, "0", "",
+                out_trade_no, out_trade_no, "openid", "JSAPI", "SUCCESS",
+                "CFT", "CNY", total_fee, "0.00", "0", "0", "0.00", "0.00",
+                "", "", "body, with comma", "", "0.01000", "0.60%", total_fee, "0.00", "")
+            return ",".join("`" + v for v in values)
+
+        bill = "\r\n".join([
+            "\ufeff交易时间,公众账号ID,商户号,特约商户号,设备号,微信订单号,"
+            "商户订单号,用户标识,交易类型,交易状态,付款银行,货币种类,"
+            "应结订单金额,代金券金额,微信退款单号,商户退款单号,退款金额,"
+            "充值券退款金额,退款类型,退款状态,商品名称,商户数据包,手续费,费率,"
+            "订单金额,申请退款金额,费率备注",
+            row(created.out_trade_no),
+            row(notpay.out_trade_no),
+            row(success.out_trade_no),
+            row(mismatched.out_trade_no, "0.01"),
+            row(refunded.out_trade_no),
+            row("unknown"),
+            "总交易单数,应结订单总金额,退款总金额,充值券退款总金额,手续费总金额,"
+            "订单总金额,申请退款总金额",
+            "`5,`4.05,`0.00,`0.00,`0.05000,`4.05,`0.00"
+        ]).encode("utf-8")
+
+        @urlmatch(netloc=r"api\.mch\.weixin\.qq\.com$",
+                  path=r"/pay/downloadbill")
+        def downloadbill(url, request):
+            return response(200, bill, {"Content-Type": "text/plain"})
+
+        with HTTMock(downloadbill),\
+            mock.patch.object(order_updated, "send"):
+            report = pay.reconcile("20190613", chunk_size=2)
+            self.assertEqual(order_updated.send.call_count, 2)
+        self.assertEqual(report["total"], 6)
+        self.assertEqual(report["updated"], 2)
+        self.assertEqual(report["missing"], ["unknown"])
+        self.assertEqual(report["mismatched"], [mismatched.out_trade_no])
+
+        for order in (created, notpay):
+            result = UnifiedOrderResult.objects.get(order=order)
+            self.assertEqual(result.trade_state, UnifiedOrderResult.State.SUCCESS)
+            self.assertEqual(result.transaction_id, order.out_trade_no)
+            self.assertEqual(result.settlement_total_fee, 101)
+            self.assertEqual(result.cash_fee, 101)
+            self.assertEqual(result.time_end, PayDateTimeField.str2dt(
+                "20190613190854"))
+        # 状态一致的订单不更新
+        self.assertEqual(
+            UnifiedOrderResult.objects.get(order=success).bank_type, "CMC")
+        self.assertFalse(
+            UnifiedOrderResult.objects.filter(order=mismatched).exists())
+        # 已退款的订单不回退为支付成功
+        self.assertEqual(
+            UnifiedOrderResult.objects.get(order=refunded).trade_state,
+            UnifiedOrderResult.State.REFUND)
+        self.assertEqual(
+            pay.order_summaries.get(trade_state="REFUND").count, 1)
+        self.assertEqual(
+            pay.order_summaries.get(trade_state="SUCCESS").count,
+            dict((k, c) for k, c, _ in summaries)["SUCCESS"] + 2)
+
+        # 下载失败
+        @urlmatch(netloc=r"api\.mch\.weixin\.qq\.com$",
+                  path=r"/pay/downloadbill")
+        def nobill(url, request):
+            return response(200, "<xml><return_code><![CDATA[FAIL]]>"
+                                 "</return_code><return_msg><![CDATA[No Bill "
+                                 "Exist]]></return_msg><error_code>20002"
+                                 "</error_code></xml>")
+
+        with HTTMock(nobill):
+            self.assertRaises(
+                WeChatPayException, pay.reconcile, "20190613")
+
+    def test_summary(self):
+        """测试订单统计"""
+        pay = self.app.pay
+
+        def summary():
+            return {
+                s.trade_state: (s.count, s.total_fee, s.cash_fee)
+                for s in pay.order_summaries.all()
+            }
+
+        order = pay.create_order(**self.minimal_example)
+        order.update(self.notpay(pay, order))
+        self.assertEqual(summary(), dict(NOTPAY=(1, 101, 0)))
+
+        another = pay.create_order(**self.minimal_example)
+        another.update(self.notpay(pay, another))
+        order.update(self.success(pay, order))
+        self.assertEqual(
+            summary(), dict(NOTPAY=(1, 101, 0), SUCCESS=(1, 101, 101)))
+
+        expected = summary()
+        OrderSummary.rebuild(pay)
+        self.assertEqual(summary(), expected)
+
     def test_sync(self):
         """测试同步订单"""
         pass
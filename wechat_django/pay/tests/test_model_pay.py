@@ -73,8 +73,23 @@ class PayTestCase(WeChatPayTestCase):
             WeChatPayBaseClient._request = mock_request
             mch_cert_name, mch_key_name = cert_pay.client.order.query("1")
 
-            # 请求结束后已移除证书文件
+            # 证书文件仅当前用户可读写 且在请求间复用
+            self.assertEqual(os.stat(mch_cert_name).st_mode & 0o777, 0o600)
+            self.assertEqual(os.stat(mch_key_name).st_mode & 0o777, 0o600)
+            self.assertEqual(
+                cert_pay.client.order.query("1"),
+                (mch_cert_name, mch_key_name))
+
+            # 证书变更后写入新文件并移除旧文件
+            mch_cert = cert_pay.mch_cert = b"new_mch_cert"
+            new_cert_name, new_key_name = cert_pay.client.order.query("1")
+            self.assertNotEqual(new_cert_name, mch_cert_name)
             self.assertFalse(os.path.exists(mch_cert_name))
             self.assertFalse(os.path.exists(mch_key_name))
+
+            # 删除商户号后移除证书文件
+            cert_pay.delete()
+            self.assertFalse(os.path.exists(new_cert_name))
+            self.assertFalse(os.path.exists(new_key_name))
         finally:
             WeChatPayBaseClient._request = origin_request
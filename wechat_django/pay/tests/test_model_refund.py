@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from uuid import uuid4
+
+import requests
+from wechatpy.crypto import RefundCrypto, WeChatRefundCrypto
+from wechatpy.exceptions import WeChatPayException
+from wechatpy.pay.api import WeChatRefund
+import xmltodict
+
+from ..models import Refund
+from ..signals import refund_updated
+from .base import mock, WeChatPayTestCase
+
+
+class RefundTestCase(WeChatPayTestCase):
+    def test_apply_many(self):
+        """测试批量申请退款"""
+        pay = self.app.pay
+        refunds = [self.create_refund(pay) for i in range(3)]
+        failed = refunds[1]
+
+        def apply(**kwargs):
+            if kwargs["out_refund_no"] == failed.out_refund_no:
+                raise WeChatPayException(
+                    "SUCCESS", "FAIL", errcode="NOTENOUGH", errmsg="余额不足")
+            self.assertEqual(
+                kwargs["notify_url"],
+                pay.notify_url(urlname="refund_notify"))
+            return dict(
+                out_refund_no=kwargs["out_refund_no"],
+                refund_id=kwargs["out_refund_no"][:32],
+                refund_fee=kwargs["refund_fee"])
+
+        with mock.patch.object(WeChatRefund, "apply", side_effect=apply),\
+            mock.patch.object(refund_updated, "send"):
+            rv = pay.apply_refunds(Refund.objects.all(), workers=2)
+            self.assertEqual(rv, dict(applied=2, failed=1))
+            self.assertEqual(refund_updated.send.call_count, 3)
+
+        for refund in refunds:
+            refund.refresh_from_db()
+            if refund == failed:
+                self.assertEqual(refund.status, Refund.Status.FAIL)
+                self.assertEqual(refund.ext_info["err_code"], "NOTENOUGH")
+            else:
+                self.assertEqual(refund.status, Refund.Status.PROCESSING)
+                self.assertEqual(refund.refund_id, refund.out_refund_no[:32])
+
+    def test_sync_many(self):
+        """测试批量查询退款"""
+        pay = self.app.pay
+        success = self.create_refund(pay, status=Refund.Status.PROCESSING)
+        processing = self.create_refund(
+            pay, status=Refund.Status.PROCESSING)
+        self.create_refund(pay)
+
+        def query(out_refund_no):
+            status = "SUCCESS" if out_refund_no == success.out_refund_no\
+                else "PROCESSING"
+            return dict(
+                refund_count="1",
+                out_refund_no_0=out_refund_no,
+                refund_id_0=out_refund_no[:32],
+                refund_status_0=status,
+                refund_success_time_0="2019-06-18 22:36:14",
+                refund_recv_accout_0="支付用户的零钱")
+
+        with mock.patch.object(WeChatRefund, "query", side_effect=query):
+            rv = pay.sync_refunds(workers=2)
+        self.assertEqual(rv, dict(synced=2, updated=2, failed=0))
+        success.refresh_from_db()
+        self.assertEqual(success.status, Refund.Status.SUCCESS)
+        self.assertEqual(success.success_time, "2019-06-18 22:36:14")
+        processing.refresh_from_db()
+        self.assertEqual(processing.status, Refund.Status.PROCESSING)
+        self.assertEqual(processing.refund_id, processing.out_refund_no[:32])
+
+        # 状态未变化时不更新
+        with mock.patch.object(WeChatRefund, "query", side_effect=query):
+            rv = pay.sync_refunds(workers=2)
+        self.assertEqual(rv, dict(synced=1, updated=0, failed=0))
+
+    def test_apply_errors(self):
+        """测试申请退款结果未知"""
+        pay = self.app.pay
+        retry = self.create_refund(pay)
+        broken = self.create_refund(pay)
+        applied = self.create_refund(pay)
+
+        def apply(**kwargs):
+            if kwargs["out_refund_no"] == retry.out_refund_no:
+                raise WeChatPayException(
+                    "SUCCESS", "FAIL", errcode="SYSTEMERROR", errmsg="系统超时")
+            if kwargs["out_refund_no"] == broken.out_refund_no:
+                raise requests.ConnectionError("connection reset")
+            return dict(
+                out_refund_no=kwargs["out_refund_no"],
+                refund_id=kwargs["out_refund_no"][:32])
+
+        with mock.patch.object(WeChatRefund, "apply", side_effect=apply):
+            rv = pay.apply_refunds(Refund.objects.all(), workers=2)
+        self.assertEqual(rv, dict(applied=1, failed=2))
+
+        # 结果未知的退款不记为失败 由查询确认
+        retry.refresh_from_db()
+        self.assertEqual(retry.status, Refund.Status.PROCESSING)
+        self.assertEqual(retry.ext_info["err_code"], "SYSTEMERROR")
+        broken.refresh_from_db()
+        self.assertEqual(broken.status, Refund.Status.PROCESSING)
+
+        def query(out_refund_no):
+            if out_refund_no == broken.out_refund_no:
+                raise requests.ConnectionError("connection reset")
+            return dict(
+                refund_count="1",
+                out_refund_no_0=out_refund_no,
+                refund_id_0=out_refund_no[:32],
+                refund_status_0="SUCCESS")
+
+        with mock.patch.object(WeChatRefund, "query", side_effect=query):
+            rv = pay.sync_refunds(workers=2)
+        self.assertEqual(rv, dict(synced=3, updated=2, failed=1))
+        retry.refresh_from_db()
+        self.assertEqual(retry.status, Refund.Status.SUCCESS)
+        self.assertEqual(retry.refund_id, retry.out_refund_no[:32])
+
+    def test_update(self):
+        """测试退款状态流转"""
+        pay = self.app.pay
+        refund = self.create_refund(pay, status=Refund.Status.PROCESSING)
+
+        with mock.patch.object(refund_updated, "send"):
+            self.assertTrue(refund.update(dict(
+                refund_status="SUCCESS", refund_id="refund_id")))
+            # 迟到的查询结果不回退终态
+            stale = Refund.objects.get(pk=refund.pk)
+            stale.status = Refund.Status.PENDING
+            self.assertFalse(stale.update(dict(
+                refund_status="PROCESSING", refund_id="refund_id")))
+            self.assertFalse(refund.update(dict(
+                refund_status="CHANGE", refund_id="refund_id")))
+            self.assertEqual(refund_updated.send.call_count, 1)
+        refund.refresh_from_db()
+        self.assertEqual(refund.status, Refund.Status.SUCCESS)
+
+        # 处理中的退款不因明确拒绝以外的错误记为失败
+        refund = self.create_refund(pay, status=Refund.Status.PROCESSING)
+        with mock.patch.object(refund_updated, "send"):
+            self.assertFalse(refund.update(dict(refund_status="FAIL")))
+        refund.refresh_from_db()
+        self.assertEqual(refund.status, Refund.Status.PROCESSING)
+
+    def test_notify(self):
+        """测试退款结果通知"""
+        pay = self.app.pay
+        refund = self.create_refund(pay, status=Refund.Status.PROCESSING)
+        req_info = xmltodict.unparse(dict(root=dict(
+            out_trade_no=refund.order.out_trade_no,
+            out_refund_no=refund.out_refund_no,
+            refund_id="refund_id",
+            total_fee="101",
+            refund_fee="101",
+            settlement_refund_fee="101",
+            refund_status="SUCCESS",
+            success_time="2019-06-18 22:36:14",
+            refund_recv_accout="支付用户的零钱"
+        )), full_document=False)
+        key = WeChatRefundCrypto(pay.api_key).key
+        xml = xmltodict.unparse(dict(xml=dict(
+            return_code="SUCCESS",
+            appid=pay.appid,
+            mch_id=pay.mch_id,
+            nonce_str="nonce_str",
+            req_info=RefundCrypto(key).encrypt(req_info)
+        )))
+
+        url = self.app.build_url(
+            "refund_notify", kwargs=dict(payname=pay.name))
+        with mock.patch.object(refund_updated, "send"):
+            for i in range(2):
+                resp = self.client.post(
+                    url, data=xml, content_type="text/xml")
+                data = xmltodict.parse(resp.content)["xml"]
+                self.assertEqual(data["return_code"], "SUCCESS")
+            # 重复通知不重复处理
+            self.assertEqual(refund_updated.send.call_count, 1)
+        refund.refresh_from_db()
+        self.assertEqual(refund.status, Refund.Status.SUCCESS)
+        self.assertEqual(refund.refund_id, "refund_id")
+        self.assertEqual(refund.settlement_refund_fee, 101)
+
+        # 无法解密
+        xml = xml.replace(pay.appid, "another")
+        resp = self.client.post(url, data=xml, content_type="text/xml")
+        data = xmltodict.parse(resp.content)["xml"]
+        self.assertEqual(data["return_code"], "FAIL")
+
+    def create_refund(self, pay, **kwargs):
+        order = pay.create_order(
+            body="body", out_trade_no=str(uuid4()), total_fee=101)
+        return order.refunds.create(refund_fee=101, **kwargs)
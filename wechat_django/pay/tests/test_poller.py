@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import time
+from uuid import uuid4
+
+from django.utils import timezone as tz
+import requests
+from wechatpy.pay.api import WeChatOrder
+
+from ..models import UnifiedOrderResult
+from ..poller import OrderPoller
+from .base import mock, WeChatPayTestCase
+
+
+class PollerTestCase(WeChatPayTestCase):
+    def test_poll(self):
+        """测试轮询待支付订单"""
+        pay = self.app.pay
+        paid = self.create_order(pay)
+        pending = self.create_order(pay)
+        expired = self.create_order(
+            pay, time_expire=tz.now() - datetime.timedelta(minutes=1))
+        success = self.create_order(pay)
+        success.update(self.result(pay, success.out_trade_no, "SUCCESS"))
+
+        states = {
+            paid.out_trade_no: "SUCCESS",
+            pending.out_trade_no: "NOTPAY",
+            expired.out_trade_no: "NOTPAY"
+        }
+
+        def query(out_trade_no):
+            return self.result(pay, out_trade_no, states[out_trade_no])
+
+        def close(out_trade_no):
+            states[out_trade_no] = "CLOSED"
+
+        poller = OrderPoller([pay], workers=2)
+        with mock.patch.object(WeChatOrder, "query", side_effect=query),\
+            mock.patch.object(WeChatOrder, "close", side_effect=close):
+            rv = poller.poll()
+            self.assertEqual(
+                rv, dict(polled=3, updated=3, closed=1, failed=0))
+            for order, state in ((paid, "SUCCESS"), (pending, "NOTPAY"),
+                                 (expired, "CLOSED")):
+                self.assertEqual(
+                    UnifiedOrderResult.objects.get(order=order).trade_state,
+                    state)
+            WeChatOrder.close.assert_called_once_with(
+                out_trade_no=expired.out_trade_no)
+
+            # 退避期内不重复查询
+            rv = poller.poll()
+            self.assertEqual(rv["polled"], 0)
+            self.assertEqual(WeChatOrder.query.call_count, 4)
+
+            # 退避期后再次查询
+            now = time.time()
+            with mock.patch("time.time", return_value=now + 6):
+                rv = poller.poll()
+            self.assertEqual(rv["polled"], 1)
+            self.assertEqual(rv["updated"], 0)
+
+    def test_poll_errors(self):
+        """测试单笔订单异常不中断轮询"""
+        pay = self.app.pay
+        broken = self.create_order(pay)
+        mismatched = self.create_order(pay)
+        paid = self.create_order(pay)
+
+        def query(out_trade_no):
+            if out_trade_no == broken.out_trade_no:
+                raise requests.ConnectionError()
+            rv = self.result(pay, out_trade_no, "SUCCESS")
+            if out_trade_no == mismatched.out_trade_no:
+                rv["total_fee"] = "1"
+            return rv
+
+        poller = OrderPoller([pay], workers=2)
+        with mock.patch.object(WeChatOrder, "query", side_effect=query):
+            rv = poller.poll()
+        self.assertEqual(rv, dict(polled=3, updated=1, closed=0, failed=2))
+        self.assertEqual(
+            UnifiedOrderResult.objects.get(order=paid).trade_state,
+            "SUCCESS")
+        # 失败的订单同样退避
+        self.assertEqual(
+            set(poller._schedule), {broken.pk, mismatched.pk})
+
+    def create_order(self, pay, **kwargs):
+        return pay.create_order(
+            body="body", out_trade_no=str(uuid4()), total_fee=101, **kwargs)
+
+    def result(self, pay, out_trade_no, trade_state):
+        rv = {
+            "return_code": "SUCCESS",
+            "result_code": "SUCCESS",
+            "appid": pay.appid,
+            "mch_id": pay.mch_id,
+            "out_trade_no": out_trade_no,
+            "total_fee": "101",
+            "trade_state": trade_state
+        }
+        if trade_state == "SUCCESS":
+            rv["transaction_id"] = out_trade_no
+        return rv
@@ -9,6 +9,7 @@ from wechat_django.sites.wechat import default_site
 from ..exceptions import WeChatPayNotifyError
 from ..models import UnifiedOrderResult
 from ..notify import NotifyView
+from ..signals import order_updated
 from .base import mock, WeChatPayTestCase
 
 
@@ -76,6 +77,33 @@ class NotifyTestCase(WeChatPayTestCase):
         self.assertEqual(
             order.result.trade_state, UnifiedOrderResult.State.SUCCESS)
 
+    def test_repeated_notify(self):
+        """测试重复通知不重复写入"""
+        url = self.app.build_url(
+            "order_notify", kwargs=dict(payname=self.app.pay.name))
+        order = self.app.pay.create_order(**self.minimal_example)
+        xml = self.success_order_notify(self.app.pay, order)
+
+        view = NotifyView()
+        request = self.rf().post(
+            url, data=xml, content_type="text/xml")
+        request = view.initialize_request(request, appname=self.app.name)
+        with mock.patch("wechatpy.pay.calculate_signature") as m,\
+            mock.patch.object(order_updated, "send"):
+            m.return_value = self.sign
+            view.post(request, self.app.name, self.app.pay.name)
+            self.assertEqual(order_updated.send.call_count, 1)
+            updated_at = UnifiedOrderResult.objects.get(
+                order=order).updated_at
+
+            # 订单及结果由一次查询取出 状态未变化时不写入也不发信号
+            with self.assertNumQueries(1):
+                view.post(request, self.app.name, self.app.pay.name)
+            self.assertEqual(order_updated.send.call_count, 1)
+            self.assertEqual(
+                UnifiedOrderResult.objects.get(order=order).updated_at,
+                updated_at)
+
     @property
     def minimal_example(self):
         return dict(
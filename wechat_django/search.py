@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""消息日志搜索后端
+
+通过WECHAT_MESSAGELOGSEARCH配置,后端依据MessageLog.text列检索消息文本
+"""
+
+from __future__ import unicode_literals
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from . import settings
+
+
+class MessageLogSearchBackend(object):
+    def q(self, keyword):
+        """返回筛选包含keyword的消息日志的Q对象
+        :rtype: django.db.models.Q
+        """
+        raise NotImplementedError()
+
+    def index(self, logs):
+        """记录日志时建立索引
+        :type logs: list of wechat_django.models.MessageLog
+        """
+        pass
+
+    def remove(self, ids):
+        """删除日志时移除索引"""
+        pass
+
+
+class ContainsSearchBackend(MessageLogSearchBackend):
+    """在text列上做包含查询"""
+    def q(self, keyword):
+        return Q(text__icontains=keyword)
+
+
+class PostgresSearchBackend(ContainsSearchBackend):
+    """PostgreSQL下以pg_trgm索引加速的包含查询
+
+    全文检索的分词配置不能切分中文,故不使用text__search;
+    迁移会在UPPER(text)上建立gin_trgm_ops索引(需pg_trgm扩展),
+    icontains生成的UPPER(text) LIKE查询可直接使用该索引,
+    检索词不足3个字符时索引无法过滤,退化为顺序扫描
+    """
+
+
+class SQLiteFTSSearchBackend(MessageLogSearchBackend):
+    """SQLite FTS5全文检索 以trigram分词支持中文子串检索,需SQLite 3.34以上
+
+    索引表及同步索引的触发器由迁移建立,无需另行维护索引;
+    trigram分词无法匹配不足3个字符的检索词,此时退化为包含查询,
+    迁移未能建立索引表时同样退化为包含查询
+    """
+    table = "wechat_django_messagelog_fts"
+    min_length = 3
+
+    def __init__(self):
+        self._available = None
+
+    def q(self, keyword):
+        if len(keyword) < self.min_length or not self.available:
+            return Q(text__icontains=keyword)
+        keyword = '"{0}"'.format(keyword.replace('"', '""'))
+        return Q(id__in=RawSQL(
+            "SELECT rowid FROM {0} WHERE text MATCH %s".format(self.table),
+            (keyword,)))
+
+    @property
+    def available(self):
+        if self._available is None:
+            self._available = self.table in connection.introspection\
+                .table_names()
+        return self._available
+
+
+_backend = None
+
+
+def get_search_backend():
+    """:rtype: MessageLogSearchBackend"""
+    global _backend
+    if not _backend:
+        _backend = import_string(settings.MESSAGELOGSEARCH)()
+    return _backend
@@ -14,3 +14,14 @@ SESSIONSTORAGE = getattr(
 MESSAGETIMEOFFSET = getattr(settings, "WECHAT_MESSAGETIMEOFFSET", 180)
 
 MESSAGENOREPEATNONCE = getattr(settings, "WECHAT_MESSAGENOREPEATNONCE", True)
+
+PERMISSIONCACHETIMEOUT = getattr(settings, "WECHAT_PERMISSIONCACHETIMEOUT", 60)
+
+MESSAGELOGSEARCH = getattr(
+    settings, "WECHAT_MESSAGELOGSEARCH",
+    "wechat_django.search.ContainsSearchBackend")
+
+MATERIALSTORAGE = getattr(settings, "WECHAT_MATERIALSTORAGE", None)
+
+MATERIALCACHESIZE = getattr(
+    settings, "WECHAT_MATERIALCACHESIZE", 512*1024*1024)
@@ -3,9 +3,13 @@ from __future__ import unicode_literals
 
 from contextlib import contextmanager
 from functools import wraps
+import hashlib
+import uuid
 
 from django.conf.urls import include, url
 from django.contrib import admin
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
 from django.http import response
 from django.urls import NoReverseMatch, resolve, Resolver404, reverse
 from django.utils.translation import ugettext_lazy as _
@@ -18,6 +22,48 @@ from ..models.permission import get_user_permissions
 from .wechat import default_site as default_wechat_site
 
 
+APPS_VERSION_KEY = "wechat_django:admin:apps:version"
+VISIBLE_APPS_CACHE_KEY = "wechat_django:admin:visibleapps:{version}:{key}"
+APPS_CACHE_TIMEOUT = 300
+
+
+def get_apps_version():
+    version = cache.get(APPS_VERSION_KEY)
+    if not version:
+        version = expire_apps()
+    return version
+
+
+def expire_apps():
+    """使后台缓存的公众号列表失效"""
+    version = uuid.uuid4().hex
+    cache.set(APPS_VERSION_KEY, version, None)
+    return version
+
+
+def on_app_changed(sender, *args, **kwargs):
+    expire_apps()
+
+
+_watched_models = set()
+
+
+def watch_app_model(model):
+    """公众号模型(或其代理类)变动时使公众号列表失效
+
+    仅监听指定模型 避免每次保存任意模型都执行失效判断
+    """
+    if model in _watched_models:
+        return
+    uid = "wechat_django.admin.apps:" + model._meta.label
+    post_save.connect(on_app_changed, sender=model, dispatch_uid=uid)
+    post_delete.connect(on_app_changed, sender=model, dispatch_uid=uid)
+    _watched_models.add(model)
+
+
+watch_app_model(WeChatApp)
+
+
 def wechat_admin_view(view, site):
     """装饰WeChatAdmin中的view
     在请求上附上WeChatApp实例
@@ -68,9 +114,8 @@ def wechat_admin_view(view, site):
             return correct_url(request, object_id)
 
         extra_context = kwargs.pop("extra_context", None) or {}
-        try:
-            app = site.wechat_site.get_app_queryset().get(id=app_id)
-        except WeChatApp.DoesNotExist:
+        app = site.get_app(app_id)
+        if not app:
             return response.HttpResponseNotFound()
 
         # 附上app
@@ -104,6 +149,45 @@ class WeChatAdminSiteMixin(CustomObjectToolAdminSiteMixin):
         """
         return self._default_wechat_site
 
+    def get_app(self, app_id):
+        """后台使用的公众号实例 含密钥及配置,每次由数据库读取
+
+        :rtype: wechat_django.models.WeChatApp
+        """
+        try:
+            return self.wechat_site.get_app_queryset().get(id=app_id)
+        except WeChatApp.DoesNotExist:
+            return None
+
+    def get_visible_apps(self, request):
+        """用户在后台可见的公众号 [(id, name, title)]
+
+        按用户有权限的公众号名集合缓存,权限或公众号变动时失效;
+        仅缓存列表所需的字段,本地内存缓存下其他进程最长APPS_CACHE_TIMEOUT秒
+        后更新
+        """
+        if request.user.is_superuser:
+            allowed_apps = None
+            scope = "*"
+        else:
+            perms = get_user_permissions(request.user)
+            allowed_apps = sorted(
+                k for k, ps in perms.items() if ps != {"manage"})
+            scope = "|".join(allowed_apps)
+        queryset = self.wechat_site.get_app_queryset()
+        watch_app_model(queryset.model)
+        scope = "{0}:{1}".format(queryset.model._meta.label, scope)
+        key = VISIBLE_APPS_CACHE_KEY.format(
+            version=get_apps_version(),
+            key=hashlib.md5(scope.encode("utf-8")).hexdigest())
+        rv = cache.get(key)
+        if rv is None:
+            if allowed_apps is not None:
+                queryset = queryset.filter(name__in=allowed_apps)
+            rv = [(app.id, app.name, str(app)) for app in queryset.all()]
+            cache.set(key, rv, APPS_CACHE_TIMEOUT)
+        return rv
+
     @contextmanager
     def _unregister_wechatadmins(self):
         """暂时取消注册wechat-django相关的modeladmin以进行一些操作"""
@@ -177,20 +261,13 @@ class WeChatAdminSiteMixin(CustomObjectToolAdminSiteMixin):
         app_label = WeChatApp._meta.app_label
 
         # 过滤有权限的app
-        query = self.wechat_site.get_app_queryset()
-        if not request.user.is_superuser:
-            perms = get_user_permissions(request.user)
-            allowed_apps = {
-                k for k, ps in perms.items() if ps != {"manage"}
-            }
-            query = query.filter(name__in=allowed_apps)
-        apps = query.all()
+        apps = self.get_visible_apps(request)
 
         # 构建app_dict
         app_perms = [
             dict(
-                name=str(app),
-                object_name=app.name,
+                name=title,
+                object_name=name,
                 perms=dict(
                     change=True,
                 ),
@@ -198,12 +275,12 @@ class WeChatAdminSiteMixin(CustomObjectToolAdminSiteMixin):
                     "admin:wechat_funcs_list",
                     current_app=self.name,
                     kwargs=dict(
-                        wechat_app_id=app.id,
+                        wechat_app_id=id,
                         app_label=app_label
                     )
                 )
             )
-            for app in apps
+            for id, name, title in apps
         ]
         return {
             'name': WeChatApp._meta.verbose_name_plural,
@@ -1,23 +1,37 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import re
+
 from django.http import response
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 import requests
 from wechatpy.constants import WeChatErrorCode
 from wechatpy.exceptions import WeChatClientException
 
+from ...materialcache import get_material_cache
 from .base import wechat_view
 from .sites import default_site
 
 
+CHUNK_SIZE = 8192
+
+
 @default_site.register
 @wechat_view(r"^materials/(?P<media_id>[-_a-zA-Z\d]+)$",
              name="material_proxy")
 def material_proxy(request, appname, media_id):
     """代理下载微信的素材"""
     app = request.wechat.app
+    material_cache = get_material_cache()
+    if material_cache:
+        info, file = material_cache.get(app, media_id)
+        if info:
+            return cached_material_response(request, info, file)
+
     try:
-        resp = app.client.material.get(media_id)
+        resp = app.client.material.get_stream(media_id)
     except WeChatClientException as e:
         if e.errcode == WeChatErrorCode.INVALID_MEDIA_ID:
             return response.HttpResponseNotFound()
@@ -29,8 +43,113 @@ def material_proxy(request, appname, media_id):
         # 暂时只处理image和voice
         return response.HttpResponseNotFound()
 
-    rv = response.FileResponse(resp.content)
-    for k, v in resp.headers.items():
-        if k.lower().startswith("content-"):
-            rv[k] = v
+    # 内容已由requests解码 不转发content-encoding
+    headers = {
+        k: v for k, v in resp.headers.items()
+        if k.lower().startswith("content-")
+        and k.lower() not in (
+            "content-length", "content-range", "content-encoding")
+    }
+    if material_cache:
+        try:
+            info = material_cache.set(
+                app, media_id, resp.iter_content(CHUNK_SIZE), headers)
+        finally:
+            resp.close()
+        file = material_cache.open(info)
+        if file:
+            return cached_material_response(request, info, file)
+        # 素材大于缓存容量被立即淘汰 重新下载转发
+        resp = app.client.material.get_stream(media_id)
+    rv = response.StreamingHttpResponse(iter_response(resp))
+    for k, v in headers.items():
+        rv[k] = v
+    return rv
+
+
+def cached_material_response(request, info, file):
+    """以缓存的素材响应 支持条件请求及单段Range请求"""
+    etag = quote_etag(info["etag"])
+    last_modified = int(info["modified"])
+    rv = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if rv is not None:
+        file.close()
+        rv["ETag"] = etag
+        rv["Last-Modified"] = http_date(last_modified)
+        return rv
+
+    size = info["size"]
+    byte_range = parse_range(request.META.get("HTTP_RANGE"), size)
+    if byte_range is False:
+        file.close()
+        rv = response.HttpResponse(status=416)
+        rv["Content-Range"] = "bytes */{0}".format(size)
+        return rv
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if byte_range and if_range and if_range != etag:
+        byte_range = None
+
+    if byte_range:
+        start, end = byte_range
+        file.seek(start)
+        rv = response.StreamingHttpResponse(
+            iter_file(file, end - start + 1), status=206)
+        rv["Content-Range"] = "bytes {0}-{1}/{2}".format(start, end, size)
+        rv["Content-Length"] = str(end - start + 1)
+    else:
+        rv = response.FileResponse(file)
+        rv["Content-Length"] = str(size)
+    for k, v in info["headers"].items():
+        rv[k] = v
+    rv["Accept-Ranges"] = "bytes"
+    rv["ETag"] = etag
+    rv["Last-Modified"] = http_date(last_modified)
     return rv
+
+
+def parse_range(header, size):
+    """解析单段Range头
+
+    :returns: (start, end) 无需分段或Range头无效时返回None,
+              无法满足时返回False
+    """
+    match = header and re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # 最后n字节
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        if end and int(end) < start:
+            # 语法无效的Range 按RFC 7233忽略
+            return None
+        end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def iter_response(resp, chunk_size=CHUNK_SIZE):
+    """转发上游响应 响应关闭时关闭上游连接"""
+    try:
+        for chunk in resp.iter_content(chunk_size):
+            yield chunk
+    finally:
+        resp.close()
+
+
+def iter_file(file, length, chunk_size=CHUNK_SIZE):
+    try:
+        while length > 0:
+            data = file.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file.close()
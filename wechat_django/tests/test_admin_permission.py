@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import shutil
+import tempfile
 from uuid import uuid4 as uuid
 
 from django.contrib.admin import site
-from django.contrib.auth.models import ContentType, Permission, User
+from django.contrib.auth.models import (
+    ContentType, Group, Permission, User)
+from django.test import override_settings
 from django.urls import ResolverMatch
 
 from ..models import permission as pm, WeChatApp
 from ..pay.admin.payapp import WeChatPayInline, WeChatAppWithPayAdmin
 from ..pay.models.app import WeChatPay
-from .base import WeChatTestCase
+from .base import mock, WeChatTestCase
 
 
 class PermissionTestCase(WeChatTestCase):
@@ -29,6 +33,98 @@ class PermissionTestCase(WeChatTestCase):
         # 测试组授权
         pass
 
+    def test_sync_perms(self):
+        """测试批量补全权限"""
+        apps = [
+            WeChatApp.objects.create(
+                title="sync{0}".format(i), name="sync{0}".format(i),
+                appid="sync{0}".format(i), appsecret="secret")
+            for i in range(5)]
+        content_type = ContentType.objects.get_for_model(WeChatApp)
+        perms = Permission.objects.filter(content_type=content_type)
+        expected = set()
+        for app in apps:
+            expected.update(pm.list_perm_names(app))
+        self.assertTrue(expected.issubset(
+            set(perms.values_list("codename", flat=True))))
+
+        # 缺失及名称有误的权限
+        perms.filter(codename=pm.get_perm_name(apps[0], "menu")).delete()
+        perms.filter(codename=pm.get_perm_name(apps[1], "user")).update(
+            name="wrong")
+        perms.filter(codename__in=pm.get_perm_names(
+            apps[2], ("menu", "user"))).delete()
+        with self.assertNumQueries(5):
+            # 查询,插入,更新各一次 另有savepoint两次
+            self.assertEqual(
+                pm.sync_perms(apps, ("menu", "user")), (3, 1))
+        self.assertTrue(expected.issubset(
+            set(perms.values_list("codename", flat=True))))
+        self.assertEqual(
+            perms.get(codename=pm.get_perm_name(apps[1], "user")).name,
+            pm.get_perm_desc(pm.get_perm_name(apps[1], "user"), apps[1]))
+        # 无需写入时仅查询一次 且不使权限缓存失效
+        with mock.patch.object(pm, "expire_permissions"),\
+            self.assertNumQueries(1):
+            self.assertEqual(pm.sync_perms(apps), (0, 0))
+            self.assertFalse(pm.expire_permissions.called)
+
+    def test_permissions_cache(self):
+        """测试用户权限缓存及失效"""
+        # 本地内存缓存不能跨进程失效 不跨请求缓存
+        user = self._create_user(pm.get_perm_name(self.app, "menu"))
+        pm.get_user_permissions(User(pk=user.pk), self.app)
+        with self.assertNumQueries(2):
+            pm.get_user_permissions(User(pk=user.pk), self.app)
+
+        path = tempfile.mkdtemp()
+        try:
+            with override_settings(CACHES=dict(default=dict(
+                BACKEND="django.core.cache.backends.filebased.FileBasedCache",
+                LOCATION=path))):
+                self._test_shared_permissions_cache()
+        finally:
+            shutil.rmtree(path)
+
+    def _test_shared_permissions_cache(self):
+        user = self._create_user(pm.get_perm_name(self.app, "menu"))
+        user = User.objects.get(pk=user.pk)
+        self.assertEqual(pm.get_user_permissions(user, self.app), {"menu"})
+        # 同一请求内不再查询
+        with self.assertNumQueries(0):
+            pm.get_user_permissions(user, self.app)
+            pm.get_user_permissions(user)
+        # 新请求由缓存读取
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                pm.get_user_permissions(User(pk=user.pk), self.app), {"menu"})
+
+        # 用户权限变动
+        user.user_permissions.add(
+            pm.get_perm_model(pm.get_perm_name(self.app, "user")))
+        self.assertEqual(
+            pm.get_user_permissions(User.objects.get(pk=user.pk), self.app),
+            {"menu", "user"})
+
+        # 组权限变动
+        group = Group.objects.create(name="group")
+        user.groups.add(group)
+        self.assertEqual(
+            pm.get_user_permissions(User.objects.get(pk=user.pk), self.app),
+            {"menu", "user"})
+        group.permissions.add(
+            pm.get_perm_model(pm.get_perm_name(self.app, "template")))
+        self.assertEqual(
+            pm.get_user_permissions(User.objects.get(pk=user.pk), self.app),
+            {"menu", "user", "template"})
+
+        # 超级用户
+        user.is_superuser = True
+        user.save()
+        self.assertEqual(
+            pm.get_user_permissions(User.objects.get(pk=user.pk), self.app),
+            set(pm.permissions.keys()))
+
     def test_index_menu(self):
         """测试首页菜单权限"""
         def assertMenuCorrect(perm_name, manage=False, apps=None):
@@ -2,6 +2,8 @@
 from __future__ import unicode_literals
 
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from wechatpy.client import api
 
@@ -130,6 +132,79 @@ class AdminViewTestCase(WeChatTestCase):
         self.assertModelViewSuccess(
             models.MessageLog, log.id, status={"add": 403})
 
+    def test_keyset_changelist(self):
+        """测试消息日志列表不COUNT并按游标翻页"""
+        from ..admin.views.messagelog import MessageLogAdmin
+
+        user = models.WeChatUser.objects.create(app=self.app, openid="openid")
+        logs = [
+            models.MessageLog.objects.create(
+                app=self.app, user=user, content={},
+                type=models.Rule.ReceiveMsgType.TEXT)
+            for i in range(5)]
+        # 同一时间的日志以主键区分先后
+        models.MessageLog.objects.filter(pk__in=[o.pk for o in logs]).update(
+            created_at=logs[0].created_at)
+        url = reverse("admin:wechat_django_messagelog_changelist", kwargs=dict(
+            wechat_app_id=self.app.id))
+
+        pages = []
+        second_page = None
+        with mock.patch.object(MessageLogAdmin, "list_per_page", 2):
+            while url:
+                with CaptureQueriesContext(connection) as context:
+                    resp = self.client.get(url)
+                self.assertSuccess(resp)
+                self.assertFalse(any(
+                    "COUNT(" in query["sql"]
+                    and "wechat_django_messagelog" in query["sql"]
+                    for query in context))
+                cl = resp.context["cl"]
+                pages.append([o.pk for o in cl.result_list])
+                url = cl.next_url and url.split("?")[0] + cl.next_url
+                second_page = second_page or url
+        expected = [o.pk for o in reversed(logs)]
+        self.assertEqual(pages, [expected[:2], expected[2:4], expected[4:]])
+
+        # 翻页后的筛选链接及搜索表单不带游标
+        with mock.patch.object(MessageLogAdmin, "list_per_page", 2):
+            resp = self.client.get(second_page)
+        self.assertSuccess(resp)
+        cl = resp.context["cl"]
+        self.assertNotIn(
+            "cursor", cl.get_query_string({"type__exact": "text"}))
+        content = resp.content.decode("utf-8")
+        self.assertIn("type__exact=text", content)
+        self.assertNotIn("cursor=", content.split('class="paginator"')[0])
+        self.assertNotIn('name="cursor"', content)
+
+        # 搜索结果不显示易误解为总数的条数
+        with mock.patch.object(MessageLogAdmin, "list_per_page", 2):
+            resp = self.client.get(
+                second_page.split("?")[0], dict(q="openid"))
+        self.assertSuccess(resp)
+        self.assertNotIn("2 results", resp.content.decode("utf-8"))
+
+        # 按用户昵称搜索
+        user.nickname = "nickname"
+        user.save()
+        with mock.patch.object(MessageLogAdmin, "list_per_page", 2):
+            resp = self.client.get(
+                second_page.split("?")[0], dict(q="nickname"))
+        self.assertSuccess(resp)
+        self.assertEqual(len(resp.context["cl"].result_list), 2)
+
+        # 点击列排序时退化为offset翻页
+        url = reverse("admin:wechat_django_messagelog_changelist", kwargs=dict(
+            wechat_app_id=self.app.id))
+        with mock.patch.object(MessageLogAdmin, "list_per_page", 2):
+            resp = self.client.get(url, dict(o="-1", p="1"))
+        self.assertSuccess(resp)
+        cl = resp.context["cl"]
+        self.assertEqual(len(cl.result_list), 2)
+        self.assertTrue(cl.prev_url)
+        self.assertTrue(cl.next_url)
+
     def test_user_view(self):
         """测试用户"""
         self.assertModelViewSuccess(
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from ..models import Article, Material
 from .base import WeChatTestCase
 
 
@@ -8,3 +9,33 @@ class ArticleTestCase(WeChatTestCase):
     def test_sync(self):
         """测试同步图文"""
         pass
+
+    def test_articles_json(self):
+        """测试批量补全图文封面"""
+        news = Material.objects.create(
+            app=self.app, type=Material.Type.NEWS, media_id="news")
+        for i in range(5):
+            Material.objects.create(
+                app=self.app, type=Material.Type.IMAGE,
+                media_id="thumb{0}".format(i), url="url{0}".format(i))
+            Article.objects.create(
+                material=news, index=i, title="title{0}".format(i),
+                thumb_media_id="thumb{0}".format(i), url="article{0}".format(i))
+        Article.objects.create(
+            material=news, index=5, title="title5",
+            thumb_media_id="missing", url="article5")
+
+        # 查询图文 查询封面 写入封面
+        news = Material.objects.get(pk=news.pk)
+        with self.assertNumQueries(3):
+            articles = news.articles_json
+        self.assertEqual(
+            [o["image"] for o in articles],
+            ["url{0}".format(i) for i in range(5)] + [None])
+        self.assertEqual(
+            list(news.articles.values_list("_thumb_url", flat=True)),
+            ["url{0}".format(i) for i in range(5)] + [None])
+
+        # 已补全的封面不再查询素材
+        with self.assertNumQueries(2):
+            news.articles_json
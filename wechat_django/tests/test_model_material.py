@@ -1,10 +1,154 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from .base import WeChatTestCase
+from httmock import response, urlmatch, HTTMock
+from wechatpy.client.api import WeChatMaterial
+
+from ..models import Article, Material
+from .base import mock, WeChatTestCase
+from .interceptors import wechatapi, wechatapi_accesstoken
 
 
 class MaterialTestCase(WeChatTestCase):
     def test_sync(self):
         """测试同步素材"""
-        pass
+        images = [
+            dict(media_id="image{0}".format(i), name="image{0}".format(i),
+                 url="url{0}".format(i), update_time=100 - i)
+            for i in range(30)]
+        with mock.patch.object(WeChatMaterial, "batchget") as batchget:
+            batchget.side_effect = self.batchget(images)
+            materials = Material.sync_type(self.app, Material.Type.IMAGE)
+            self.assertEqual(len(materials), 30)
+            self.assertEqual(batchget.call_count, 2)
+            self.assertEqual(
+                set(self.app.materials.values_list("media_id", flat=True)),
+                {o["media_id"] for o in images})
+
+            # 增量同步遇到更早的素材即停止翻页
+            images = [
+                dict(media_id="new", name="new", url="new", update_time=101),
+                dict(images[0], name="changed")
+            ] + images[1:]
+            batchget.reset_mock()
+            batchget.side_effect = self.batchget(images)
+            materials = Material.sync_type(
+                self.app, Material.Type.IMAGE, incremental=True)
+            self.assertEqual(batchget.call_count, 1)
+            self.assertEqual(
+                [o.media_id for o in materials], ["new", "image0"])
+            self.assertEqual(
+                self.app.materials.get(media_id="image0").name, "changed")
+            self.assertEqual(self.app.materials.count(), 31)
+
+            # 全量同步删除微信上已删除的素材
+            images = images[:10]
+            batchget.side_effect = self.batchget(images)
+            with mock.patch.object(WeChatMaterial, "delete"):
+                Material.sync_type(self.app, Material.Type.IMAGE)
+            self.assertEqual(self.app.materials.count(), 10)
+
+    def test_iter_materials(self):
+        """测试并发分页拉取素材"""
+        images = [
+            dict(media_id="image{0}".format(i), update_time=1000 - i)
+            for i in range(95)]
+        with mock.patch.object(WeChatMaterial, "batchget") as batchget:
+            batchget.side_effect = self.batchget(images)
+            pages = list(Material.iter_materials(
+                self.app, Material.Type.IMAGE, workers=4))
+            self.assertEqual([len(page) for page in pages], [20] * 4 + [15])
+            self.assertEqual(
+                [item for page in pages for item in page], images)
+            self.assertEqual(
+                sorted(call[1]["offset"] for call in batchget.call_args_list),
+                [0, 20, 40, 60, 80])
+
+            materials = Material.sync_type(
+                self.app, Material.Type.IMAGE, workers=4)
+            self.assertEqual(
+                [o.media_id for o in materials],
+                [o["media_id"] for o in images])
+
+    def test_sync_news(self):
+        """测试同步图文仅替换变化的图文"""
+        def make_news(media_id, titles, update_time):
+            return dict(media_id=media_id, update_time=update_time, content=dict(
+                update_time=update_time,
+                news_item=[
+                    dict(title=title, thumb_media_id="thumb", author="",
+                         digest="", content=title, url="url",
+                         content_source_url="", show_cover_pic=1)
+                    for title in titles]))
+
+        news = [make_news("news", ["a", "b", "c"], 100)]
+        with mock.patch.object(WeChatMaterial, "batchget") as batchget:
+            batchget.side_effect = self.batchget(news)
+            Material.sync_type(self.app, Material.Type.NEWS)
+            articles = Article.objects.filter(material__media_id="news")
+            self.assertEqual(
+                list(articles.values_list("title", flat=True)),
+                ["a", "b", "c"])
+            ids = list(articles.values_list("id", flat=True))
+
+            news = [make_news("news", ["a", "changed"], 101)]
+            batchget.side_effect = self.batchget(news)
+            Material.sync_type(self.app, Material.Type.NEWS, incremental=True)
+            self.assertEqual(
+                list(articles.values_list("title", flat=True)),
+                ["a", "changed"])
+            # 未变化的图文不重写
+            self.assertEqual(articles.get(index=0).id, ids[0])
+            self.assertNotEqual(articles.get(index=1).id, ids[1])
+            self.assertEqual(
+                articles.first().material.update_time, 101)
+
+    def test_as_permenant(self):
+        """测试临时素材转永久素材按内容去重"""
+        contents = dict(temp1=b"image" * 1000, temp2=b"image" * 1000,
+                        temp3=b"another")
+
+        @urlmatch(netloc=r"(.*\.)?api\.weixin\.qq\.com$",
+                  path="/cgi-bin/media/get")
+        def media_get(url, request):
+            media_id = url.query.split("media_id=")[1].split("&")[0]
+            return response(200, contents[media_id], {
+                "Content-Type": "image/jpeg",
+                "Content-Disposition": 'attachment; filename="a.jpg"'
+            })
+
+        uploaded = []
+
+        def on_upload(url, request, response):
+            uploaded.append(request.body)
+
+        add_material = wechatapi(
+            "/cgi-bin/material/add_material",
+            dict(media_id="permanent", url="url"), on_upload)
+        with wechatapi_accesstoken(), HTTMock(media_get), add_material:
+            material = Material.as_permenant("temp1", self.app)
+            self.assertEqual(material.media_id, "permanent")
+            self.assertEqual(material.type, Material.Type.IMAGE)
+            self.assertEqual(len(uploaded), 1)
+            self.assertIn(contents["temp1"], uploaded[0])
+
+            # 相同内容不重复上传
+            self.assertEqual(
+                Material.as_permenant("temp2", self.app, False), "permanent")
+            self.assertEqual(len(uploaded), 1)
+
+            add_material = wechatapi(
+                "/cgi-bin/material/add_material",
+                dict(media_id="another", url="url"), on_upload)
+            with add_material:
+                self.assertEqual(
+                    Material.as_permenant("temp3", self.app, False),
+                    "another")
+            self.assertEqual(len(uploaded), 2)
+
+    def batchget(self, items):
+        def batchget(media_type, offset, count):
+            return dict(
+                item=items[offset:offset + count], total_count=len(items),
+                item_count=len(items[offset:offset + count]))
+        return batchget
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import requests
 from wechatpy.client.api import WeChatMenu
+from wechatpy.exceptions import WeChatClientException
 
-from ..models import Material, Menu, WeChatApp
+from ..models import ConditionalMenu, Material, Menu, WeChatApp
 from .base import mock, WeChatTestCase
 
 
@@ -48,8 +50,147 @@ class MenuTestCase(WeChatTestCase):
             self.assertMenusEqual(self.menus, buttons)
 
     def test_menu_publish(self):
-        # 菜单发布
-        pass
+        """测试菜单发布"""
+        menu = Menu.objects.create(
+            app=self.app, name="menu", type=Menu.Event.CLICK,
+            content=dict(key="key"))
+        sub = Menu.objects.create(app=self.app, name="sub", content={})
+        sub.sub_button.add(Menu.objects.create(
+            app=self.app, name="view", type=Menu.Event.VIEW,
+            content=dict(url="https://baidu.com")))
+        expected = dict(button=[
+            dict(name="menu", type=Menu.Event.CLICK, key="key"),
+            dict(name="sub", sub_button=[
+                dict(name="view", type=Menu.Event.VIEW,
+                     url="https://baidu.com")])
+        ])
+
+        with mock.patch.object(WeChatMenu, "create"):
+            WeChatMenu.create.return_value = dict(errcode=0)
+            self.app.publish_menus()
+            WeChatMenu.create.assert_called_once_with(expected)
+            self.assertEqual(self.app.ext_info["current_menus"], expected)
+
+            # 菜单未变化时不调用接口
+            self.assertIsNone(self.app.publish_menus())
+            self.assertEqual(WeChatMenu.create.call_count, 1)
+            self.app.publish_menus(force=True)
+            self.assertEqual(WeChatMenu.create.call_count, 2)
+
+            # 菜单变动后重新生成
+            menu.content = dict(key="changed")
+            menu.save()
+            self.app.publish_menus()
+            self.assertEqual(WeChatMenu.create.call_count, 3)
+            self.assertEqual(
+                WeChatMenu.create.call_args[0][0]["button"][0]["key"],
+                "changed")
+            menu.delete()
+            self.app.publish_menus()
+            self.assertEqual(
+                len(WeChatMenu.create.call_args[0][0]["button"]), 1)
+
+            # 不发送信号的批量更新同样生效
+            Menu.objects.filter(pk=sub.pk).update(name="updated")
+            self.app.publish_menus()
+            self.assertEqual(WeChatMenu.create.call_count, 5)
+            self.assertEqual(
+                WeChatMenu.create.call_args[0][0]["button"][0]["name"],
+                "updated")
+
+    def test_conditional_publish(self):
+        """测试个性化菜单批量发布"""
+        default = Menu.objects.create(
+            app=self.app, name="default", type=Menu.Event.CLICK,
+            content=dict(key="default"))
+        conditionals = []
+        for i in range(3):
+            conditional = ConditionalMenu.objects.create(
+                app=self.app, title=str(i), matchrule=dict(tag_id=str(i)))
+            Menu.objects.create(
+                app=self.app, name="menu", type=Menu.Event.CLICK,
+                content=dict(key=str(i)), conditional=conditional)
+            conditionals.append(conditional)
+        # 默认菜单不包含个性化菜单
+        self.assertEqual(
+            Menu.menus2json(self.app), dict(button=[default.to_json()]))
+
+        menuids = iter(range(100, 200))
+        with mock.patch.object(WeChatMenu, "add_conditional"),\
+            mock.patch.object(WeChatMenu, "del_conditional"):
+            WeChatMenu.add_conditional.side_effect = lambda data: dict(
+                menuid=next(menuids))
+
+            rv = self.app.publish_conditional_menus()
+            self.assertEqual(rv, dict(published=3, skipped=0, failed=0))
+            self.assertEqual(WeChatMenu.add_conditional.call_count, 3)
+            self.assertEqual(WeChatMenu.del_conditional.call_count, 0)
+            published = {
+                call[0][0]["matchrule"]["tag_id"]: call[0][0]["button"]
+                for call in WeChatMenu.add_conditional.call_args_list}
+            self.assertEqual(published, {
+                str(i): [dict(name="menu", type=Menu.Event.CLICK, key=str(i))]
+                for i in range(3)})
+
+            # 未变化的菜单不再发布
+            rv = self.app.publish_conditional_menus()
+            self.assertEqual(rv, dict(published=0, skipped=3, failed=0))
+
+            # 仅重新发布有变化的菜单
+            menuid = ConditionalMenu.objects.get(pk=conditionals[1].pk).menuid
+            menu = conditionals[1].menus.get()
+            menu.content = dict(key="changed")
+            menu.save()
+            rv = self.app.publish_conditional_menus()
+            self.assertEqual(rv, dict(published=1, skipped=2, failed=0))
+            conditional = ConditionalMenu.objects.get(pk=conditionals[1].pk)
+            WeChatMenu.del_conditional.assert_called_once_with(menuid)
+            self.assertNotEqual(conditional.menuid, menuid)
+            self.assertEqual(
+                conditional.published["button"][0]["key"], "changed")
+
+            # 新菜单创建失败时不删除旧菜单
+            menuid = conditional.menuid
+            menu.content = dict(key="failed")
+            menu.save()
+            WeChatMenu.del_conditional.reset_mock()
+            WeChatMenu.add_conditional.side_effect = WeChatClientException(
+                -1, "error")
+            rv = self.app.publish_conditional_menus()
+            self.assertEqual(rv, dict(published=0, skipped=2, failed=1))
+            self.assertEqual(WeChatMenu.del_conditional.call_count, 0)
+            self.assertEqual(
+                ConditionalMenu.objects.get(pk=conditional.pk).menuid, menuid)
+
+            # 其他异常同样计为失败 不中断发布
+            WeChatMenu.add_conditional.side_effect = requests.ConnectionError
+            rv = self.app.publish_conditional_menus()
+            self.assertEqual(rv, dict(published=0, skipped=2, failed=1))
+
+            # 删除微信菜单失败时仍删除本地菜单
+            other = ConditionalMenu.objects.get(pk=conditionals[0].pk)
+            WeChatMenu.del_conditional.side_effect = WeChatClientException(
+                -1, "error")
+            other.delete()
+            WeChatMenu.del_conditional.assert_called_with(other.menuid)
+            self.assertFalse(
+                ConditionalMenu.objects.filter(pk=other.pk).exists())
+            WeChatMenu.del_conditional.side_effect = None
+
+            # 删除时一并删除微信菜单
+            conditional.delete()
+            WeChatMenu.del_conditional.assert_called_with(conditional.menuid)
+            self.assertFalse(Menu.objects.filter(pk=menu.pk).exists())
+
+            # 批量删除同样删除微信菜单
+            WeChatMenu.del_conditional.reset_mock()
+            menuids = set(self.app.conditional_menus.values_list(
+                "menuid", flat=True))
+            self.app.conditional_menus.all().delete()
+            self.assertEqual(
+                {call[0][0] for call in
+                 WeChatMenu.del_conditional.call_args_list},
+                menuids)
 
     def assertMenusEqual(self, menus, buttons):
         self.assertEqual(len(menus), len(buttons))
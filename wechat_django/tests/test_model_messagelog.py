@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.utils import timezone
+from wechatpy import messages
+
+from ..models import MessageLog
+from ..search import SQLiteFTSSearchBackend
+from ..utils.model import bucket_range, month_bucket
+from .base import mock, WeChatTestCase
+
+
+class MessageLogTestCase(WeChatTestCase):
+    def setUp(self):
+        super(MessageLogTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(MessageLogTestCase, self).tearDown()
+
+    def test_bucket(self):
+        """测试按月分区"""
+        log = self.create_log()
+        self.assertEqual(log.bucket, month_bucket(timezone.now()))
+
+        january = self.create_log(201901)
+        february = self.create_log(201902)
+        self.assertEqual(january.bucket, 201901)
+        self.assertEqual(
+            bucket_range(201912)[1], timezone.make_aware(
+                timezone.datetime(2020, 1, 1)))
+
+        start, end = bucket_range(201902)
+        logs = MessageLog.objects.filter(app=self.app)
+        self.assertEqual(list(logs.between(start, end)), [february])
+        self.assertEqual(
+            set(logs.between(start)), {log, february})
+        self.assertEqual(
+            list(logs.buckets()), [log.bucket, 201902, 201901])
+        buckets = logs.calendar_buckets()
+        self.assertEqual(buckets[0], log.bucket)
+        self.assertEqual(buckets[-3:], [201903, 201902, 201901])
+
+    def test_archive(self):
+        """测试归档"""
+        january = self.create_log(201901)
+        february = self.create_log(201902)
+        before = bucket_range(201902)[0]
+
+        rv = self.app.archive_messagelogs(before, self.path, chunk_size=1)
+        self.assertEqual(rv, {201901: 1})
+        self.assertFalse(MessageLog.objects.filter(pk=january.pk).exists())
+        self.assertTrue(MessageLog.objects.filter(pk=february.pk).exists())
+
+        # 再次归档时写入新的文件
+        another = self.create_log(201901)
+        self.app.archive_messagelogs(before, self.path)
+        rows = self.read_archive(201901)
+        self.assertEqual([row["id"] for row in rows], [january.pk, another.pk])
+        self.assertEqual(rows[0]["content"], january.content)
+        self.assertEqual(rows[0]["user__openid"], january.user.openid)
+
+        # 写入归档后删除中断 再次归档时不重复写入
+        logs = [self.create_log(201901) for i in range(2)]
+        with mock.patch("wechat_django.search.get_search_backend",
+                        side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.app.archive_messagelogs(before, self.path, chunk_size=1)
+        self.assertTrue(MessageLog.objects.filter(pk=logs[1].pk).exists())
+        rv = self.app.archive_messagelogs(before, self.path)
+        self.assertEqual(rv, {201901: 0})
+        self.assertFalse(MessageLog.objects.filter(bucket=201901).exists())
+        rows = self.read_archive(201901)
+        self.assertEqual(
+            [row["id"] for row in rows],
+            [january.pk, another.pk] + [log.pk for log in logs])
+
+    def test_search(self):
+        """测试消息搜索"""
+        user = self.app.users.create(openid="search_user")
+        message = messages.TextMessage(dict(
+            FromUserName=user.openid, Content="你好世界", MsgId=1,
+            CreateTime=int(time.time())))
+        log = MessageLog._from_message(message, self.app, user)
+        self.assertEqual(log.text, "你好世界")
+        voice = self.create_log()
+        MessageLog.objects.filter(pk=voice.pk).update(
+            content=dict(recognition="语音识别"), text=None)
+
+        logs = MessageLog.objects.filter(app=self.app)
+        self.assertEqual(list(logs.search("好世")), [log])
+        self.assertEqual(MessageLog.reindex(logs), 2)
+        self.assertEqual(list(logs.search("语音")), [voice])
+
+        backend = SQLiteFTSSearchBackend()
+        with mock.patch("wechat_django.search._backend", backend):
+            self.assertTrue(backend.available)
+            self.assertEqual(MessageLog.reindex(logs), 2)
+            self.assertEqual(list(logs.search("你好世")), [log])
+            # 不足3个字符的检索词退化为包含查询
+            self.assertEqual(list(logs.search("识别")), [voice])
+            MessageLog._archive_bucket(
+                self.app, log.bucket, self.path, 1000)
+            self.assertEqual(list(logs.search("你好世")), [])
+
+            # 级联删除时同步移除索引 重用的rowid不会匹配旧文本
+            log = MessageLog._from_message(message, self.app, user)
+            user.delete()
+            self.assertEqual(list(logs.search("你好世")), [])
+            user = self.app.users.create(openid="search_user")
+            reused = MessageLog.objects.create(
+                id=log.id, app=self.app, user=user, type="text",
+                content=dict(content="其他内容"), text="其他内容")
+            self.assertEqual(list(logs.search("你好世")), [])
+            self.assertEqual(list(logs.search("其他内")), [reused])
+
+    def read_archive(self, bucket):
+        prefix = "messagelog-{0}-{1}-".format(self.app.name, bucket)
+        rows = []
+        for name in sorted(os.listdir(self.path)):
+            if name.startswith(prefix):
+                with gzip.open(os.path.join(self.path, name), "rb") as f:
+                    rows.extend(json.loads(line.decode("utf-8")) for line in f)
+        return sorted(rows, key=lambda row: row["id"])
+
+    def create_log(self, bucket=None):
+        user = self.app.users.get_or_create(openid="openid")[0]
+        log = MessageLog.objects.create(
+            app=self.app, user=user, type="text", content=dict(content="a"))
+        if bucket:
+            log.created_at = bucket_range(bucket)[0] + timezone.timedelta(
+                days=10)
+            log.save()
+        return log
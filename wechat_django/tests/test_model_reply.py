@@ -5,16 +5,19 @@ import json
 import time
 
 from django.test import RequestFactory
+from django.utils import timezone
 from django.utils.http import urlencode
 from httmock import response
 from requests.exceptions import HTTPError
 from six.moves.urllib.parse import parse_qsl
 from wechatpy import messages, parse_message, replies
+from wechatpy.client.api import WeChatMessage
+from wechatpy.exceptions import WeChatClientException
 from wechatpy.utils import check_signature, WeChatSigner
 
 from ..exceptions import MessageHandleError
 from ..handler import Handler, WeChatMessageInfo
-from ..models import MessageHandler, Reply
+from ..models import MessageHandler, MessageLog, Reply
 
 from .base import mock, WeChatTestCase
 from .interceptors import (common_interceptor, wechatapi,
@@ -365,6 +368,59 @@ class ReplyTestCase(WeChatTestCase):
         ), callback):
             handler.replies.all()[0].send(message)
 
+    def test_broadcast(self):
+        """测试向活跃用户群发客服消息"""
+        content = "broadcast"
+        users = [self.app.users.create(openid="openid%d" % i)
+                 for i in range(4)]
+        another = self.another_app.users.create(openid="another")
+        for user in users + [another]:
+            MessageLog.objects.create(
+                app=user.app, user=user, type="text",
+                content=dict(content="hello"))
+        # 过期及由公众号发出的消息不计
+        MessageLog.objects.filter(user=users[0]).update(
+            created_at=timezone.now() - timezone.timedelta(hours=49))
+        MessageLog.objects.filter(user=users[1]).update(
+            direct=MessageLog.Direct.APP2USER)
+
+        active_users = self.app.active_users()
+        self.assertEqual(
+            set(active_users.values_list("openid", flat=True)),
+            {"openid2", "openid3"})
+        self.assertEqual(
+            set(self.app.active_users(hours=50).values_list(
+                "openid", flat=True)),
+            {"openid0", "openid2", "openid3"})
+
+        handler = self._create_handler(replies=dict(
+            type=Reply.MsgType.TEXT,
+            content=content
+        ))
+        reply = handler.replies.all()[0]
+
+        def send_text(user_id, content, account=None):
+            if user_id == "openid3":
+                raise WeChatClientException(45015, "response out of time limit")
+            return dict(errcode=0)
+
+        with mock.patch.object(WeChatMessage, "send_text"):
+            WeChatMessage.send_text.side_effect = send_text
+            rv = reply.broadcast(active_users, workers=2)
+            self.assertEqual(rv, dict(
+                sent=1, failed=1, errors={"openid3": 45015}))
+            self.assertEqual(WeChatMessage.send_text.call_count, 2)
+            self.assertEqual(
+                WeChatMessage.send_text.call_args[1]["content"], content)
+
+        handler = self._create_handler(replies=dict(
+            type=Reply.MsgType.CUSTOM,
+            program="wechat_django.tests.test_model_handler.debug_handler"
+        ))
+        self.assertRaises(
+            MessageHandleError, handler.replies.all()[0].broadcast,
+            active_users)
+
     def _wrap_message(self, message):
         return WeChatMessageInfo(
             _app=self.app,
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
+
+from wechatpy import parse_message
 from wechatpy.client.api import WeChatMessage, WeChatTemplate, WeChatWxa
+from wechatpy.exceptions import WeChatClientException
 
-from ..models import Template, WeChatUser
+from ..handler import handle_template_events
+from ..models import Template, TemplateMessageLog, WeChatUser
 from .base import mock, WeChatTestCase
 
 
@@ -158,6 +163,135 @@ class TemplateTestCase(WeChatTestCase):
                 WeChatMessage.send_template,
                 (openid, id, {k: {"value": v["value"]} for k, v in data.items()}))
 
+    def test_send_many(self):
+        """测试批量发送模板消息"""
+        blocked = "openid3"
+
+        def post(endpoint, data):
+            data = json.loads(data.decode("utf-8"))
+            if data["touser"] == blocked:
+                raise WeChatClientException(43004, "require subscribe")
+            return dict(errcode=0, errmsg="ok", msgid=int(data["touser"][-1]))
+
+        t = Template.objects.create(
+            app=self.app, template_id="id", title="title", content="")
+        users = [self.app.users.create(openid="openid%d" % i)
+                 for i in range(5)]
+        with mock.patch.object(WeChatMessage, "_post"):
+            WeChatMessage._post.side_effect = post
+            rv = t.send_many(
+                self.app.users.all(), lambda u: dict(first=u.openid),
+                workers=2, remark="remark")
+            self.assertEqual(rv["sent"], 4)
+            self.assertEqual(rv["failed"], 1)
+            self.assertEqual(WeChatMessage._post.call_count, 5)
+            call_args = [
+                json.loads(c[1]["data"].decode("utf-8"))
+                for c in WeChatMessage._post.call_args_list]
+            call_args = {o["touser"]: o["data"] for o in call_args}
+            for user in users:
+                self.assertEqual(call_args[user.openid], dict(
+                    first=dict(value=user.openid),
+                    remark=dict(value="remark")))
+
+            logs = t.logs.filter(campaign=rv["campaign"])
+            self.assertEqual(logs.count(), 5)
+            log = logs.get(openid=blocked)
+            self.assertEqual(log.errcode, 43004)
+            self.assertIsNone(log.msgid)
+            log = logs.get(openid="openid1")
+            self.assertEqual(log.errcode, 0)
+            self.assertEqual(log.msgid, 1)
+
+            # 续发 只重发失败的用户
+            WeChatMessage._post.reset_mock()
+            blocked = None
+            resumed = t.send_many(
+                [u.openid for u in users], campaign=rv["campaign"],
+                remark="remark")
+            self.assertEqual(resumed["sent"], 1)
+            self.assertEqual(resumed["skipped"], 4)
+            self.assertEqual(WeChatMessage._post.call_count, 1)
+            self.assertEqual(logs.count(), 5)
+            self.assertFalse(logs.exclude(errcode=0).exists())
+
+    def test_compile(self):
+        """测试预编译模板消息与send发送的数据一致"""
+        openid = "openid"
+
+        def assertBodyEqual(template, api, static, fields, **kwargs):
+            with mock.patch.object(api, "_post"):
+                template.send(openid, **dict(static, **fields))
+                expected = api._post.call_args[1]["data"]
+                template.compile(**static).send(openid, **fields)
+                body = api._post.call_args[1]["data"]
+                self.assertEqual(json.loads(body.decode("utf-8")), expected)
+                self.assertEqual(
+                    api._post.call_args[0], (kwargs["endpoint"],))
+
+        t = Template(app=self.app, template_id="id")
+        static = dict(url="url", appid="appid", pagepath="pagepath",
+                      first="恭喜你购买成功！",
+                      remark=dict(value="remark", color="#173177"))
+        fields = dict(keyword1="巧克力", remark="覆盖")
+        assertBodyEqual(t, WeChatMessage, static, fields,
+                        endpoint="message/template/send")
+        assertBodyEqual(t, WeChatMessage, dict(), fields,
+                        endpoint="message/template/send")
+
+        t = Template(app=self.miniprogram, template_id="id")
+        static = dict(page="page", emphasis_keyword="keyword1.DATA",
+                      keyword2="2015年01月05日 12:30")
+        fields = dict(keyword1="339208499", form_id="form_id")
+        assertBodyEqual(t, WeChatWxa, static, fields,
+                        endpoint="cgi-bin/message/wxopen/template/send")
+
+    def test_delivery_receipt(self):
+        """测试模板消息送达回执"""
+        t = Template.objects.create(
+            app=self.app, template_id="id", title="title", content="")
+        with mock.patch.object(WeChatMessage, "send_template"):
+            WeChatMessage.send_template.side_effect = lambda openid, *a, **kw:\
+                dict(errcode=0, errmsg="ok", msgid=int(openid[-1]))
+            logs = [t.send_with_log("openid%d" % i, "campaign")
+                    for i in range(4)]
+            WeChatMessage.send_template.side_effect = WeChatClientException(
+                43004, "require subscribe")
+            self.assertRaises(WeChatClientException, t.send_with_log,
+                              "openid9", "campaign")
+        self.assertEqual(logs[1].msgid, 1)
+
+        def receipt(msgid, status):
+            xml = """<xml>
+                <ToUserName><![CDATA[gh_7f083739789a]]></ToUserName>
+                <FromUserName><![CDATA[openid]]></FromUserName>
+                <CreateTime>1395658920</CreateTime>
+                <MsgType><![CDATA[event]]></MsgType>
+                <Event><![CDATA[TEMPLATESENDJOBFINISH]]></Event>
+                <MsgID>{0}</MsgID>
+                <Status><![CDATA[{1}]]></Status>
+            </xml>""".format(msgid, status)
+            message_info = self._msg2info(parse_message(xml))
+            handle_template_events(self.app.staticname, message_info)
+
+        Status = TemplateMessageLog.Status
+        receipt(0, Status.SUCCESS)
+        receipt(1, Status.USERBLOCK)
+        receipt(2, Status.SYSTEMFAILED)
+        self.assertEqual(
+            t.logs.get(msgid=0).status, Status.SUCCESS)
+        self.assertEqual(
+            t.logs.get(msgid=1).status, Status.USERBLOCK)
+
+        # 批量更新
+        self.assertEqual(TemplateMessageLog.objects.update_status(
+            [(0, Status.SUCCESS), (3, Status.SUCCESS)]), 2)
+
+        stats = t.logs.filter(campaign="campaign").stats()
+        self.assertEqual(stats, dict(
+            total=5, sent=4, failed=1, delivered=2, user_block=1,
+            system_failed=1, pending=0))
+
     def assertTemplateEqual(self, app, templates):
         """模板和同步的一致"""
         self.assertEqual(app.templates.count(), len(templates))
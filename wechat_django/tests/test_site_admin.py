@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.contrib.auth.models import User
+
+from ..models import permission as pm, WeChatApp
+from ..sites.admin import default_site
 from .base import WeChatTestCase
 
 
@@ -12,3 +16,42 @@ class AdminSiteTestCase(WeChatTestCase):
 
         # 测试响应有extra_context
         pass
+
+    def test_cached_apps(self):
+        """测试后台公众号列表缓存"""
+        app = default_site.get_app(self.app.id)
+        self.assertEqual(app.name, self.app.name)
+        self.assertIsNone(default_site.get_app(0))
+
+        user = User.objects.create_user("staff")
+        user.user_permissions.add(
+            pm.get_perm_model(pm.get_perm_name(self.app, "menu")))
+        request = self.rf().get("/admin/")
+        request.user = User.objects.get(pk=user.pk)
+        visible = [(self.app.id, self.app.name, str(self.app))]
+        self.assertEqual(default_site.get_visible_apps(request), visible)
+        with self.assertNumQueries(0):
+            self.assertEqual(default_site.get_visible_apps(request), visible)
+
+        # 保存其他模型不失效
+        self.app.users.create(openid="openid")
+        with self.assertNumQueries(0):
+            self.assertEqual(default_site.get_visible_apps(request), visible)
+
+        # 公众号变动后失效
+        self.app.title = "changed"
+        self.app.save()
+        self.assertEqual(default_site.get_app(self.app.id).title, "changed")
+        self.assertEqual(
+            default_site.get_visible_apps(request),
+            [(self.app.id, self.app.name, str(self.app))])
+
+        # 权限变动后失效
+        another = WeChatApp.objects.create(
+            title="another", name="another", appid="another")
+        user.user_permissions.add(
+            pm.get_perm_model(pm.get_perm_name(another, "menu")))
+        request.user = User.objects.get(pk=user.pk)
+        self.assertEqual(
+            {o[0] for o in default_site.get_visible_apps(request)},
+            {self.app.id, another.id})
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import shutil
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.urls import reverse
+import requests
+
+from ..client import WeChatMaterial
+from ..materialcache import MaterialCache
+from .base import mock, WeChatTestCase
+
+
+class MaterialProxyTestCase(WeChatTestCase):
+    def setUp(self):
+        super(MaterialProxyTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.material_cache = MaterialCache(
+            FileSystemStorage(location=self.path), 1024)
+        patcher = mock.patch(
+            "wechat_django.sites.wechat.views.get_material_cache",
+            return_value=self.material_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(MaterialProxyTestCase, self).tearDown()
+
+    def test_cache(self):
+        """测试素材代理缓存"""
+        content = b"0123456789" * 10
+        url = self.url("media_id")
+        with mock.patch.object(WeChatMaterial, "get_stream") as get:
+            get.side_effect = lambda media_id: self.make_response(content)
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(b"".join(resp.streaming_content), content)
+            self.assertEqual(resp["Content-Type"], "image/jpeg")
+            etag = resp["ETag"]
+
+            # 再次访问不再请求微信
+            resp = self.client.get(url)
+            self.assertEqual(b"".join(resp.streaming_content), content)
+            self.assertEqual(get.call_count, 1)
+
+            # 相同内容只存储一份
+            resp = self.client.get(self.url("another_media_id"))
+            self.assertEqual(resp["ETag"], etag)
+            self.assertEqual(
+                len(list(self.material_cache._iter_files())), 1)
+
+        # 条件请求
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=resp["Last-Modified"])
+        self.assertEqual(resp.status_code, 304)
+
+        # Range请求
+        resp = self.client.get(url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp["Content-Range"], "bytes 10-19/100")
+        self.assertEqual(b"".join(resp.streaming_content), content[10:20])
+        resp = self.client.get(url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(resp.streaming_content), content[-5:])
+        resp = self.client.get(url, HTTP_RANGE="bytes=100-")
+        self.assertEqual(resp.status_code, 416)
+        # 语法无效的Range被忽略
+        resp = self.client.get(url, HTTP_RANGE="bytes=5-3")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b"".join(resp.streaming_content), content)
+
+    def test_nocache(self):
+        """测试未配置缓存时流式转发素材"""
+        content = b"0123456789" * 10
+        with mock.patch(
+            "wechat_django.sites.wechat.views.get_material_cache",
+            return_value=None),\
+            mock.patch.object(WeChatMaterial, "get_stream") as get:
+            upstream = get.return_value = self.make_response(content)
+            upstream.close = mock.MagicMock()
+            resp = self.client.get(self.url("media_id"))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(b"".join(resp.streaming_content), content)
+            self.assertEqual(resp["Content-Type"], "image/jpeg")
+            resp.close()
+            self.assertTrue(upstream.close.called)
+
+    def test_evict(self):
+        """测试缓存超出大小时淘汰最久未访问的文件"""
+        # 写入量在各进程间共享
+        another = MaterialCache(self.material_cache.storage, 1024)
+        for i in range(12):
+            material_cache = another if i % 2 else self.material_cache
+            material_cache.set(
+                self.app, "media{0}".format(i),
+                iter([bytes(bytearray([i])) * 50] * 2))
+        files = list(self.material_cache._iter_files())
+        self.assertLessEqual(sum(size for _, size, _ in files), 1024)
+        self.assertIsNone(self.material_cache.get(self.app, "media0")[0])
+        info, file = self.material_cache.get(self.app, "media11")
+        file.close()
+        self.assertEqual(info["size"], 100)
+
+    def make_response(self, content):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp._content = content
+        resp._content_consumed = True
+        resp.headers["Content-Type"] = "image/jpeg"
+        resp.headers["Content-Length"] = str(len(content))
+        return resp
+
+    def url(self, media_id):
+        return reverse("wechat_django:material_proxy", kwargs=dict(
+            appname=self.app.name, media_id=media_id))
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
 
 def next_chunk(iterator, count=100):
     rv = []
@@ -13,6 +17,48 @@ def next_chunk(iterator, count=100):
         yield rv
 
 
+def concurrent_map(func, iterable, workers=8, chunk_size=100):
+    """以有限线程池并发执行func,按输入顺序逐个产出结果
+
+    输入按chunk_size分块提交,不会一次性读入整个iterable,适合流式处理
+    大量数据.func应只做网络io等线程安全的工作,数据库写入请在调用方线程完成
+
+    :param workers: 最大并发数
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    pool = ThreadPool(workers)
+    try:
+        for items in next_chunk(iterable, chunk_size):
+            for rv in pool.imap(func, items):
+                yield rv
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class RateLimiter(object):
+    """线程安全的简单限流器,保证每秒最多放行rate次"""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
 class Static(object):
     __caches = dict()
 
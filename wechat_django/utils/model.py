@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import datetime
 import re
 
+from django.conf import settings
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -18,3 +21,22 @@ def enum2choices(enum):
 def model_fields(model, excludes=None):
     excludes = excludes or set()
     return set(map(lambda o: o.name, model._meta.fields)).difference(excludes)
+
+
+def month_bucket(dt):
+    """按月分区的分区号,如201906"""
+    if timezone.is_aware(dt):
+        dt = timezone.localtime(dt)
+    return dt.year * 100 + dt.month
+
+
+def bucket_range(bucket):
+    """分区号对应的时间范围[start, end)"""
+    year, month = divmod(bucket, 100)
+    start = datetime.datetime(year, month, 1)
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    end = datetime.datetime(year, month, 1)
+    if settings.USE_TZ:
+        start = timezone.make_aware(start)
+        end = timezone.make_aware(end)
+    return start, end